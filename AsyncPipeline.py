@@ -0,0 +1,637 @@
+#!/usr/bin/env python3
+"""
+Collect email and crawl the URLs in it at the same time, with asyncio.
+
+collect() runs four stages linked by bounded asyncio queues:
+    fetch   a thread per mailbox reads raw emails from its IMAP server
+    parse   a process pool parses them in batches, keeping their order
+    write   one thread owns the database connection and stores everything
+    crawl   a thread pool retrieves URLs claimed from the crawl queue
+An email's URLs are queued for crawling as soon as it's stored, so pages
+are retrieved while later emails are still downloading, instead of after
+the mailbox is drained.  Peewee and imaplib block, so the event loop only
+moves work between stages; every database call goes to the writer thread.
+
+Several accounts, and several folders of each, are read at once, each
+account using at most its maxConnections IMAP sessions.  An account that
+fails is reported and the rest carry on.
+
+Intended use:
+    collect(mailbox_options(accounts), cache=ResponseCache(DEFAULT_CACHE_PATH))
+"""
+
+import asyncio
+import collections
+import concurrent.futures as futures
+import contextlib
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from Common import print_error
+from CrawlFrontier import (CrawlFrontier, DEFAULT_WORKERS,
+        DEFAULT_DOMAIN_RATE, DEFAULT_DOMAIN_BURST)
+from DatabaseOperations import (Database, DEFAULT_LEASE,
+        DEFAULT_TRANSACTION_SIZE)
+from EmailRetriever import EmailRetriever
+from HighLevelFunctionality import (CLAIMS_PER_WORKER, MailboxSync,
+        store_url_contents)
+import Metrics
+from ParsePipeline import parse_emails, BATCHES_PER_WORKER, DEFAULT_BATCH_SIZE
+from RetrieveURLs import retrieveURLWithEachUserAgent, hostFailureCache
+
+# Items a stage may get ahead of the next one by
+QUEUE_SIZE = 256
+# IMAP sessions open at once to one account, unless it says otherwise
+DEFAULT_ACCOUNT_CONNECTIONS = 2
+# Follows the last email of a mailbox through the stages
+_END = object()
+
+def mailbox_options(accounts):
+    """
+    Expand account details into the options of each mailbox to collect.
+
+    :param list accounts: dicts with the keys of server_details, and
+        optionally "folders", a list of folder names (default INBOX), and
+        "maxConnections", the most sessions to open to the account at once
+        (default DEFAULT_ACCOUNT_CONNECTIONS)
+    :returns: a list of option dicts for collect(), one per folder
+    """
+    mailboxes = []
+    for account in accounts:
+        account = dict(account)
+        folders = account.pop("folders", None) or [account.get("directory",
+                "INBOX")]
+        for folder in folders:
+            mailboxes.append(dict(account, directory=folder))
+    return mailboxes
+
+class _Mailbox():
+    """One mailbox's retriever, and the emails stored from it"""
+    def __init__(self, email_server_opts, unseen_only, accountSlots):
+        self.opts = dict(email_server_opts, unseenOnly=unseen_only)
+        limit = self.opts.pop("maxConnections", DEFAULT_ACCOUNT_CONNECTIONS)
+        self.markSeen = self.opts.get("markSeen")
+        if self.markSeen is None:
+            self.markSeen = unseen_only
+        account = "{username}@{hostname}:{port}".format(**self.opts)
+        self.name = "{}/{}".format(account, self.opts.get("directory",
+                "INBOX"))
+        # Shared by the account's mailboxes, to limit its sessions
+        self.slots = accountSlots.setdefault(account,
+                threading.BoundedSemaphore(int(limit)))
+        self.sync = None
+        self.retriever = None
+        self.fetched = 0
+        self.stored = []
+        # Left unseen, and below the incremental mark, to be retried
+        self.unparsed = []
+        self.error = None
+        # The writer puts the stored uids here once they're committed
+        self.committed = queue.Queue()
+
+    def open(self, dbo, incremental):
+        """Make the retriever, on the writer thread"""
+        if incremental:
+            self.sync = MailboxSync(self.opts, dbo)
+        self.retriever = EmailRetriever(**dict(self.opts, markSeen=False,
+                raw=True))
+
+def _fetch_mailbox(mailbox, put, stop):
+    """
+    The fetch stage, on its own thread.  Once the account has a session to
+    spare, put() each (mailbox, uid, raw email) then (mailbox, _END, None),
+    then flag seen the emails the writer commits.  Returns early once stop
+    is set.  An error is recorded in mailbox.error, and ends the mailbox.
+    """
+    while not mailbox.slots.acquire(timeout=0.1):
+        if stop.is_set():
+            return
+    ended = False
+    try:
+        with mailbox.retriever as emails:
+            for (uid, raw) in emails:
+                if not put((mailbox, uid, raw)):
+                    return
+                mailbox.fetched += 1
+            ended = True
+            if not put((mailbox, _END, None)):
+                return
+            while not stop.is_set():
+                try:
+                    committed = mailbox.committed.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if mailbox.markSeen and committed:
+                    mailbox.retriever.flagSeen(committed)
+                return
+    except Exception as exc:
+        mailbox.error = exc
+        print_error("Error retrieving emails from", mailbox.name,
+                "Exception:", exc)
+        if not ended:
+            put((mailbox, _END, None))
+    finally:
+        mailbox.slots.release()
+
+def _store_emails(dbo, items):
+    """
+    Store parsed emails and queue their URLs for crawling.  At the end of a
+    mailbox, commit and hand its fetch thread the uids stored.
+
+    :param list items: (mailbox, uid, ParsedEmailData or None), or
+        (mailbox, _END, None)
+    :returns: (how many URLs were queued, how many mailboxes ended)
+    """
+    (queued, ended) = (0, 0)
+    for (mailbox, uid, email) in items:
+        if uid is _END:
+            dbo.commit()
+            mailbox.committed.put(list(mailbox.stored))
+            ended += 1
+            continue
+        if email is None:
+            mailbox.unparsed.append(uid)
+            Metrics.count("collect.unparsed")
+            continue
+        email_id = dbo.addContent(email)
+        dbo.addURLs(email.urlList, email_id, fromEmail=True)
+        queued += dbo.queueURLs(email.urlList, 0)
+        if mailbox.sync is not None and not mailbox.unparsed:
+            mailbox.sync.stored(mailbox.retriever, uid)
+        mailbox.stored.append(uid)
+        dbo.checkpoint()
+    return (queued, ended)
+
+class _Pipeline():
+    """The stages of one collect() run, sharing an event loop"""
+    def __init__(self, mailboxes, dbo, incremental, parse_workers,
+            url_workers, extract_depth, domain_rate, domain_burst, lease,
+            cache, host_failures, progress_interval):
+        self.mailboxes = mailboxes
+        self.dbo = dbo
+        self.incremental = incremental
+        self.parseWorkers = parse_workers
+        self.urlWorkers = url_workers
+        self.extractDepth = extract_depth
+        self.frontier = CrawlFrontier(domain_rate, domain_burst)
+        self.lease = lease
+        self.cache = cache
+        self.hostFailures = host_failures
+        self.progressInterval = progress_interval
+        self.stop = threading.Event()   # Tells the fetch threads to give up
+        self.emailsDone = False
+        # Counts the URLs queued, for the crawler to notice new ones
+        self.queued = 0
+        self.retrieved = 0
+        self.failure = None
+
+    def db(self, function, *args):
+        """Run function(*args) on the writer thread"""
+        return self.loop.run_in_executor(self.dbExecutor, function, *args)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        # The fetch threads wait on rawSlots rather than on the loop, so
+        # they needn't wait for the loop to run for each email
+        self.rawQueue = asyncio.Queue()
+        self.rawSlots = threading.Semaphore(QUEUE_SIZE)
+        self.parsedQueue = asyncio.Queue(QUEUE_SIZE)
+        self.wake = asyncio.Event()
+        if self.parseWorkers == 0:
+            parseExecutor = futures.ThreadPoolExecutor(1)
+        else:
+            parseExecutor = futures.ProcessPoolExecutor(self.parseWorkers)
+        self.parseWindow = BATCHES_PER_WORKER * (self.parseWorkers or
+                os.cpu_count() or 1)
+        with futures.ThreadPoolExecutor(1) as self.dbExecutor, \
+                futures.ThreadPoolExecutor(len(self.mailboxes)) as \
+                self.fetchExecutor, \
+                futures.ThreadPoolExecutor(self.urlWorkers) as \
+                self.urlExecutor, parseExecutor:
+            self.parseExecutor = parseExecutor
+            await self.db(self.dbo.__enter__)
+            try:
+                await self._stages()
+            except BaseException as exc:
+                await self.db(self.dbo.__exit__, type(exc), exc,
+                        exc.__traceback__)
+                raise
+            await self.db(self.dbo.__exit__, None, None, None)
+
+    async def _stages(self):
+        for mailbox in self.mailboxes:
+            await self.db(mailbox.open, self.dbo, self.incremental)
+        if self.hostFailures is not None:
+            self.hostFailures.load(await self.db(self.dbo.getHostFailures,
+                    time.time()))
+        await self.db(self.dbo.queueUnprocessedURLs)
+
+        tasks = [asyncio.ensure_future(stage) for stage in
+                [self._fetch(mailbox) for mailbox in self.mailboxes] +
+                [self._parse(), self._write(), self._crawl()]]
+        reporter = asyncio.ensure_future(self._report())
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            self.stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            reporter.cancel()
+        self.printProgress()
+        if self.hostFailures is not None:
+            await self.db(self.dbo.setHostFailures,
+                    self.hostFailures.entries())
+
+    def _put(self, item):
+        """Put item on rawQueue from a fetch thread, unless stop is set"""
+        while not self.stop.is_set():
+            if self.rawSlots.acquire(timeout=0.1):
+                self.loop.call_soon_threadsafe(self.rawQueue.put_nowait, item)
+                return True
+        return False
+
+    async def _get(self):
+        """Take an item from rawQueue, freeing its slot"""
+        item = await self.rawQueue.get()
+        self.rawSlots.release()
+        return item
+
+    async def _fetch(self, mailbox):
+        """Fetch a mailbox, failing the run only if every mailbox failed"""
+        await self.loop.run_in_executor(self.fetchExecutor, _fetch_mailbox,
+                mailbox, self._put, self.stop)
+        if all(other.error is not None for other in self.mailboxes):
+            raise mailbox.error
+
+    async def _report(self):
+        """Print progress every progressInterval seconds"""
+        while self.progressInterval:
+            await asyncio.sleep(self.progressInterval)
+            self.printProgress()
+
+    def printProgress(self):
+        """Print how far each mailbox, and the crawl, have got"""
+        for mailbox in self.mailboxes:
+            print("{}: {} emails fetched, {} stored{}{}".format(mailbox.name,
+                    mailbox.fetched, len(mailbox.stored),
+                    "" if not mailbox.unparsed else
+                    ", {} unparsed".format(len(mailbox.unparsed)),
+                    "" if mailbox.error is None else
+                    ", failed: {}".format(mailbox.error)))
+        print("Crawl: {} URLs retrieved, {} queued".format(self.retrieved,
+                self.queued))
+
+    async def _parse(self):
+        """
+        Parse batches of whatever has been fetched, up to parseWindow
+        batches at once, and pass them on in the order they were fetched
+        """
+        fetching = len(self.mailboxes)
+        pending = collections.deque()   # (items, future or None), oldest first
+        while fetching or pending:
+            if fetching and (not pending or (len(pending) < self.parseWindow
+                    and not self.rawQueue.empty())):
+                batch = [await self._get()]
+                while (len(batch) < DEFAULT_BATCH_SIZE and
+                        not self.rawQueue.empty()):
+                    batch.append(await self._get())
+                raws = [raw for (_, uid, raw) in batch if uid is not _END]
+                fetching -= len(batch) - len(raws)
+                pending.append((batch, self.loop.run_in_executor(
+                        self.parseExecutor, parse_emails, raws)
+                        if raws else None))
+                continue
+
+            (batch, future) = pending.popleft()
+            parsed = iter(await future if future is not None else [])
+            for (mailbox, uid, _) in batch:
+                await self.parsedQueue.put((mailbox, uid,
+                        None if uid is _END else next(parsed)))
+
+    async def _write(self):
+        """
+        Store parsed emails in order, as many as have arrived in each trip
+        to the writer thread
+        """
+        fetching = len(self.mailboxes)
+        while fetching:
+            items = [await self.parsedQueue.get()]
+            while (len(items) < DEFAULT_BATCH_SIZE and
+                    not self.parsedQueue.empty()):
+                items.append(self.parsedQueue.get_nowait())
+            (queued, ended) = await self.db(_store_emails, self.dbo, items)
+            fetching -= ended
+            if queued:
+                self.queued += queued
+                self.wake.set()
+        self.emailsDone = True
+        self.wake.set()
+
+    async def _crawl(self):
+        """
+        Claim URLs from the crawl queue whenever the frontier runs low, and
+        retrieve them as their domains allow, until the emails are stored
+        and nothing is left to claim
+        """
+        inFlight = set()
+        emptyClaimAt = None     # self.queued when a claim last found nothing
+
+        def _done(task):
+            inFlight.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                self.failure = task.exception()
+            self.wake.set()
+
+        try:
+            while True:
+                self.wake.clear()
+                if self.failure is not None:
+                    raise self.failure
+                # Only while there's room for more retrievals, since each
+                # claim is a database round trip
+                if (emptyClaimAt != self.queued and
+                        len(self.frontier) < self.urlWorkers and
+                        len(inFlight) < 2 * self.urlWorkers):
+                    queued = self.queued
+                    claimed = await self.db(self.dbo.claimURLs,
+                            CLAIMS_PER_WORKER * self.urlWorkers,
+                            self.extractDepth, self.lease)
+                    for (url, depth) in claimed:
+                        self.frontier.add(url, depth)
+                    emptyClaimAt = None if claimed else queued
+                while len(inFlight) < 2 * self.urlWorkers:
+                    item = self.frontier.pop()
+                    if item is None:
+                        break
+                    task = asyncio.ensure_future(self._retrieve(*item))
+                    inFlight.add(task)
+                    task.add_done_callback(_done)
+
+                if (self.emailsDone and not inFlight and
+                        not len(self.frontier) and
+                        emptyClaimAt == self.queued):
+                    return
+                try:
+                    await asyncio.wait_for(self.wake.wait(),
+                            self.frontier.nextReadyIn())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in inFlight:
+                task.cancel()
+
+    def _fetchURL(self, url):
+        print("Processing URL: {}".format(url))
+        return retrieveURLWithEachUserAgent(url, cache=self.cache,
+                hostFailures=self.hostFailures)
+
+    async def _retrieve(self, url, depth):
+        try:
+            result = await self.loop.run_in_executor(self.urlExecutor,
+                    self._fetchURL, url)
+        except Exception as err:
+            print_error("Error fetching URL:", url, "Exception:", err)
+            result = None
+        queued = await self.db(store_url_contents, self.dbo, url, depth,
+                result)
+        self.queued += queued
+        self.retrieved += 1
+
+@Metrics.timed()
+def collect(email_server_opts, unseen_only=True, incremental=False,
+        parse_workers=None, extract_depth=1, workers=DEFAULT_WORKERS,
+        domain_rate=DEFAULT_DOMAIN_RATE, domain_burst=DEFAULT_DOMAIN_BURST,
+        transaction_size=DEFAULT_TRANSACTION_SIZE, cache=None,
+        host_failures=hostFailureCache, lease=DEFAULT_LEASE,
+        similarity_index=None, progress_interval=10):
+    """
+    Pull email from servers into the database and crawl the URLs in it,
+    all at once.  Does the work of retrieve_emails_into_database then
+    retrieve_urls_into_database, but URLs are retrieved as soon as the
+    email they're in is stored.  Emails are flagged seen once committed.
+
+    :param email_server_opts:
+        Information about the email server.  The dictionary should have the
+        following keys: str hostname, int port, str username, str password
+        Or a list of them, one per mailbox, as mailbox_options makes, to
+        read all of them at once.  Each may also say which folder to read
+        under "directory", and how many sessions its account may have open
+        at once under "maxConnections".
+
+    :param bool unseen_only:
+        Optional - Default True
+        If true, only pull in emails that are marked unread
+
+    :param bool incremental:
+        Optional - Default False
+        If true, retrieve only the emails that arrived since the last
+        incremental run, seen or not, instead of following unseen_only
+
+    :param int parse_workers:
+        Optional - Default None
+        How many processes to parse emails in, None for one per core.  0
+        parses on a single thread instead.
+
+    :param int extract_depth:
+        Optional - Default 1
+        How many rounds of extraction to complete before quitting
+
+    :param int workers:
+        Optional - Default CrawlFrontier.DEFAULT_WORKERS
+        How many URLs to retrieve at once
+
+    :param float domain_rate:
+        Optional - Default CrawlFrontier.DEFAULT_DOMAIN_RATE
+        How many requests per second to allow to any one domain
+
+    :param int domain_burst:
+        Optional - Default CrawlFrontier.DEFAULT_DOMAIN_BURST
+        How many requests a domain may receive at once before domain_rate
+        applies
+
+    :param int transaction_size:
+        Optional - Default DatabaseOperations.DEFAULT_TRANSACTION_SIZE
+        How many emails and URLs to store in each database transaction
+
+    :param ResponseCache cache:
+        Optional - Default None
+        A cache to answer requests from, and store responses in
+
+    :param HostFailureCache host_failures:
+        Optional - Default RetrieveURLs.hostFailureCache
+        Hosts to skip because they recently failed, as for
+        retrieve_urls_into_database.  None never skips.
+
+    :param float lease:
+        Optional - Default DatabaseOperations.DEFAULT_LEASE
+        Seconds a claimed URL is held before another run may claim it
+
+    :param SimilarityIndex similarity_index:
+        Optional - Default None
+        An index to add the new emails, pages and scripts to
+
+    :param float progress_interval:
+        Optional - Default 10
+        Seconds between progress reports, None for only a final one.  Each
+        mailbox's failure, if any, is reported with its progress.
+
+    :returns: {mailbox name: how many emails were stored from it}
+
+    If every mailbox fails the first failure is raised, and what wasn't
+    committed is rolled back.
+    """
+    if isinstance(email_server_opts, dict):
+        email_server_opts = [email_server_opts]
+    accountSlots = dict()
+    mailboxes = [_Mailbox(opts, unseen_only, accountSlots)
+            for opts in email_server_opts]
+    dbo = Database(transactionSize=transaction_size,
+            similarityIndex=similarity_index)
+    pipeline = _Pipeline(mailboxes, dbo, incremental, parse_workers,
+            workers, extract_depth, domain_rate, domain_burst, lease, cache,
+            host_failures, progress_interval)
+    asyncio.run(pipeline.run())
+    return {mailbox.name: len(mailbox.stored) for mailbox in mailboxes}
+
+
+
+
+
+class CollectTester(unittest.TestCase):
+    """Runs against local stand in servers and a temporary database"""
+    def setUp(self):
+        import CreateTables
+        from DatabaseModel import database
+        self.database = database
+        self.originalPath = database.database
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database.init(os.path.join(self.tmpdir.name, "test.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateTables.create_tables()
+
+    def tearDown(self):
+        self.database.init(self.originalPath)
+        self.tmpdir.cleanup()
+
+    def test_collect(self):
+        from DatabaseModel import CrawlQueue, Email, HTML_Content, URL
+        from RetrieveURLs import userAgents
+        from StandInServers import StandInHTTPServer, StandInIMAPServer
+        with StandInHTTPServer({}) as web:
+            web.pages["/a.html"] = '<a href="{}">b</a>'.format(
+                    web.url("/b.html")).encode("ascii")
+            web.pages["/b.html"] = b"<p>the end</p>"
+            headers = "From: a@example.com\r\nTo: b@example.com\r\n"
+            messages = [(headers + "Subject: {0}\r\n\r\nhello {0} {1}\r\n"
+                    ).format(num, web.url(path)).encode("ascii")
+                    for (num, path) in enumerate(["/a.html"] * 5 +
+                    ["/missing.html"])]
+            with StandInIMAPServer(messages) as server, \
+                    contextlib.redirect_stdout(io.StringIO()):
+                collect({"hostname": "127.0.0.1", "port": server.port,
+                        "username": "user", "password": "pass",
+                        "useSSL": False}, parse_workers=0, extract_depth=2,
+                        workers=2, domain_rate=0, host_failures=None)
+                seen = [message[2] for message in server.messages]
+
+        self.database.connect()
+        try:
+            self.assertEqual(seen, [True] * 6)
+            self.assertEqual(Email.select().count(), 6)
+            self.assertEqual(HTML_Content.select().count(), 2)
+            # Each page is retrieved once, with each user agent
+            self.assertEqual(web.requestCount, 3 * len(userAgents))
+            urls = {url.url: url.processed for url in URL.select()}
+            self.assertEqual(urls[web.url("/b.html")], True)
+            # A 404 won't change on a retry
+            self.assertEqual(urls[web.url("/missing.html")], True)
+            states = {row.url.url: row.state for row in CrawlQueue.select()}
+            self.assertEqual(states[web.url("/a.html")], CrawlQueue.DONE)
+            self.assertEqual(states[web.url("/missing.html")],
+                    CrawlQueue.DONE)
+        finally:
+            self.database.close()
+
+    def test_unparsedLeftUnseen(self):
+        from DatabaseModel import Email, MailboxSyncState
+        from StandInServers import StandInIMAPServer
+        parse = parse_emails
+        def _parse_emails(raws):
+            return [None if b"Subject: 1\r\n" in raw else email
+                    for (raw, email) in zip(raws, parse(raws))]
+
+        messages = ["From: a@example.com\r\nTo: b@example.com\r\n"
+                "Subject: {0}\r\n\r\nhello {0}\r\n".format(num).encode(
+                "ascii") for num in range(3)]
+        with StandInIMAPServer(messages) as server, \
+                unittest.mock.patch.dict(globals(),
+                {"parse_emails": _parse_emails}), \
+                contextlib.redirect_stdout(io.StringIO()) as output:
+            stored = collect({"hostname": "127.0.0.1", "port": server.port,
+                    "username": "user", "password": "pass",
+                    "useSSL": False}, incremental=True, parse_workers=0,
+                    host_failures=None)
+            seen = [message[2] for message in server.messages]
+
+        self.assertEqual(list(stored.values()), [2])
+        self.assertEqual(seen, [True, False, True])
+        self.assertIn("2 stored, 1 unparsed", output.getvalue())
+        self.database.connect()
+        try:
+            self.assertEqual(Email.select().count(), 2)
+            # The incremental mark stays below the unparsed email
+            self.assertEqual(MailboxSyncState.get().lastUID, 1)
+        finally:
+            self.database.close()
+
+    def test_severalAccounts(self):
+        from DatabaseModel import Email
+        from StandInServers import StandInIMAPServer
+        def messages(account):
+            return ["From: a@example.com\r\nTo: {0}@example.com\r\n"
+                    "Subject: {1}\r\n\r\nhello {1}\r\n".format(account,
+                    num).encode("ascii") for num in range(3)]
+        with StandInIMAPServer(messages("one")) as one, \
+                StandInIMAPServer(messages("two")) as two:
+            accounts = [{"hostname": "127.0.0.1", "port": server.port,
+                    "username": "user", "password": "pass", "useSSL": False}
+                    for server in (one, two)]
+            # The folders of one take turns, and it has no Junk folder
+            accounts[0].update(folders=["INBOX", "Junk"], maxConnections=1)
+            accounts.append(dict(accounts[1], port=1))  # Nothing listens
+            mailboxes = mailbox_options(accounts)
+            self.assertEqual([opts["directory"] for opts in mailboxes],
+                    ["INBOX", "Junk", "INBOX", "INBOX"])
+            with contextlib.redirect_stdout(io.StringIO()) as output, \
+                    contextlib.redirect_stderr(io.StringIO()) as errors:
+                stored = collect(mailboxes, parse_workers=0,
+                        host_failures=None)
+                self.assertRaises(ConnectionError, collect, mailboxes[3:],
+                        parse_workers=0, host_failures=None)
+            seen = [message[2] for server in (one, two)
+                    for message in server.messages]
+
+        self.assertEqual(list(stored.values()), [3, 0, 3, 0])
+        self.assertEqual(seen, [True] * 6)
+        self.assertIn("/Junk", errors.getvalue())
+        self.assertIn("user@127.0.0.1:1/INBOX", errors.getvalue())
+        self.assertIn("user@127.0.0.1:1/INBOX: 0 emails fetched, 0 stored, "
+                "failed:", output.getvalue())
+        self.database.connect()
+        try:
+            self.assertEqual(Email.select().count(), 6)
+        finally:
+            self.database.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,581 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the ingestion code.
+
+Every benchmark runs against a scratch database in a temporary directory,
+so malmail.db is never touched.
+"""
+
+import argparse
+import contextlib
+import email.mime.application
+import email.mime.multipart
+import email.mime.text
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import unittest.mock
+
+import AsyncPipeline
+from DatabaseModel import database, Domain, URL
+import CreateTables
+import DatabaseOperations
+import HighLevelFunctionality
+from ConnectionPool import ConnectionPool
+import ContentHandlers
+import JSURLScanner
+from EmailRetriever import EmailRetriever
+import RetrieveURLs
+from SimilarityIndex import SimilarityIndex
+from StandInServers import StandInIMAPServer, StandInHTTPServer
+
+@contextlib.contextmanager
+def scratch_database():
+    """Point the model at an empty, freshly created database for a while."""
+    originalPath = database.database
+    with tempfile.TemporaryDirectory() as tmpdir:
+        database.init(os.path.join(tmpdir, "benchmark.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateTables.create_tables()
+        try:
+            yield
+        finally:
+            database.init(originalPath)
+
+def synthetic_pages(pages, linksPerPage, hosts, seed=0):
+    """
+    Build lists of links like those extracted from phishing pages.  Links
+    repeat across pages, the way kit assets do.
+    """
+    rand = random.Random(seed)
+    hostNames = ["http://host{}.example".format(num) for num in range(hosts)]
+    return [["{}/{}/{}".format(rand.choice(hostNames), page % 50,
+                    rand.randrange(linksPerPage * 4))
+                for _ in range(linksPerPage)]
+            for page in range(pages)]
+
+def _legacy_add_urls(urlList):
+    """The one-url-at-a-time insert addURLs used to do, for comparison."""
+    for url in urlList:
+        if not URL.select().where(URL.url == url).exists():
+            dom = DatabaseOperations.domain(url)
+            try:
+                domainID = Domain.select().where(Domain.url == dom).get().id
+            except Domain.DoesNotExist:
+                domainID = Domain.insert(url = dom).execute()
+            URL.insert(domain=domainID, url = url, processed=False).execute()
+
+def bench_add_urls(pages=20, linksPerPage=400, hosts=30):
+    """Compare rows per second for the legacy and the batched addURLs."""
+    pageLinks = synthetic_pages(pages, linksPerPage, hosts)
+    totalLinks = sum(len(links) for links in pageLinks)
+    results = dict()
+
+    for (name, add) in (("legacy", None), ("batched", "addURLs")):
+        with scratch_database():
+            with DatabaseOperations.Database() as dbo:
+                start = time.perf_counter()
+                with database.atomic():
+                    for links in pageLinks:
+                        if add is None:
+                            _legacy_add_urls(links)
+                        else:
+                            dbo.addURLs(links)
+                elapsed = time.perf_counter() - start
+                rows = URL.select().count() + Domain.select().count()
+        results[name] = {"seconds": elapsed, "rows": rows,
+                "links_per_second": totalLinks / elapsed}
+
+    for (name, result) in results.items():
+        print("addURLs {:8}: {:8.3f}s  {:6} rows  {:10.0f} links/s".format(
+            name, result["seconds"], result["rows"],
+            result["links_per_second"]))
+    print("speedup: {:.1f}x".format(
+        results["legacy"]["seconds"] / results["batched"]["seconds"]))
+    return results
+
+def synthetic_email(number, links=5):
+    """Build the RFC822 bytes of a plain phishing-style email."""
+    body = "\r\n".join(
+            "Verify your account at http://phish{}.example/login/{}".format(
+                number % 7, link) for link in range(links))
+    return ("From: Support <support@bank{0}.example>\r\n"
+            "To: Victim <victim@example.com>\r\n"
+            "Subject: Account notice {0}\r\n"
+            "Content-Type: text/plain; charset=utf-8\r\n"
+            "\r\n{1}\r\n").format(number, body).encode("utf-8")
+
+def bench_imap_fetch(messages=2000, latency=0.002,
+                chunkSizes=(1, 10, 100, 500)):
+    """Report messages per second retrieved for several UID FETCH sizes."""
+    mailbox = [synthetic_email(num) for num in range(messages)]
+    results = dict()
+    with StandInIMAPServer(mailbox, latency=latency) as server:
+        for chunkSize in chunkSizes:
+            start = time.perf_counter()
+            with EmailRetriever("127.0.0.1", server.port, "user", "password",
+                            unseenOnly=False, useSSL=False,
+                            chunkSize=chunkSize) as emails:
+                count = sum(1 for _ in emails)
+            elapsed = time.perf_counter() - start
+            results[chunkSize] = count / elapsed
+            print("IMAP fetch chunk {:4}: {:6} messages {:10.0f} messages/s"
+                    .format(chunkSize, count, results[chunkSize]))
+    return results
+
+def bench_http_pool(urls=200):
+    """Compare per-URL latency of the user agent sweep with and without
+    keep-alive connection pooling."""
+    pages = {"/{}".format(num): b"<a href='/next'>next</a>" * 20
+            for num in range(urls)}
+    results = dict()
+    with StandInHTTPServer(pages) as server:
+        for (name, pool) in (("urllib", None), ("pooled", ConnectionPool())):
+            connectionsBefore = server.connectionCount
+            start = time.perf_counter()
+            for path in pages:
+                RetrieveURLs.retrieveURLWithEachUserAgent(server.url(path),
+                                concurrent=False, pool=pool)
+            elapsed = time.perf_counter() - start
+            results[name] = elapsed / len(pages)
+            print("HTTP {:7}: {:7.2f} ms/URL  {:6} connections".format(
+                    name, 1000 * results[name],
+                    server.connectionCount - connectionsBefore))
+            if pool is not None:
+                pool.close()
+    return results
+
+def _legacy_plaintext_urls(data):
+    """The replace-then-split URL search PlainTextContent used to do."""
+    toReplaceChars = "\n\r"
+    if isinstance(data, bytes):
+        replaced = data.translate(None, bytes(toReplaceChars, "ascii"))
+        urlPrefixes = (b"http://", b"https://")
+    else:
+        replaced = data.translate("".maketrans("", "", toReplaceChars))
+        urlPrefixes = ("http://", "https://")
+    return [token for token in replaced.split()
+            if token.startswith(urlPrefixes)]
+
+def bench_plaintext_urls(megabytes=8, repeat=3):
+    """Time URL extraction from large plain text bodies, str and bytes."""
+    rand = random.Random(0)
+    lines = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        if rand.random() < 0.05:
+            line = "Click http://phish{}.example/login?id={} now".format(
+                    rand.randrange(100), rand.randrange(10 ** 6))
+        else:
+            line = " ".join("word{}".format(rand.randrange(1000))
+                    for _ in range(12))
+        lines.append(line)
+        size += len(line) + 2
+    text = "\r\n".join(lines)
+    results = dict()
+
+    for data in (text, text.encode("ascii")):
+        typeName = type(data).__name__
+        for (name, extract) in (("legacy", _legacy_plaintext_urls),
+                ("scanner", lambda d: list(
+                    ContentHandlers.PlainTextContent(d).extractURLs()))):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                count = len(extract(data))
+            elapsed = (time.perf_counter() - start) / repeat
+            results[(typeName, name)] = len(data) / elapsed / 1024 / 1024
+            print("plaintext {:5} {:7}: {:6} URLs {:8.1f} MB/s".format(
+                    typeName, name, count, results[(typeName, name)]))
+    return results
+
+def synthetic_minified_script(kilobytes, seed=0):
+    """Build a minified-looking script with a few URLs buried in it."""
+    rand = random.Random(seed)
+    statements = []
+    size = 0
+    while size < kilobytes * 1024:
+        roll = rand.random()
+        if roll < 0.01:
+            statement = 'window.location.href="http://drop{}.example/"+"p.php"'\
+                    .format(rand.randrange(100))
+        elif roll < 0.03:
+            statement = "var u{0}='https://cdn{0}.example/lib.js'".format(
+                    rand.randrange(100))
+        elif roll < 0.3:
+            statement = 'a.b("{}",function(e){{return e.c}})'.format(
+                    "".join(rand.choice("abcdefgh") for _ in range(20)))
+        else:
+            statement = "var {0}=function({1}){{return {1}*{2}+{0}.x||[]}}"\
+                    .format("f{}".format(rand.randrange(1000)),
+                    "n", rand.randrange(100))
+        statements.append(statement)
+        size += len(statement) + 1
+    return ";".join(statements)
+
+def bench_js_urls(kilobytes=(50, 500, 2000), repeat=3):
+    """
+    Time JSContent URL extraction on minified scripts, and show the budget
+    cutting off a large obfuscated one.
+    """
+    results = dict()
+    for size in kilobytes:
+        script = synthetic_minified_script(size)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            count = len(ContentHandlers.JSContent(script).extractURLs())
+        elapsed = (time.perf_counter() - start) / repeat
+        results[size] = len(script) / elapsed / 1024 / 1024
+        print("jsurls {:5} KB: {:4} URLs {:8.1f} MB/s {:7.1f} ms".format(
+                size, count, results[size], elapsed * 1000))
+
+    # One endless string concatenation, as packers produce
+    obfuscated = "var p=" + "+".join('"\\x{:02x}"'.format(num % 256)
+            for num in range(1500000)) + ";"
+    start = time.perf_counter()
+    JSURLScanner.extractURLs(obfuscated)
+    elapsed = time.perf_counter() - start
+    results["obfuscated"] = elapsed
+    print("jsurls obfuscated {:.1f} MB: stopped after {:.0f} ms "
+            "(budget {:.0f} ms, {:.1f} MB)".format(
+            len(obfuscated) / 1024 / 1024, elapsed * 1000,
+            JSURLScanner.DEFAULT_MAX_SECONDS * 1000,
+            JSURLScanner.DEFAULT_MAX_BYTES / 1024 / 1024))
+    return results
+
+def synthetic_phishing_site(campaigns, slowEvery=5, slowSeconds=0.05):
+    """
+    Build the pages of phishing campaigns, for StandInHTTPServer.
+
+    Each campaign has a redirect to its landing page, which pulls in a kit
+    script, an image and a help page.  Every slowEvery-th help page answers
+    slowly, and the page the script sends victims to is missing.
+    """
+    pages = dict()
+    for num in range(campaigns):
+        prefix = "/c{}".format(num)
+        pages["/r/{}".format(num)] = (302,
+                {"Location": prefix + "/login.html"}, b"")
+        pages[prefix + "/login.html"] = ("<html><script src='{0}/kit.js'>"
+                "</script><img src='{0}/logo.png'><form action='{0}/post.php'>"
+                "<a href='{0}/help.html'>help</a></form></html>".format(prefix)
+                ).encode("ascii")
+        pages[prefix + "/kit.js"] = (200,
+                {"Content-Type": "application/javascript"},
+                "window.location.href='{}/done.html';".format(prefix).encode(
+                "ascii"))
+        pages[prefix + "/logo.png"] = (200, {"Content-Type": "image/png"},
+                b"\x89PNG" + bytes(2000))
+        pages[prefix + "/help.html"] = (200,
+                {"Content-Type": "text/html; charset=utf-8"}, b"<p>help</p>",
+                slowSeconds if num % slowEvery == 0 else 0)
+    return pages
+
+def synthetic_phishing_email(number, siteURL, campaigns):
+    """
+    Build the RFC822 bytes of a multipart phishing email linking to a
+    campaign at siteURL.  Every tenth one has an attachment.
+    """
+    campaign = number % campaigns
+    message = email.mime.multipart.MIMEMultipart("mixed")
+    message["From"] = "Security <alert@bank{}.example>".format(campaign)
+    message["To"] = "victim{}@example.com".format(number)
+    message["Subject"] = "Unusual sign-in activity #{}".format(number)
+    body = email.mime.multipart.MIMEMultipart("alternative")
+    body.attach(email.mime.text.MIMEText("Confirm your details at "
+            "{}/c{}/login.html within 24 hours.".format(siteURL, campaign)))
+    body.attach(email.mime.text.MIMEText("<p>Please <a href='{}/r/{}'>sign "
+            "in</a> to keep your account.</p>".format(siteURL, campaign),
+            "html"))
+    message.attach(body)
+    if number % 10 == 0:
+        message.attach(email.mime.application.MIMEApplication(
+                os.urandom(20000), Name="statement.pdf"))
+    return message.as_bytes()
+
+def _count_rows():
+    """The number of rows in every table of the database"""
+    database.connect()
+    try:
+        return sum(database.execute_sql(
+                'SELECT COUNT(*) FROM "{}"'.format(table)).fetchone()[0]
+                for table in database.get_tables())
+    finally:
+        database.close()
+
+def _percentile(values, fraction):
+    """The nearest-rank percentile of values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def _timed_database(times):
+    """A Database class that appends the time of each checkpoint to times"""
+    class _TimedDatabase(DatabaseOperations.Database):
+        def checkpoint(self):
+            super().checkpoint()
+            times.append(time.perf_counter())
+    return _TimedDatabase
+
+def _run_stage(name, function):
+    """
+    Run one HighLevelFunctionality stage, timing each item it checkpoints.
+
+    Return value: a report dict for the stage
+    """
+    times = []
+    rowsBefore = _count_rows()
+    with unittest.mock.patch.object(HighLevelFunctionality, "Database",
+                    _timed_database(times)), \
+                    contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+    rows = _count_rows() - rowsBefore
+    latencies = [1000 * (end - begin)
+            for (begin, end) in zip([start] + times, times)]
+    return {name: len(times), "seconds": elapsed,
+            name + "_per_second": len(times) / elapsed, "rows": rows,
+            "rows_per_second": rows / elapsed,
+            "latency_ms": {"p50": _percentile(latencies, 0.5),
+                    "p99": _percentile(latencies, 0.99)}}
+
+def bench_end_to_end(emails=500, campaigns=50, imapLatency=0.001,
+                slowSeconds=0.05, extractDepth=2, workers=8):
+    """
+    Ingest a synthetic phishing run offline, from stand-in IMAP and HTTP
+    servers, through HighLevelFunctionality into a scratch database.
+
+    Prints and returns a JSON-ready report of emails/s, URLs/s, rows/s and
+    per-item latency.  Latency is the time between database checkpoints,
+    which the stages make once per email and once per URL.
+    """
+    pages = synthetic_phishing_site(campaigns, slowSeconds=slowSeconds)
+    with StandInHTTPServer(pages) as httpServer, scratch_database():
+        mailbox = [synthetic_phishing_email(num, httpServer.url(""),
+                        campaigns) for num in range(emails)]
+        with StandInIMAPServer(mailbox, latency=imapLatency) as imapServer:
+            serverOpts = {"hostname": "127.0.0.1", "port": imapServer.port,
+                    "username": "user", "password": "password",
+                    "useSSL": False}
+            report = _run_stage("emails", lambda:
+                    HighLevelFunctionality.retrieve_emails_into_database(
+                    serverOpts))
+        report = {"emails": report, "urls": _run_stage("urls", lambda:
+                HighLevelFunctionality.retrieve_urls_into_database(
+                extractDepth, workers=workers, domain_rate=0))}
+        report["http_requests"] = httpServer.requestCount
+    print(json.dumps(report, indent=2))
+    return report
+
+def bench_mbox_import(emails=3000, workerCounts=(0, None)):
+    """Compare emails per second imported from an mbox file, parsed in
+    this process and in a process pool."""
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "spam.mbox")
+        with open(path, "wb") as mbox:
+            for num in range(emails):
+                mbox.write(b"From MAILER-DAEMON Thu Jan  1 00:00:00 1970\n")
+                mbox.write(synthetic_phishing_email(num,
+                        "http://site.example", 200).replace(b"\nFrom ",
+                        b"\n>From ") + b"\n")
+        for workers in workerCounts:
+            name = "inline" if workers == 0 else "pool"
+            with scratch_database(), \
+                            contextlib.redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                HighLevelFunctionality.import_archive_into_database(path,
+                        workers)
+                elapsed = time.perf_counter() - start
+            results[name] = emails / elapsed
+            print("mbox import {:6}: {:8.0f} emails/s".format(name,
+                    results[name]))
+    return results
+
+def bench_email_pipeline(emails=1000, latency=0.001, workerCounts=(0, None)):
+    """Compare emails per second stored by retrieve_emails_into_database,
+    parsing inline and in the fetch, parse and write pipeline."""
+    mailbox = [synthetic_phishing_email(num, "http://site.example", 50)
+            for num in range(emails)]
+    results = dict()
+    for workers in workerCounts:
+        name = "inline" if workers == 0 else "pipelined"
+        with StandInIMAPServer(mailbox, latency=latency) as server, \
+                        scratch_database():
+            serverOpts = {"hostname": "127.0.0.1", "port": server.port,
+                    "username": "user", "password": "password",
+                    "useSSL": False}
+            start = time.perf_counter()
+            HighLevelFunctionality.retrieve_emails_into_database(serverOpts,
+                    parse_workers=workers)
+            elapsed = time.perf_counter() - start
+            seen = sum(1 for message in server.messages if message[2])
+        results[name] = emails / elapsed
+        print("email pipeline {:9}: {:8.0f} emails/s, {} flagged seen".format(
+                name, results[name], seen))
+    return results
+
+def bench_collect(emails=300, campaigns=30, imapLatency=0.25,
+                slowSeconds=0.2, extractDepth=2, workers=8):
+    """
+    Compare the wall time of a whole collection run, from stand-in IMAP and
+    HTTP servers, done in sequential stages and by the asyncio pipeline.
+
+    The defaults make the run wait on the network, as real ones do.  The
+    stand-in servers share this process, so with little latency and few
+    cores the run is bound by the CPU, and overlapping stages gains little.
+    """
+    pages = synthetic_phishing_site(campaigns, slowSeconds=slowSeconds)
+    results = dict()
+    with StandInHTTPServer(pages) as httpServer:
+        mailbox = [synthetic_phishing_email(num, httpServer.url(""),
+                        campaigns) for num in range(emails)]
+        for name in ("sequential", "asyncio"):
+            with StandInIMAPServer(mailbox, latency=imapLatency) as server, \
+                            scratch_database(), \
+                            contextlib.redirect_stdout(io.StringIO()):
+                serverOpts = {"hostname": "127.0.0.1", "port": server.port,
+                        "username": "user", "password": "password",
+                        "useSSL": False}
+                start = time.perf_counter()
+                if name == "sequential":
+                    HighLevelFunctionality.retrieve_emails_into_database(
+                            serverOpts, parse_workers=None)
+                    HighLevelFunctionality.retrieve_urls_into_database(
+                            extractDepth, workers=workers, domain_rate=0,
+                            host_failures=None)
+                else:
+                    AsyncPipeline.collect(serverOpts,
+                            extract_depth=extractDepth, workers=workers,
+                            domain_rate=0, host_failures=None)
+                elapsed = time.perf_counter() - start
+                rows = _count_rows()
+            results[name] = {"seconds": elapsed, "rows": rows}
+            print("collect {:10}: {:6.2f} s, {} rows".format(name, elapsed,
+                    rows))
+    return results
+
+def synthetic_campaign_documents(documents, campaigns, words=80,
+                changed=0.03, unrelated=0.2, seed=0):
+    """
+    Build emails from campaign templates, each copy with some words
+    changed, mixed with unrelated emails.
+
+    Yield value: (campaign number, or None if unrelated, text)
+    """
+    rand = random.Random(seed)
+    vocabulary = ["w{}".format(num) for num in range(20000)]
+    templates = [[rand.choice(vocabulary) for _ in range(words)]
+            for _ in range(campaigns)]
+    for _ in range(documents):
+        if rand.random() < unrelated:
+            yield (None, " ".join(rand.choice(vocabulary)
+                    for _ in range(words)))
+            continue
+        campaign = rand.randrange(campaigns)
+        text = [word if rand.random() >= changed else rand.choice(vocabulary)
+                for word in templates[campaign]]
+        yield (campaign, " ".join(text))
+
+def bench_similarity(documents=100000, campaigns=1000, checkpoints=(10000,),
+                queries=500):
+    """
+    Time building a SimilarityIndex of documents emails, querying it as it
+    grows, and clustering it into campaigns.
+    """
+    results = {"build": dict(), "query_ms": dict()}
+    campaignOf = dict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        index = SimilarityIndex(os.path.join(tmpdir, "similarity.db"))
+        building = 0.0
+        sizes = sorted(set(checkpoints) | {documents})
+        docs = synthetic_campaign_documents(documents, campaigns)
+        rand = random.Random(1)
+        for size in sizes:
+            start = time.perf_counter()
+            while len(campaignOf) < size:
+                (campaign, text) = next(docs)
+                docID = len(campaignOf) + 1
+                campaignOf[docID] = campaign
+                index.add("Email", docID, text)
+                if docID % 1000 == 0:
+                    index.commit()
+            index.commit()
+            building += time.perf_counter() - start
+            results["build"][size] = size / building
+
+            times = []
+            found = 0
+            for docID in rand.sample(range(1, size + 1), queries):
+                start = time.perf_counter()
+                found += len(index.similar("Email", docID))
+                times.append(time.perf_counter() - start)
+            results["query_ms"][size] = {"p50": _percentile(times, 0.5) * 1000,
+                    "p99": _percentile(times, 0.99) * 1000,
+                    "found": found / queries}
+            print("similarity {:7} docs: build {:6.0f} docs/s, query p50 "
+                    "{:5.2f} ms p99 {:5.2f} ms, {:.1f} similar each".format(
+                    size, results["build"][size],
+                    results["query_ms"][size]["p50"],
+                    results["query_ms"][size]["p99"], found / queries))
+
+        start = time.perf_counter()
+        clusters = index.clusters("Email")
+        elapsed = time.perf_counter() - start
+        index.close()
+
+    clustered = sum(len(cluster) for cluster in clusters)
+    majority = sum(max(sum(1 for docID in cluster if campaignOf[docID] == c)
+                    for c in {campaignOf[docID] for docID in cluster})
+            for cluster in clusters)
+    campaignDocs = sum(1 for c in campaignOf.values() if c is not None)
+    results["clusters"] = {"seconds": elapsed, "clusters": len(clusters),
+            "recall": clustered / campaignDocs, "purity": majority / clustered}
+    print("similarity clustering: {:.1f} s, {} clusters of {} campaigns, "
+            "{:.1%} of campaign emails clustered, {:.1%} pure".format(
+            elapsed, len(clusters), campaigns, clustered / campaignDocs,
+            majority / clustered))
+    return results
+
+BENCHMARKS = {"addurls": bench_add_urls, "imapfetch": bench_imap_fetch,
+        "httppool": bench_http_pool, "plaintext": bench_plaintext_urls,
+        "jsurls": bench_js_urls, "endtoend": bench_end_to_end,
+        "mboximport": bench_mbox_import, "emailpipeline": bench_email_pipeline,
+        "similarity": bench_similarity, "collect": bench_collect}
+
+def _jsonable(results):
+    """Results with every dict key made a string, for json"""
+    if isinstance(results, dict):
+        return {(key if isinstance(key, str) else
+                        "/".join(map(str, key)) if isinstance(key, tuple)
+                        else str(key)): _jsonable(value)
+                for (key, value) in results.items()}
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Malmail benchmarks.")
+    parser.add_argument("benchmark", nargs="*",
+                    help="The benchmarks to run, from: {}.  Default: all of "
+                    "them.".format(", ".join(sorted(BENCHMARKS))))
+    parser.add_argument("--json", metavar="FILE",
+                    help="Also write every benchmark's results to FILE as "
+                    "JSON")
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark: {}".format(name))
+
+    results = dict()
+    for name in args.benchmark or sorted(BENCHMARKS):
+        results[name] = BENCHMARKS[name]()
+
+    if args.json:
+        with open(args.json, "w") as jsonFile:
+            json.dump(_jsonable(results), jsonFile, indent=2)
+
+if __name__ == "__main__":
+    main()
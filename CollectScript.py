@@ -3,12 +3,67 @@
 Run a round of data importing and processing
 """
 
+import argparse
+import contextlib
+
+import AsyncPipeline
 import HighLevelFunctionality as hlf
+import Metrics
 from EmailAcctData import server_details
+try:
+    from EmailAcctData import accounts
+except ImportError:     # Written by Setup.py before it asked for several
+    accounts = [server_details]
+from ResponseCache import ResponseCache, DEFAULT_CACHE_PATH
+from SimilarityIndex import SimilarityIndex, DEFAULT_INDEX_PATH
 
 ONLY_UNSEEN = True
+INCREMENTAL = True # Retrieve only mail newer than the last run, seen or not
+PARSE_WORKERS = None # Processes parsing email, None for one per core, 0 inline
+RESPONSE_CACHE_PATH = DEFAULT_CACHE_PATH # None disables the response cache
+SIMILARITY_INDEX_PATH = DEFAULT_INDEX_PATH # None disables similarity indexing
+
+def main():
+    parser = argparse.ArgumentParser(
+                    description="Run a round of data importing and processing.")
+    parser.add_argument("-m", "--metrics", metavar="FILE",
+                    help="Time each stage of the run, and write a summary to "
+                    "FILE as JSON lines.")
+    parser.add_argument("-i", "--metrics-interval", metavar="SECONDS",
+                    type=float, help="Also write a metrics snapshot to FILE "
+                    "this often.")
+    parser.add_argument("-p", "--pipeline", action="store_true",
+                    help="Crawl URLs while email is still being retrieved, "
+                    "rather than after.  Always done when accounts lists "
+                    "more than one mailbox.")
+    args = parser.parse_args()
+    if args.metrics_interval and not args.metrics:
+        parser.error("--metrics-interval requires --metrics")
+
+    if args.metrics:
+        Metrics.enable()
+        metrics = Metrics.SnapshotWriter(args.metrics, args.metrics_interval)
+    else:
+        metrics = contextlib.ExitStack()    # Does nothing
+
+    cache = (None if RESPONSE_CACHE_PATH is None
+            else ResponseCache(RESPONSE_CACHE_PATH))
+    index = (None if SIMILARITY_INDEX_PATH is None
+            else SimilarityIndex(SIMILARITY_INDEX_PATH))
+    mailboxes = AsyncPipeline.mailbox_options(accounts)
+    with metrics:
+        if args.pipeline or len(mailboxes) > 1:
+            AsyncPipeline.collect(mailboxes, ONLY_UNSEEN, INCREMENTAL,
+                    PARSE_WORKERS, 1, cache=cache, similarity_index=index)
+        else:
+            mailbox = dict(mailboxes[0])
+            mailbox.pop("maxConnections", None)
+            hlf.retrieve_emails_into_database(mailbox,
+                    ONLY_UNSEEN, parse_workers=PARSE_WORKERS,
+                    incremental=INCREMENTAL, similarity_index=index)
+            hlf.retrieve_urls_into_database(1, cache=cache,
+                    similarity_index=index)
+    hlf.print_summary()
 
 if __name__ == "__main__":
-    hlf.retrieve_emails_into_database(server_details.copy(), ONLY_UNSEEN)
-    hlf.retrieve_urls_into_database(1)
-    hlf.print_database()
+    main()
@@ -2,9 +2,62 @@
 Common functionality potentially required by every module
 """
 
+import collections
 import sys
+import threading
+
+_printLock = threading.Lock()
 
 def print_error(*args):
-    """Print an error nicely."""
-    print(*args, file=sys.stderr)#, flush=True)
-    sys.stderr.flush()
+    """Print an error nicely, even from several threads at once."""
+    with _printLock:
+        print(*args, file=sys.stderr)#, flush=True)
+        sys.stderr.flush()
+
+class BoundedCache():
+    """
+    A dictionary-like cache that evicts its least recently used entries once
+    it holds more than maxSize of them.
+
+    :param int maxSize:
+        The most entries to keep.  0 disables the cache entirely.
+    """
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self._data = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it recently used."""
+        try:
+            value = self._data[key]
+        except KeyError:
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Store value for key, evicting old entries if required."""
+        if self.maxSize <= 0:
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxSize:
+            self._data.popitem(last=False)
+
+    def update(self, mapping):
+        """Store every key, value pair in mapping."""
+        for (key, value) in mapping.items():
+            self.put(key, value)
+
+    def discard(self, key):
+        """Remove key if present."""
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
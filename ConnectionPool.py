@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+A thread-safe pool of keep-alive HTTP(S) connections.
+
+urllib opens a new connection, and for HTTPS does a new TLS handshake, for
+every request.  ConnectionPool keeps finished connections open per
+(scheme, host, port) and reuses them, and otherwise behaves like
+urllib.request.urlopen: it follows redirects, and raises HTTPError and
+URLError the same way.  Proxy settings are not consulted.
+
+Intended use:
+    with pool.urlopen(request, timeout=2) as response:
+        ContentHandlers.WebData(response, request)
+"""
+
+import contextlib
+import http.client
+import socket
+import ssl
+import threading
+import time
+import unittest
+import urllib.error as urlErr
+import urllib.parse as urlParse
+import urllib.request as urlReq
+
+DEFAULT_MAX_IDLE_PER_HOST = 4
+DEFAULT_IDLE_TIMEOUT = 30.0
+DEFAULT_MAX_REDIRECTS = 5
+DRAIN_LIMIT = 64 * 1024
+
+_redirectCodes = (301, 302, 303, 307, 308)
+_defaultPorts = {"http": 80, "https": 443}
+
+class ConnectionPool():
+    """
+    :param int maxIdlePerHost: the most idle connections kept per host
+    :param float idleTimeout: seconds an idle connection is kept
+    :param int maxRedirects: the most redirects followed for one request
+    """
+    def __init__(self, maxIdlePerHost=DEFAULT_MAX_IDLE_PER_HOST,
+                    idleTimeout=DEFAULT_IDLE_TIMEOUT,
+                    maxRedirects=DEFAULT_MAX_REDIRECTS, clock=time.monotonic):
+        self.maxIdlePerHost = maxIdlePerHost
+        self.idleTimeout = idleTimeout
+        self.maxRedirects = maxRedirects
+        self.clock = clock
+        self.sslContext = ssl.create_default_context()
+        self._lock = threading.Lock()
+        self._idle = dict()     # (scheme, host, port): [(conn, idleSince), ...]
+        self.connectionsOpened = 0
+
+    @contextlib.contextmanager
+    def urlopen(self, request, timeout=None):
+        """
+        Send a urllib.request.Request, following redirects.
+
+        Yield value: an http.client.HTTPResponse, or for schemes other than
+                http and https, whatever urllib.request.urlopen returns
+        """
+        url = request.full_url
+        scheme = urlParse.urlsplit(url).scheme.lower()
+        if scheme not in _defaultPorts:
+            with urlReq.urlopen(request, timeout=timeout) as response:
+                yield response
+            return
+
+        method = request.get_method()
+        body = request.data
+        for _ in range(self.maxRedirects + 1):
+            (key, conn, response) = self._send(url, method, body,
+                            request.header_items(), timeout)
+            location = response.getheader("Location")
+            if response.status not in _redirectCodes or not location:
+                break
+            self._release(key, conn, response, drain=True)
+            url = urlParse.urljoin(url, location)
+            if urlParse.urlsplit(url).scheme.lower() not in _defaultPorts:
+                raise urlErr.HTTPError(url, response.status,
+                                "{} - Redirection to url '{}' is not allowed"
+                                .format(response.reason, url),
+                                response.headers, None)
+            if (response.status in (301, 302, 303) and
+                            method not in ("GET", "HEAD")):
+                (method, body) = ("GET", None)
+        else:
+            self._release(key, conn, response, drain=True)
+            raise urlErr.HTTPError(url, response.status,
+                            "Too many redirects", response.headers, None)
+
+        if not 200 <= response.status < 300:
+            self._release(key, conn, response, drain=True)
+            raise urlErr.HTTPError(url, response.status, response.reason,
+                            response.headers, None)
+
+        try:
+            yield response
+        finally:
+            self._release(key, conn, response)
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, dict()
+        for connections in idle.values():
+            for (conn, _) in connections:
+                conn.close()
+
+    def _send(self, url, method, body, headers, timeout):
+        """Send one request, retrying once if a reused connection had died.
+
+                Return value: (pool key, connection, response)
+                """
+        parts = urlParse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        key = (scheme, (parts.hostname or "").lower(),
+                        parts.port or _defaultPorts[scheme])
+        selector = urlParse.urlunsplit(("", "", parts.path or "/",
+                        parts.query, ""))
+        headers = dict(headers)
+        headers.setdefault("Host", parts.netloc)
+
+        while True:
+            (conn, reused) = self._acquire(key, timeout)
+            try:
+                conn.request(method, selector, body, headers)
+                return (key, conn, conn.getresponse())
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                            BrokenPipeError) as err:
+                conn.close()
+                if not reused:
+                    raise urlErr.URLError(err) from err
+            except (OSError, http.client.HTTPException) as err:
+                conn.close()
+                raise urlErr.URLError(err) from err
+
+    def _acquire(self, key, timeout):
+        """Return (connection, True if it was reused) for key"""
+        now = self.clock()
+        with self._lock:
+            connections = self._idle.get(key, [])
+            while connections:
+                (conn, idleSince) = connections.pop()
+                if now - idleSince <= self.idleTimeout:
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    conn.timeout = timeout
+                    return (conn, True)
+                conn.close()
+            self.connectionsOpened += 1
+
+        (scheme, host, port) = key
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout,
+                            context=self.sslContext)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        return (conn, False)
+
+    def _release(self, key, conn, response, drain=False):
+        """Return conn to the pool if its response was read in full."""
+        if drain and not response.isclosed():
+            try:    # Small error and redirect bodies are worth skipping past
+                response.read(DRAIN_LIMIT)
+            except (OSError, http.client.HTTPException):
+                pass
+        if not response.isclosed() or response.will_close:
+            conn.close()
+            return
+
+        now = self.clock()
+        with self._lock:
+            connections = []
+            for (idleConn, idleSince) in self._idle.get(key, []):
+                if now - idleSince <= self.idleTimeout:
+                    connections.append((idleConn, idleSince))
+                else:
+                    idleConn.close()
+            connections.append((conn, now))
+            while len(connections) > self.maxIdlePerHost:
+                connections.pop(0)[0].close()
+            self._idle[key] = connections
+
+
+
+
+
+class ConnectionPoolTester(unittest.TestCase):
+    def setUp(self):
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+
+    def fetch(self, url, size=None):
+        with self.pool.urlopen(urlReq.Request(url), timeout=5) as response:
+            return response.read(size)
+
+    def test_followsRedirects(self):
+        from StandInServers import StandInHTTPServer
+        pages = {"/a": (302, {"Location": "/b"}, b"moved"),
+                "/b": (301, {"Location": "/c"}, b""), "/c": b"<p>c</p>",
+                "/loop": (302, {"Location": "/loop"}, b""),
+                "/ftp": (302, {"Location": "ftp://a.example/file"}, b"")}
+        with StandInHTTPServer(pages) as server:
+            self.assertEqual(self.fetch(server.url("/a")), b"<p>c</p>")
+            self.assertEqual(server.requestCount, 3)
+            # Redirect bodies are drained, so one connection does it all
+            self.assertEqual(self.pool.connectionsOpened, 1)
+
+            with self.assertRaises(urlErr.HTTPError) as caught:
+                self.fetch(server.url("/loop"))
+            self.assertEqual(caught.exception.code, 302)
+            self.assertEqual(server.requestCount,
+                            3 + self.pool.maxRedirects + 1)
+            # urllib doesn't follow redirects away from http either
+            with self.assertRaises(urlErr.HTTPError) as caught:
+                self.fetch(server.url("/ftp"))
+            self.assertEqual(caught.exception.code, 302)
+            self.assertEqual(caught.exception.url, "ftp://a.example/file")
+            with self.assertRaises(urlErr.HTTPError) as caught:
+                self.fetch(server.url("/missing"))
+            self.assertEqual(caught.exception.code, 404)
+            self.assertEqual(self.pool.connectionsOpened, 1)
+
+    def test_retriesDeadReusedConnection(self):
+        from StandInServers import StandInHTTPServer
+        with StandInHTTPServer({"/": b"hi"}) as server:
+            self.fetch(server.url())
+            # Drop the idle connection, as a server that timed it out would
+            [(conn, _)] = self.pool._idle[("http", "127.0.0.1", server.port)]
+            conn.sock.shutdown(socket.SHUT_RDWR)
+            self.assertEqual(self.fetch(server.url()), b"hi")
+            self.assertEqual(self.pool.connectionsOpened, 2)
+            self.assertEqual(server.requestCount, 2)
+
+        # A new connection that fails isn't retried
+        self.pool.close()
+        self.assertRaises(urlErr.URLError, self.fetch, server.url())
+        self.assertEqual(self.pool.connectionsOpened, 3)
+
+    def test_closesUnfinishedConnections(self):
+        from StandInServers import StandInHTTPServer
+        pages = {"/": b"hi", "/big": b"x" * (DRAIN_LIMIT * 2)}
+        with StandInHTTPServer(pages) as server:
+            self.assertEqual(self.fetch(server.url("/big"), 10), b"x" * 10)
+            self.assertEqual(self.pool._idle, dict())
+            self.fetch(server.url())
+            self.fetch(server.url())
+            self.assertEqual(self.pool.connectionsOpened, 2)
+            self.assertEqual(server.connectionCount, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
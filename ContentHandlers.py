@@ -2,14 +2,45 @@
 
 """This module knows how to get URLs and content out of many things."""
 
+import binascii
+import codecs
 import email
+import hashlib
+import io
 import itertools as it
 import html.parser as htp
+import re
 import unittest
 import urllib.request as urlReq
 import urllib.parse as urlParse
 
 import DatabaseOperations
+import JSURLScanner
+import Metrics
+
+DEFAULT_MAX_BODY_SIZE = 10 * 1024 * 1024
+LOGGED_BODY_SIZE = 64 * 1024
+READ_CHUNK_SIZE = 64 * 1024
+# Content types whose bodies are searched for URLs, rather than only logged
+PARSED_CONTENT_TYPES = {"text/html", "text/plain", "application/javascript",
+        "text/javascript", "application/x-javascript"}
+
+_charsetRE = re.compile(rb"""<meta[^>]+charset=["']?([\w.:-]+)""", re.I)
+
+def _sniffEncoding(data):
+    """Guess the encoding of data from a byte order mark or a meta tag.
+
+            data: the first bytes of a document
+
+            Return value: an encoding name, or None
+            """
+    for (bom, encoding) in ((codecs.BOM_UTF8, "utf-8-sig"),
+                    (codecs.BOM_UTF16_LE, "utf-16"),
+                    (codecs.BOM_UTF16_BE, "utf-16")):
+        if data.startswith(bom):
+            return encoding
+    match = _charsetRE.search(data)
+    return match.group(1).decode("ascii") if match else None
 
 class EqualityWithToTuple():
     """Superclass for objects that need equality other than "id()".
@@ -50,9 +81,13 @@ class RetrievedData(EqualityWithToTuple):
 
     def extractURLs(self):
         def _absolutizeURL(url):
+            if isinstance(url, bytes): # From undecoded, single part emails
+                url = url.decode("utf-8", "replace")
             return url if (self.url is None) else urlParse.urljoin(self.url, url)
         # The data knows how to extract its own URLs
-        return [_absolutizeURL(url) for url in self.data.extractURLs()]
+        urls = [_absolutizeURL(url) for url in self.data.extractURLs()]
+        Metrics.count("RetrievedData.urlsExtracted", len(urls))
+        return urls
 
     @property
     def content(self):
@@ -61,29 +96,63 @@ class RetrievedData(EqualityWithToTuple):
 
 class WebData(RetrievedData):
     """Represents data retrieved from a urllib.Request"""
-    def __init__(self, obj, req):
+    @Metrics.timed("WebData")
+    def __init__(self, obj, req, maxBodySize=DEFAULT_MAX_BODY_SIZE):
         """
                 obj: an HTTPResponse object
                 req: a urllib.request.Request object
+                maxBodySize: the most bytes of the body to read.  Bodies of
+                        types we only log are cut at LOGGED_BODY_SIZE.
+
+                The body is read and decoded a chunk at a time.  HTML is fed to
+                the URL extractor as it's decoded, so the raw bytes are never
+                held alongside the text.
                 """
         contentTypeHeader = obj.getheader("Content-Type")
-        refreshHeader = obj.getheader("Refresh")
-        data = obj.read()
         defaultEncoding = "ISO-8859-1"
 
         try:    # Extract content type and encoding
-            contentType = contentTypeHeader.partition(";")[0]
+            contentType = contentTypeHeader.partition(";")[0].strip().lower()
             encoding = contentTypeHeader.partition("charset=")[2]
+            encoding = encoding.partition(";")[0].strip().strip("\"'")
         except AttributeError:
             contentType = None
-            encoding = defaultEncoding
+            encoding = ""
 
-        try:    # Decode data
-            decodedData = data.decode(encoding)
-        except LookupError:
-            decodedData = data.decode(defaultEncoding)
+        maxBodySize = bodySizeLimit(contentType, maxBodySize)
 
-        super().__init__(decodedData, contentType, req.full_url)
+        firstChunk = obj.read(min(READ_CHUNK_SIZE, maxBodySize))
+        encoding = encoding or _sniffEncoding(firstChunk) or defaultEncoding
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+        except LookupError:
+            decoder = codecs.getincrementaldecoder(defaultEncoding)()
+
+        extractor = _URLExtractor() if contentType == "text/html" else None
+        decodedParts = []
+        def _consume(text):
+            decodedParts.append(text)
+            if extractor is not None:
+                extractor.feed(text)
+
+        chunk = firstChunk
+        remaining = maxBodySize - len(chunk)
+        while chunk:
+            _consume(decoder.decode(chunk))
+            if remaining <= 0:
+                break
+            chunk = obj.read(min(READ_CHUNK_SIZE, remaining))
+            remaining -= len(chunk)
+        _consume(decoder.decode(b"", final=True))
+        self.truncated = remaining <= 0 and bool(obj.read(1))
+        if self.truncated:
+            Metrics.count("WebData.truncated")
+
+        super().__init__("".join(decodedParts), contentType, req.full_url)
+        decodedParts = None
+        if extractor is not None:
+            extractor.close()
+            self.data.urlList = extractor.urlList
         # The data knows how
         self.toDatabaseClass = self.data.toDatabaseClass
 
@@ -96,6 +165,7 @@ class WebData(RetrievedData):
 
 class EmailData(RetrievedData):
     """Represents byte or string data as an email"""
+    @Metrics.timed("EmailData")
     def __init__(self, obj):
         if type(obj) is bytes:
             msg = email.message_from_bytes(obj)
@@ -115,6 +185,40 @@ class EmailData(RetrievedData):
         self.toDatabaseClass = DatabaseOperations.EmailContentToDatabase
 
 
+class ParsedEmailData(EqualityWithToTuple):
+    """
+    The parts of an EmailData that the database needs, already worked out.
+
+    Small and picklable, so emails can be parsed in other processes and
+    handed to one database writer.  Database.addContent accepts it in place
+    of EmailData.
+    """
+    def __init__(self, fromAddress, toAddress, fromFriend, content, urlList):
+        self.fromAddress = fromAddress
+        self.toAddress = toAddress
+        self.fromFriend = fromFriend
+        self.content = content
+        self.urlList = urlList
+        self.toDatabaseClass = DatabaseOperations.EmailContentToDatabase
+
+    @classmethod
+    def fromEmailData(cls, emailData):
+        """Work out everything the database needs from an EmailData"""
+        def _header(value):
+            return None if value is None else str(value)
+        return cls(_header(emailData.fromAddress),
+                        _header(emailData.toAddress), emailData.fromFriend,
+                        emailData.content, emailData.extractURLs())
+
+    def _toTuple(self):
+        return (self.fromAddress, self.toAddress, self.fromFriend,
+                        self.content, tuple(self.urlList))
+
+    def body(self): return self.content
+
+    def extractURLs(self): return list(self.urlList)
+
+
 
 class Content(EqualityWithToTuple):
     def __init__(self, data):
@@ -126,7 +230,7 @@ class Content(EqualityWithToTuple):
         return (self.data)
 
     def extractURLs(self):
-        """Return a list of URLs contained in the data"""
+        """Return an iterable of the URLs contained in the data"""
         raise NotImplementedError("Called extractURLs on superclass Content")
 
     def body(self):
@@ -137,30 +241,48 @@ class Content(EqualityWithToTuple):
                 """
         return self.data
 
-class PlainTextContent(Content):
-    def extractURLs(self):
-        # Eliminate some characters, like newlines, that typically break
-        # URLs in plain text messages
-        toReplaceChars = "\n\r"
-        if isinstance(self.data, bytes):
-            replaced = self.data.translate(None, bytes(toReplaceChars, "ascii"))
+def _compileURLPatterns(pattern, lineBreak, trailing):
+    """Compile str and bytes versions of the URL scanning expressions"""
+    return {str: (re.compile(pattern), re.compile(lineBreak), trailing, "()"),
+            bytes: (re.compile(pattern.encode("ascii")),
+                    re.compile(lineBreak.encode("ascii")),
+                    trailing.encode("ascii"), b"()")}
+
+# A URL runs until whitespace or a delimiter.  It only continues across a
+# line break while still in its host, when the next line carries the host
+# on (".com" after "www.example"); anything else on the next line is words.
+# Quoted-printable soft breaks are gone by now, EmailData decodes them.
+_lineBreak = r"(?:\r\n|\r|\n)"
+_hostChar = r"""[^\s<>"'`/?#]"""
+_urlPatterns = _compileURLPatterns(
+        r"(?i:https?://){h}+(?:{br}(?=\.[A-Za-z0-9]){h}+)*"
+        r"""(?:[/?#][^\s<>"'`]*)?""".format(br=_lineBreak, h=_hostChar),
+        _lineBreak, ".,;:!?")
+
+def _trimURL(url, trailing, parens):
+    """Drop sentence punctuation, and a ")" closing text around the URL"""
+    (opening, closing) = (parens[:1], parens[1:])
+    while True:
+        url = url.rstrip(trailing)
+        if (url.endswith(closing) and
+                url.count(closing) > url.count(opening)):
+            url = url[:-1]
         else:
-            replaced = self.data.translate("".maketrans("", "", toReplaceChars))
-
-        # Find likely URLs in the result
-        urlList = []
-        urlPrefixes = ("http://", "https://")
-
-        #TODO: make this better.  Right now, this can't detect links that are not preceeded by a space.  If they're preceeded by a linespace, then other data, the linespace doesn't get replaced with a space, so then the url isn't detected...
-
-        if isinstance(replaced, bytes):
-            urlPrefixes = tuple(bytes(pref, "ascii") for pref in urlPrefixes)
+            return url
 
-        for token in replaced.split():
-            if token.startswith(urlPrefixes):
-                urlList.append(token)
+class PlainTextContent(Content):
+    @Metrics.timed()
+    def extractURLs(self):
+        """Yield the URLs in the text, scanning it once.
 
-        return urlList
+                Works on bytes or str data, yielding the same type, and
+                rejoins host names that were wrapped across lines.
+                """
+        (urlRE, lineBreakRE, trailing, parens) = _urlPatterns[type(self.data)]
+        empty = self.data[:0]
+        for match in urlRE.finditer(self.data):
+            yield _trimURL(lineBreakRE.sub(empty, match.group()), trailing,
+                    parens)
 
     def body(self):
         if isinstance(self.data, bytes):
@@ -168,28 +290,36 @@ class PlainTextContent(Content):
         else:
             return self.data
 
+class _URLExtractor(htp.HTMLParser):
+    """Collects the URLs in tag attributes as HTML is fed in."""
+    attrsContainingURLs = ["src", "href"]
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.urlList = []
+
+    def handle_starttag(self, tag, attrs):
+        for (attrName, attrValue) in attrs:
+            if attrName.lower() in self.attrsContainingURLs:
+                self.urlList.append(attrValue)
+
 class HTMLContent(Content):
-    def __init__(self, data):
+    def __init__(self, data, urlList=None):
+        """
+                urlList: the URLs in data, if they were found while it was read
+                """
         super().__init__(data)
+        self.urlList = urlList
         self.toDatabaseClass = DatabaseOperations.HTMLContentToDatabase
 
+    @Metrics.timed()
     def extractURLs(self):
-        class URLExtractor(htp.HTMLParser):
-            attrsContainingURLs = ["src", "href"]
-            def __init__(self, *args, **kwargs):
-                super().__init__(*args, **kwargs)
-                self.urlList = []
-
-            def handle_starttag(self, tag, attrs):
-                for (attrName, attrValue) in attrs:
-                    if attrName.lower() in self.attrsContainingURLs:
-                        self.urlList.append(attrValue)
-
-        parser = URLExtractor()
-        parser.feed(self.data)
-        parser.close()
+        if self.urlList is None:
+            parser = _URLExtractor()
+            parser.feed(self.data)
+            parser.close()
+            self.urlList = parser.urlList
         # TODO: I get some weird URLs sometimes, without http://.  Why?  These mess up the URL retriever
-        return parser.urlList
+        return list(self.urlList)
 
 
 class JSContent(Content):
@@ -197,50 +327,139 @@ class JSContent(Content):
         super().__init__(data)
         self.toDatabaseClass = DatabaseOperations.JSContentToDatabase
 
+    @Metrics.timed()
     def extractURLs(self):
-        #TODO
-        return []
-
+        """Return the URLs the script is likely to visit.
 
-class MultipartEmailContent(Content):
+                The scan is linear and has a time and size budget, see
+                JSURLScanner.
+                """
+        script = self.data
+        if isinstance(script, bytes):
+            script = script.decode("utf-8", "replace")
+        return JSURLScanner.extractURLs(script)
+
+
+# Email parts with these types are text, whatever their disposition
+_TEXT_PART_TYPES = {"application/javascript", "application/x-javascript"}
+ATTACHMENT_DIGEST_CHUNK = 64 * 1024
+
+def _isAttachment(part):
+    """True for leaf email parts holding binary data rather than text"""
+    return (part.get_content_maintype() != "text" and
+                    part.get_content_type() not in _TEXT_PART_TYPES)
+
+def _decodeText(part):
+    """Decode a text email part into a string, whatever its charset says"""
+    defaultEncoding = "ISO-8859-1"
+    payload = part.get_payload(decode=True) or b""
+    try:
+        return payload.decode(part.get_content_charset() or defaultEncoding,
+                        "replace")
+    except LookupError:
+        return payload.decode(defaultEncoding, "replace")
+
+class AttachmentContent(Content):
+    """A binary email part.  It's only decoded when something asks."""
     def __init__(self, data):
-        super().__init__(data="")
-
-        # Retrieve the data parts
-        max_iteration_depth = 3
-        dataParts = []
-        partsToSearch = [data]
-        for iteration in range(max_iteration_depth):
-            multiParts = (part.is_multipart() for part in partsToSearch)
-            singleParts = (not part.is_multipart() for part in partsToSearch)
-            dataParts += list(it.compress(partsToSearch, singleParts))
-            partsToSearch = list(it.chain.from_iterable(part.get_payload()
-                            for part in it.compress(partsToSearch, multiParts)))
-        partsToSearch = [] # Allow garbage collection on any leftovers...
-
-        # Helper function to decode a part into a string
-        defaultEncoding = "ISO-8859-1"
-        def _returnStringPayload(part):
-            payload = part.get_payload(decode=True)
+        """
+                data: the email.message.Message of the part
+                """
+        super().__init__(data)
+
+    def _chunks(self):
+        """Yield the decoded payload a piece at a time"""
+        encoding = self.data.get("Content-Transfer-Encoding", "").lower()
+        if encoding.strip() != "base64":
+            yield self.data.get_payload(decode=True) or b""
+            return
+        raw = self.data.get_payload()
+        pending = ""
+        for match in re.finditer(r"[A-Za-z0-9+/=]+", raw):
+            pending += match.group()
+            if len(pending) >= ATTACHMENT_DIGEST_CHUNK:
+                usable = len(pending) - len(pending) % 4
+                yield binascii.a2b_base64(pending[:usable])
+                pending = pending[usable:]
+        if pending:
             try:
-                decodedPayload = payload.decode(part.get_content_charset())
-            except LookupError:
-                decodedPayload = payload.decode(defaultEncoding)
-            return decodedPayload
+                yield binascii.a2b_base64(pending)
+            except binascii.Error:  # Truncated, as get_payload would allow
+                pass
 
-        # Store data parts as data of the appropriate type
-        dataClasses = (selContentClass(p.get_content_type()) for p in dataParts)
-        dataAsString = [_returnStringPayload(p) for p in dataParts]
-        self.data = [dataClass(strData)
-                        for (dataClass, strData) in zip(dataClasses, dataAsString)]
+    def digest(self):
+        """Return (size in bytes, sha256 hex digest) of the decoded payload.
+
+                The payload is streamed through the hasher, never held whole.
+                """
+        hasher = hashlib.sha256()
+        size = 0
+        for chunk in self._chunks():
+            hasher.update(chunk)
+            size += len(chunk)
+        return (size, hasher.hexdigest())
+
+    @Metrics.timed()
+    def extractURLs(self):
+        """Return the URLs in the attachment, read as plain text"""
+        return PlainTextContent(b"".join(self._chunks())).extractURLs()
+
+    def body(self):
+        """Summarize the attachment rather than include its bytes"""
+        (size, digest) = self.digest()
+        return "[attachment {} {}, {} bytes, sha256 {}]".format(
+                        self.data.get_filename() or "(unnamed)",
+                        self.data.get_content_type(), size, digest)
+
+
+class MultipartEmailContent(Content):
+    def __init__(self, data, scanAttachments=False):
+        """
+                data: an email.message.Message
+                scanAttachments: search binary attachments for URLs too
+
+                No part is decoded until body or extractURLs reaches it, and
+                none is decoded twice.
+                """
+        super().__init__(data)
+        self.scanAttachments = scanAttachments
+        self._decoded = []
+        self._undecoded = self._decodeParts()
+
+    @Metrics.timed()
+    def parts(self):
+        """Yield Content for each leaf part, at any depth, decoding each
+                only as it's first reached"""
+        index = 0
+        while True:
+            if index == len(self._decoded):
+                part = next(self._undecoded, None)
+                if part is None:
+                    return
+                self._decoded.append(part)
+            yield self._decoded[index]
+            index += 1
+
+    def _decodeParts(self):
+        """Yield Content for each leaf part, decoding it"""
+        for part in self.data.walk():
+            if part.is_multipart():
+                continue
+            if _isAttachment(part):
+                yield AttachmentContent(part)
+            else:
+                yield selContentClass(part.get_content_type())(
+                                _decodeText(part))
 
     def extractURLs(self):
         """Extract urls for all data parts."""
-        return list(it.chain.from_iterable(
-                part.extractURLs() for part in self.data))
+        return it.chain.from_iterable(part.extractURLs()
+                        for part in self.parts()
+                        if self.scanAttachments or
+                                not isinstance(part, AttachmentContent))
 
     def body(self):
-        return "\n".join(part.body() for part in self.data)
+        return "\n".join(part.body() for part in self.parts())
 
 
 
@@ -254,16 +473,63 @@ def selContentClass(contentType):
     mimeList = {"text/html": HTMLContent,
                     "text/plain": PlainTextContent,
                     "application/javascript": JSContent,
+                    "text/javascript": JSContent,
+                    "application/x-javascript": JSContent,
                     "multipartEmail": MultipartEmailContent}
     return mimeList.get(contentType, PlainTextContent)
 
+def bodySizeLimit(contentType, maxBodySize=DEFAULT_MAX_BODY_SIZE):
+    """The most bytes of a body worth reading.
+
+            contentType: the mime type, or None if the response had none
+            maxBodySize: the limit for types that are searched for urls
+
+            Return value: maxBodySize, or less for types we only log
+            """
+    if contentType is not None and contentType not in PARSED_CONTENT_TYPES:
+        return min(maxBodySize, LOGGED_BODY_SIZE)
+    return maxBodySize
+
+
 
 
 
 
 
+class _FakeResponse(io.BytesIO):
+    """Enough of an HTTPResponse to build WebData from"""
+    def __init__(self, body, headers):
+        super().__init__(body)
+        self.headers = headers
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
 
 class ContentHandlersTester(unittest.TestCase):
+    def test_WebData_streamsHTML(self):
+        body = "<p>caf\u00e9</p>" + "<a href='/next'>x</a>" * 10000
+        response = _FakeResponse(body.encode("utf-8"),
+                {"Content-Type": "text/html; charset=UTF-8"})
+        wd = WebData(response, urlReq.Request("http://example.com/a"),
+                maxBodySize=len(body) * 2)
+        self.assertEqual(wd.body(), body)
+        self.assertFalse(wd.truncated)
+        self.assertEqual(set(wd.extractURLs()), {"http://example.com/next"})
+
+    def test_WebData_capsBody(self):
+        body = b"<meta charset='utf-8'><a href='/a'>\xc3\xa9</a>" + b"x" * 500
+        wd = WebData(_FakeResponse(body, {"Content-Type": "text/html"}),
+                urlReq.Request("http://example.com/"), maxBodySize=100)
+        self.assertTrue(wd.truncated)
+        self.assertEqual(wd.body(), body[:100].decode("utf-8"))
+        self.assertEqual(wd.extractURLs(), ["http://example.com/a"])
+
+        binary = _FakeResponse(b"\0" * (LOGGED_BODY_SIZE * 2),
+                {"Content-Type": "application/octet-stream"})
+        wd = WebData(binary, urlReq.Request("http://example.com/bin"))
+        self.assertTrue(wd.truncated)
+        self.assertEqual(len(wd.body()), LOGGED_BODY_SIZE)
+
     def test_handleHTML_extractURLs(self):
         testURLs= [
                 (
@@ -281,6 +547,76 @@ class ContentHandlersTester(unittest.TestCase):
 
             self.assertEqual(set(linkList), set(wd.extractURLs()))
 
+    def test_PlainTextContent_extractURLs(self):
+        text = ('See <http://a.example/x>, then (https://b.example/y).\r\n'
+                'Wrapped: http://www.example\r\n.com/linesplit here\r\n'
+                'Visit http://c.example/\r\nThanks\r\n'
+                'http://d.example/?token=\r\nRegards\r\n'
+                'http://e.example/path\r\n.Next sentence\r\n'
+                'http://f.example/wiki/A_(b) and http://g.example/end\r\n'
+                '\r\nbye')
+        expected = ["http://a.example/x", "https://b.example/y",
+                "http://www.example.com/linesplit", "http://c.example/",
+                "http://d.example/?token=", "http://e.example/path",
+                "http://f.example/wiki/A_(b)", "http://g.example/end"]
+        self.assertEqual(list(PlainTextContent(text).extractURLs()),
+                expected)
+        self.assertEqual(
+                list(PlainTextContent(text.encode("ascii")).extractURLs()),
+                [url.encode("ascii") for url in expected])
+
+    def test_JSContent_extractURLs(self):
+        script = b"if(x)top.location='http://a.example/'+'go';f('//b.example/');"
+        self.assertEqual(JSContent(script).extractURLs(),
+                ["http://a.example/go", "//b.example/"])
+
+    def test_MultipartEmailContent_lazyParts(self):
+        import email.mime.application, email.mime.multipart, email.mime.text
+        attachment = b"\x00binary http://attached.example/ \xff" * 5000
+        inner = email.mime.multipart.MIMEMultipart()
+        inner.attach(email.mime.text.MIMEText("See http://deep.example/"))
+        inner.attach(email.mime.application.MIMEApplication(attachment,
+                Name="kit.zip"))
+        message = email.mime.multipart.MIMEMultipart()
+        for _ in range(5):  # Deeper than the old three level limit
+            outer = email.mime.multipart.MIMEMultipart()
+            outer.attach(inner)
+            inner = outer
+        message.attach(inner)
+        bare = email.message.Message()   # A text part with no charset
+        bare.set_payload("and http://bare.example/")
+        message.attach(bare)
+
+        content = EmailData(message.as_bytes()).data
+        self.assertEqual(list(content.extractURLs()),
+                ["http://deep.example/", "http://bare.example/"])
+        self.assertIn("[attachment kit.zip application/octet-stream, "
+                "{} bytes, sha256 {}]".format(len(attachment),
+                hashlib.sha256(attachment).hexdigest()), content.body())
+        content.scanAttachments = True
+        self.assertIn(b"http://attached.example/", list(content.extractURLs()))
+
+    def test_MultipartEmailContent_decodesOnce(self):
+        import email.mime.multipart, email.mime.text
+        import unittest.mock
+        message = email.mime.multipart.MIMEMultipart()
+        for num in range(3):
+            message.attach(email.mime.text.MIMEText(
+                    "part {0} http://{0}.example/".format(num)))
+        content = EmailData(message.as_bytes()).data
+        with unittest.mock.patch(__name__ + "._decodeText",
+                wraps=_decodeText) as decode:
+            # Only as far as the first part, then everything, twice
+            self.assertEqual(next(content.extractURLs()),
+                    "http://0.example/")
+            self.assertEqual(decode.call_count, 1)
+            body = content.body()
+            self.assertEqual(list(content.extractURLs()),
+                    ["http://0.example/", "http://1.example/",
+                    "http://2.example/"])
+            self.assertEqual(content.body(), body)
+        self.assertEqual(decode.call_count, 3)
+
     def test_EmailData_extractURLs(self):
         testEmails = [
                 (
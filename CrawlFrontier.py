@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Schedule URL crawling across a pool of workers, politely.
+
+The frontier hands out each URL once, shallowest first, while limiting how
+quickly any one domain is hit.  crawl() drives the frontier with a thread
+pool and hands each result back on the calling thread, so the caller may
+keep using its own database connection.
+"""
+
+import concurrent.futures as futures
+import heapq
+import itertools as it
+import time
+import unittest
+
+from Common import *
+from DatabaseOperations import domain
+
+DEFAULT_WORKERS = 8
+DEFAULT_DOMAIN_RATE = 1.0   # Requests per second to any one domain
+DEFAULT_DOMAIN_BURST = 2    # Requests a quiet domain may receive at once
+
+class TokenBucket():
+    """
+    Rate limits a single domain.
+
+    :param float rate: tokens added per second.  0 disables the limit
+    :param int burst: the most tokens the bucket holds
+    """
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def _refill(self, now):
+        self.tokens = min(self.burst,
+                        self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def readyAt(self, now):
+        """Return the time at which a token will next be available."""
+        self._refill(now)
+        if self.tokens >= 1 or self.rate <= 0:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Spend a token.  Call only once readyAt(now) <= now."""
+        self._refill(now)
+        self.tokens -= 1
+
+
+class CrawlFrontier():
+    """
+    A deduplicating priority queue of URLs keyed by depth, with a token
+    bucket per domain.
+
+    Intended use:
+        frontier.add(url, depth)
+        item = frontier.pop()   # (url, depth), or None if nothing is ready
+    """
+    def __init__(self, domainRate=DEFAULT_DOMAIN_RATE,
+                    domainBurst=DEFAULT_DOMAIN_BURST, clock=time.monotonic):
+        self.domainRate = domainRate
+        self.domainBurst = domainBurst
+        self.clock = clock
+        self._seen = set()
+        self._counter = it.count()
+        self._domainQueues = dict()  # domain: [(depth, seq, url), ...] heap
+        self._buckets = dict()       # domain: TokenBucket
+        self._ready = []             # [(depth, seq, domain), ...] heap
+        self._waiting = []           # [(readyAt, seq, domain), ...] heap
+        self._pending = 0
+
+    def __len__(self):
+        """The number of URLs not yet handed out."""
+        return self._pending
+
+    def add(self, url, depth):
+        """
+        Queue url at depth unless it has been queued before.
+
+        :returns: True if url was queued
+        """
+        if url in self._seen:
+            return False
+        self._seen.add(url)
+
+        dom = domain(url)
+        queue = self._domainQueues.setdefault(dom, [])
+        heapq.heappush(queue, (depth, next(self._counter), url))
+        self._pending += 1
+        if len(queue) == 1:
+            self._schedule(dom, self.clock())
+        return True
+
+    def pop(self):
+        """
+        Hand out the shallowest URL whose domain may be contacted now.
+
+        :returns: (url, depth), or None if nothing is ready yet
+        """
+        now = self.clock()
+        while self._waiting and self._waiting[0][0] <= now:
+            (_, _, dom) = heapq.heappop(self._waiting)
+            self._markReady(dom)
+        if not self._ready:
+            return None
+
+        (_, _, dom) = heapq.heappop(self._ready)
+        (depth, _, url) = heapq.heappop(self._domainQueues[dom])
+        self._pending -= 1
+        self._bucket(dom, now).take(now)
+        if self._domainQueues[dom]:
+            self._schedule(dom, now)
+        else:
+            del self._domainQueues[dom]
+        return (url, depth)
+
+    def nextReadyIn(self):
+        """
+        :returns: seconds until pop() may return a URL, or None if empty
+        """
+        if self._ready:
+            return 0
+        if self._waiting:
+            return max(0, self._waiting[0][0] - self.clock())
+        return None
+
+    def _bucket(self, dom, now):
+        if dom not in self._buckets:
+            self._buckets[dom] = TokenBucket(
+                            self.domainRate, self.domainBurst, now)
+        return self._buckets[dom]
+
+    def _schedule(self, dom, now):
+        readyAt = self._bucket(dom, now).readyAt(now)
+        if readyAt <= now:
+            self._markReady(dom)
+        else:
+            heapq.heappush(self._waiting, (readyAt, next(self._counter), dom))
+
+    def _markReady(self, dom):
+        depth = self._domainQueues[dom][0][0]
+        heapq.heappush(self._ready, (depth, next(self._counter), dom))
+
+
+def crawl(frontier, fetch, handle, workers=DEFAULT_WORKERS,
+                maxInFlight=None, refill=None):
+    """
+    Fetch everything in the frontier with a pool of worker threads.
+
+    :param CrawlFrontier frontier:
+        The URLs to fetch.  handle may add more while the crawl runs.
+    :param callable fetch:
+        fetch(url) runs on a worker thread and returns anything
+    :param callable handle:
+        handle(url, depth, result) runs on the calling thread with fetch's
+        return value, or None if fetch raised
+    :param int workers:
+        The number of fetching threads
+    :param int maxInFlight:
+        OPTIONAL: default - twice workers
+        The most URLs handed to the pool and not yet handled
+    :param callable refill:
+        OPTIONAL: default - None
+        refill() runs on the calling thread whenever the frontier is empty,
+        and may add more URLs to it.  It returns how many it added.  After
+        it adds none it isn't called again until another URL is handled.
+    """
+    maxInFlight = 2 * workers if maxInFlight is None else maxInFlight
+    inFlight = dict()
+    mayRefill = refill is not None
+
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            if mayRefill and not len(frontier):
+                mayRefill = bool(refill())
+            while len(inFlight) < maxInFlight:
+                item = frontier.pop()
+                if item is None:
+                    break
+                inFlight[executor.submit(fetch, item[0])] = item
+
+            delay = frontier.nextReadyIn()
+            if not inFlight:
+                if delay is None:
+                    return
+                time.sleep(delay)
+                continue
+
+            (done, _) = futures.wait(inFlight, timeout=delay,
+                            return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                (url, depth) = inFlight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as err:
+                    print_error("Error fetching URL:", url, "Exception:", err)
+                    result = None
+                handle(url, depth, result)
+                mayRefill = refill is not None
+
+
+
+
+class CrawlFrontierTester(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.frontier = CrawlFrontier(domainRate=1.0, domainBurst=1,
+                        clock=lambda: self.now)
+
+    def test_deduplicates(self):
+        self.assertTrue(self.frontier.add("http://a.com/1", 0))
+        self.assertFalse(self.frontier.add("http://a.com/1", 1))
+        self.assertEqual(len(self.frontier), 1)
+
+    def test_shallowestFirst(self):
+        self.frontier.add("http://a.com/deep", 2)
+        self.frontier.add("http://b.com/shallow", 0)
+        self.assertEqual(self.frontier.pop(), ("http://b.com/shallow", 0))
+        self.assertEqual(self.frontier.pop(), ("http://a.com/deep", 2))
+        self.assertIsNone(self.frontier.nextReadyIn())
+
+    def test_domainRateLimit(self):
+        self.frontier.add("http://a.com/1", 0)
+        self.frontier.add("http://a.com/2", 0)
+        self.frontier.add("http://b.com/1", 1)
+        popped = [self.frontier.pop(), self.frontier.pop()]
+        self.assertEqual([url for (url, _) in popped],
+                        ["http://a.com/1", "http://b.com/1"])
+        self.assertIsNone(self.frontier.pop())
+        self.assertAlmostEqual(self.frontier.nextReadyIn(), 1.0)
+
+        self.now = 1.0
+        self.assertEqual(self.frontier.pop(), ("http://a.com/2", 0))
+
+    def test_crawlAddsDiscoveredURLs(self):
+        frontier = CrawlFrontier(domainRate=0, domainBurst=100)
+        frontier.add("http://a.com/", 0)
+        handled = []
+        def _handle(url, depth, result):
+            handled.append((url, depth, result))
+            if depth == 0:
+                frontier.add("http://a.com/next", 1)
+        crawl(frontier, len, _handle, workers=2)
+        self.assertEqual(sorted(handled), [("http://a.com/", 0, 13),
+                        ("http://a.com/next", 1, 17)])
+
+    def test_crawlRefills(self):
+        frontier = CrawlFrontier(domainRate=0, domainBurst=100)
+        batches = [["http://a.com/1", "http://b.com/1"], [], ["http://a.com/2"]]
+        def _refill():
+            batch = batches.pop(0) if batches else []
+            for url in batch:
+                frontier.add(url, 0)
+            return len(batch)
+        handled = []
+        crawl(frontier, len, lambda url, depth, result: handled.append(url),
+                workers=1, refill=_refill)
+        self.assertEqual(sorted(handled),
+                ["http://a.com/1", "http://a.com/2", "http://b.com/1"])
+        self.assertEqual(batches, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,29 @@
 #!/usr/bin/env python3
 """
-Script creates all missing tables in the database.
+Script creates all missing tables in the database, and brings tables made
+by older versions up to date.
 """
 
-from DatabaseModel import database, BASE_CLASS
+import contextlib
+import datetime
+import io
+import os
+import tempfile
+import unittest
+
+from playhouse.migrate import SqliteMigrator, migrate
+
+from DatabaseModel import *
+from DatabaseOperations import domain
+from URLCanonicalizer import defaultCanonicalizer
 
 def create_tables():
     """
-    Creates all the missing tables in the database
+    Creates all the missing tables in the database, then upgrades the tables
+    that were already there to the latest schema version
     """
     database.connect()
+    fresh = not database.get_tables()
 
     subclasses = set([BASE_CLASS])
     len_prev = -1
@@ -23,7 +37,385 @@ def create_tables():
             subc.create_table()
             print("Created {}".format(subc))
 
+    if fresh:
+        set_schema_version(LATEST_VERSION)
+    else:
+        upgrade()
+
     database.close()
 
+def schema_version():
+    """
+    :returns: The version recorded in the database, 0 if there isn't one
+    """
+    row = SchemaVersion.select(SchemaVersion.version).first()
+    return 0 if row is None else row.version
+
+def set_schema_version(version):
+    """Record version as the database's schema version"""
+    if SchemaVersion.update(version=version).execute() == 0:
+        SchemaVersion.insert(version=version).execute()
+
+def upgrade():
+    """
+    Apply, in order, each migration newer than the database's version.  Each
+    migration runs in its own transaction along with its version update.
+    """
+    current = schema_version()
+    for (version, migration) in MIGRATIONS:
+        if version > current:
+            with database.atomic():
+                migration()
+                set_schema_version(version)
+            print("Upgraded schema to version {}".format(version))
+
+def _add_index(table, columns, unique=False):
+    """Index columns of table unless an index on just them exists."""
+    if any(index.columns == list(columns)
+            for index in database.get_indexes(table)):
+        return
+    migrate(SqliteMigrator(database).add_index(table, columns, unique))
+
+# The tables deduplicated by contentHash, by name as older versions made them
+HASHED_TABLES = (("email", Email), ("html_content", HTML_Content),
+        ("js_content", JS_Content), ("other_content", Other_Content))
+
+def add_content_hashes(batch_size=1000):
+    """
+    Add the contentHash column to tables made before it existed, fill it in
+    for existing rows, and index it.
+
+    When old rows are duplicates of each other only the first gets a hash,
+    the rest keep NULL so the unique index still builds.
+    """
+    migrator = SqliteMigrator(database)
+    for (table, model) in HASHED_TABLES:
+        columns = [col.name for col in database.get_columns(table)]
+        if "contentHash" in columns:
+            continue
+
+        migrate(migrator.add_column(table, "contentHash", model.contentHash))
+        seen = set()
+        last_id = 0
+        fields = [getattr(model, name) for name in model.HASHED_FIELDS]
+        while True:
+            rows = list(model.select(model.id, *fields)
+                    .where(model.id > last_id)
+                    .order_by(model.id).limit(batch_size).dicts())
+            if not rows:
+                break
+            with database.atomic():
+                for row in rows:
+                    digest = content_digest(model, row)
+                    if digest not in seen:
+                        seen.add(digest)
+                        model.update(contentHash=digest).where(
+                                model.id == row["id"]).execute()
+            last_id = rows[-1]["id"]
+
+        _add_index(table, ("contentHash",), True)
+        print("Added contentHash to {} ({} unique)".format(table, len(seen)))
+
+# (table, columns) whose values are unique in everything Malmail writes
+UNIQUE_COLUMNS = (("domain", ("url",)), ("url", ("url",)))
+INDEXED_COLUMNS = (("url", ("processed",)),)
+# (table, columns) of link tables, where repeated rows carry no information
+UNIQUE_LINKS = (("url_to_email", ("email_id", "url_id")),
+        ("url_to_url", ("source_url_id", "contained_url_id", "userAgent")),
+        ("html_to_url", ("content_id", "url_id", "userAgent")),
+        ("js_to_url", ("content_id", "url_id", "userAgent")),
+        ("other_to_url", ("content_id", "url_id", "userAgent")))
+
+def add_indexes():
+    """
+    Index the columns lookups are made on, and make repeated rows impossible.
+
+    Repeated link table rows are deleted first.  Repeated urls can't be
+    merged without rewriting references, so if an old database has any the
+    url index is left non-unique.
+    """
+    for (table, columns) in UNIQUE_COLUMNS:
+        cols = ", ".join('"{}"'.format(col) for col in columns)
+        repeated = database.execute_sql(
+                'SELECT 1 FROM "{0}" GROUP BY {1} HAVING COUNT(*) > 1 LIMIT 1'
+                .format(table, cols)).fetchone()
+        if repeated:
+            print("Repeated {} rows, so their index is not unique".format(
+                    table))
+        _add_index(table, columns, not repeated)
+
+    for (table, columns) in INDEXED_COLUMNS:
+        _add_index(table, columns)
+
+    for (table, columns) in UNIQUE_LINKS:
+        cols = ", ".join('"{}"'.format(col) for col in columns)
+        database.execute_sql(
+                'DELETE FROM "{0}" WHERE id NOT IN '
+                '(SELECT MIN(id) FROM "{0}" GROUP BY {1})'.format(table, cols))
+        _add_index(table, columns, True)
+
+def add_sync_state():
+    """Add the MailboxSyncState table, for incremental IMAP retrieval"""
+    if not MailboxSyncState.table_exists():
+        MailboxSyncState.create_table()
+
+def add_url_originals():
+    """
+    Add URL.original, for the raw form of canonicalized URLs, and
+    canonicalize the URLs already stored
+    """
+    if "original" not in [col.name for col in database.get_columns("url")]:
+        migrate(SqliteMigrator(database).add_column("url", "original",
+                URL.original))
+    canonicalize_urls()
+
+# (table, column) of each reference to a url's id
+URL_REFERENCES = (("url_to_email", "url_id"), ("url_to_url", "source_url_id"),
+        ("url_to_url", "contained_url_id"), ("html_to_url", "url_id"),
+        ("js_to_url", "url_id"), ("other_to_url", "url_id"))
+
+def canonicalize_urls(batch_size=1000):
+    """
+    Rewrite stored urls in their canonical form, as lookups now expect.
+
+    A url whose canonical form is already stored is merged into that row:
+    its references move there, repeats of references already there are
+    dropped, and it's processed if either was.  Urls with no canonical
+    form, which can't be fetched, are marked processed.  Raw SQL is used
+    since columns added by later migrations don't exist yet.
+    """
+    references = list(URL_REFERENCES)
+    if CrawlQueue.table_exists():
+        references.append((table_name(CrawlQueue), "url_id"))
+    (renamed, merged, unfetchable) = (0, 0, 0)
+    last_id = 0
+    while True:
+        rows = database.execute_sql('SELECT id, url, processed, original '
+                'FROM url WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)).fetchall()
+        if not rows:
+            break
+        with database.atomic():
+            for (url_id, url, processed, original) in rows:
+                canonical = defaultCanonicalizer.canonicalize(url)
+                if canonical == url:
+                    continue
+                if canonical is None:
+                    database.execute_sql('UPDATE url SET processed = 1 '
+                            'WHERE id = ?', (url_id,))
+                    unfetchable += 1
+                    continue
+                existing = database.execute_sql('SELECT id FROM url '
+                        'WHERE url = ?', (canonical,)).fetchone()
+                if existing is None:
+                    database.execute_sql('UPDATE url SET url = ?, '
+                            'domain_id = ?, original = ? WHERE id = ?',
+                            (canonical, _domain_id(domain(canonical)),
+                            original or url, url_id))
+                    renamed += 1
+                    continue
+                for (table, column) in references:
+                    database.execute_sql('UPDATE OR IGNORE "{0}" SET "{1}" '
+                            '= ? WHERE "{1}" = ?'.format(table, column),
+                            (existing[0], url_id))
+                    database.execute_sql('DELETE FROM "{0}" WHERE "{1}" = ?'
+                            .format(table, column), (url_id,))
+                if processed:
+                    database.execute_sql('UPDATE url SET processed = 1 '
+                            'WHERE id = ?', (existing[0],))
+                database.execute_sql('DELETE FROM url WHERE id = ?',
+                        (url_id,))
+                merged += 1
+        last_id = rows[-1][0]
+    if renamed or merged or unfetchable:
+        print("Canonicalized urls: {} rewritten, {} merged, {} unfetchable"
+                .format(renamed, merged, unfetchable))
+
+def _domain_id(dom):
+    """The id of the domain dom, inserting it if it's missing"""
+    row = database.execute_sql('SELECT id FROM domain WHERE url = ?',
+            (dom,)).fetchone()
+    if row is not None:
+        return row[0]
+    return database.execute_sql('INSERT INTO domain (url) VALUES (?)',
+            (dom,)).lastrowid
+
+def add_domain_failures():
+    """Add the Domain columns that persist unreachable hosts between runs"""
+    columns = [col.name for col in database.get_columns("domain")]
+    migrator = SqliteMigrator(database)
+    for name in ("failureReason", "failureExpires"):
+        if name not in columns:
+            migrate(migrator.add_column("domain", name,
+                    getattr(Domain, name)))
+
+def add_created_times():
+    """
+    Add and index the created column of every table, for exporting by time.
+    Rows already stored are left without a time.
+    """
+    migrator = SqliteMigrator(database)
+    for model in model_classes():
+        if not model.table_exists():    # Made later, with the column
+            continue
+        table = table_name(model)
+        if "created" not in [col.name for col in database.get_columns(table)]:
+            migrate(migrator.add_column(table, "created", model.created))
+        _add_index(table, ("created",))
+
+def add_crawl_queue():
+    """Add the CrawlQueue table, for resumable crawls"""
+    if not CrawlQueue.table_exists():
+        CrawlQueue.create_table()
+
+# (version, migration function), in the order they must be applied
+MIGRATIONS = ((1, add_content_hashes), (2, add_indexes), (3, add_sync_state),
+        (4, add_url_originals), (5, add_domain_failures),
+        (6, add_created_times), (7, add_crawl_queue))
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+
+
+
+class SchemaMigrationTester(unittest.TestCase):
+    def setUp(self):
+        self.originalPath = database.database
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database.init(os.path.join(self.tmpdir.name, "test.db"))
+        self.quietly(create_tables)
+        database.connect()
+
+    def tearDown(self):
+        database.close()
+        database.init(self.originalPath)
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def quietly(function):
+        with contextlib.redirect_stdout(io.StringIO()):
+            function()
+
+    def queryPlan(self, query):
+        (sql, params) = query.sql()
+        rows = database.execute_sql("EXPLAIN QUERY PLAN " + sql, params)
+        return " ".join(row[-1] for row in rows)
+
+    def assertUsesIndex(self, query):
+        plan = self.queryPlan(query)
+        self.assertIn("USING", plan)
+        self.assertNotRegex(plan, r"\bSCAN\b")
+
+    def test_freshDatabaseIsLatest(self):
+        self.assertEqual(schema_version(), LATEST_VERSION)
+
+    def test_hotQueriesUseIndexes(self):
+        queries = [URL.select().where(URL.url == "http://a.com/"),
+            URL.select().where(URL.url.in_(["http://a.com/", "http://b.com/"])),
+            URL.select().where(URL.processed == False),
+            Domain.select().where(Domain.url == "http://a.com"),
+            Email.select().where(Email.contentHash == "0"),
+            HTML_Content.select().where(HTML_Content.contentHash == "0"),
+            URL_To_Email.select().where(URL_To_Email.email == 1),
+            URL_To_Email.select().where((URL_To_Email.email == 1) &
+                (URL_To_Email.url == 1)),
+            URL_To_URL.select().where(URL_To_URL.contained_url == 1),
+            CrawlQueue.select().where(CrawlQueue.leaseOwner == "0"),
+            CrawlQueue.select().where((CrawlQueue.state == "queued") &
+                (CrawlQueue.depth < 1)),
+            MailboxSyncState.select().where(
+                (MailboxSyncState.account == "a") &
+                (MailboxSyncState.folder == "INBOX")),
+            Email.select().where(Email.created >= datetime.datetime(2000, 1, 1)),
+            URL_To_URL.select().where((URL_To_URL.source_url == 1) &
+                (URL_To_URL.contained_url == 1) &
+                (URL_To_URL.userAgent == "agent"))]
+        for model in (HTML_To_URL, JS_To_URL, Other_To_URL):
+            queries.append(model.select().where(model.url == 1))
+            queries.append(model.select().where((model.content == 1) &
+                (model.url == 1) & (model.userAgent == "agent")))
+        for query in queries:
+            with self.subTest(sql=query.sql()[0]):
+                self.assertUsesIndex(query)
+
+    def test_upgradeOldDatabase(self):
+        for (table, columns) in UNIQUE_COLUMNS + INDEXED_COLUMNS + UNIQUE_LINKS:
+            for index in database.get_indexes(table):
+                if index.columns == list(columns):
+                    database.execute_sql('DROP INDEX "{}"'.format(index.name))
+        SchemaVersion.delete().execute()
+
+        dom = Domain.insert(url="http://a.com").execute()
+        url = URL.insert(domain=dom, url="http://a.com/", processed=False
+                ).execute()
+        email = Email.insert(fromAddress="a", toAddress="b", fromFriend=False,
+                content="c").execute()
+        for _ in range(3):
+            URL_To_Email.insert(email=email, url=url).execute()
+
+        self.quietly(upgrade)
+        self.assertEqual(schema_version(), LATEST_VERSION)
+        self.assertEqual(URL_To_Email.select().count(), 1)
+        self.assertUsesIndex(URL.select().where(URL.processed == False))
+
+    def test_hashOldContent(self):
+        migrator = SqliteMigrator(database)
+        for (table, _) in HASHED_TABLES:
+            for index in database.get_indexes(table):
+                if index.columns == ["contentHash"]:
+                    migrate(migrator.drop_index(table, index.name))
+            migrate(migrator.drop_column(table, "contentHash"))
+        ids = []
+        for content in ("a", "b", "a", "a"):
+            ids.append(database.execute_sql('INSERT INTO email (fromAddress, '
+                    'toAddress, fromFriend, content) VALUES (?, ?, ?, ?)',
+                    ("from", "to", False, content)).lastrowid)
+
+        self.quietly(add_content_hashes)
+        hashes = {email.id: email.contentHash for email in Email.select()}
+        # Only the first of the duplicates is hashed
+        self.assertIsNotNone(hashes[ids[0]])
+        self.assertIsNotNone(hashes[ids[1]])
+        self.assertNotEqual(hashes[ids[0]], hashes[ids[1]])
+        self.assertEqual((hashes[ids[2]], hashes[ids[3]]), (None, None))
+        self.assertEqual(hashes[ids[0]], content_digest(Email,
+                {"fromAddress": "from", "toAddress": "to",
+                "fromFriend": False, "content": "a"}))
+        for (table, _) in HASHED_TABLES:
+            self.assertIn(["contentHash"], [index.columns for index in
+                    database.get_indexes(table) if index.unique])
+
+    def test_canonicalizeOldURLs(self):
+        dom = Domain.insert(url="http://Evil.com").execute()
+        email = Email.insert(fromAddress="a", toAddress="b", fromFriend=False,
+                content="c").execute()
+        ids = dict()
+        for (url, processed) in (("http://evil.com/", False),
+                ("http://Evil.com", True), ("http://EVIL.com:80/a#x", False),
+                ("javascript:void(0)", False)):
+            ids[url] = URL.insert(domain=dom, url=url, processed=processed
+                    ).execute()
+            URL_To_Email.insert(email=email, url=ids[url]).execute()
+        URL_To_URL.insert(source_url=ids["http://EVIL.com:80/a#x"],
+                contained_url=ids["http://Evil.com"], userAgent="a").execute()
+
+        self.quietly(canonicalize_urls)
+        urls = {url.url: url for url in URL.select()}
+        self.assertEqual(sorted(urls), ["http://evil.com/",
+                "http://evil.com/a", "javascript:void(0)"])
+        # Merged into the row already canonical, which keeps its id
+        self.assertEqual(urls["http://evil.com/"].id, ids["http://evil.com/"])
+        self.assertTrue(urls["http://evil.com/"].processed)
+        self.assertEqual(urls["http://evil.com/a"].original,
+                "http://EVIL.com:80/a#x")
+        self.assertEqual(urls["http://evil.com/a"].domain.url,
+                "http://evil.com")
+        self.assertTrue(urls["javascript:void(0)"].processed)
+        self.assertEqual(URL_To_Email.select().count(), 3)
+        link = URL_To_URL.get()
+        self.assertEqual((link.source_url.url, link.contained_url.url),
+                ("http://evil.com/a", "http://evil.com/"))
+
+
 if __name__ == "__main__":
     create_tables()
@@ -1,38 +1,93 @@
 #import cymysql
 #cymysql.install_as_MySQLdb()
 
+import datetime
+import hashlib
+
 import peewee as pw
 
 #TODO: import these settings from elsewhere
 #dbSettings={"database": "malmail", "host": "localhost",
 #                "user": "malmail", "passwd": "malmail"}
 
+# Applied to each new connection.  WAL lets readers run alongside the
+# writer, and with it synchronous=normal only syncs at checkpoints.
+SQLITE_PRAGMAS = (("journal_mode", "wal"), ("synchronous", "normal"),
+        ("cache_size", -64000), ("temp_store", "memory"))
+
 #database = pw.MySQLDatabase(**dbSettings)
-database = pw.SqliteDatabase("malmail.db")
+database = pw.SqliteDatabase("malmail.db", pragmas=SQLITE_PRAGMAS)
 
 class MalmailModel(pw.Model):
     id = pw.PrimaryKeyField()
+    # When the row was stored, in local time.  Null for rows stored before
+    # this column existed.
+    created = pw.DateTimeField(default=datetime.datetime.now, null=True,
+            index=True)
     class Meta:
         database = database
 
 BASE_CLASS = MalmailModel
 
+def model_classes():
+    """
+    :returns: every model with a table, subclasses of BASE_CLASS at any
+        depth, sorted by name
+    """
+    subclasses = set()
+    pending = [BASE_CLASS]
+    while pending:
+        for subc in pending.pop().__subclasses__():
+            if subc not in subclasses:
+                subclasses.add(subc)
+                pending.append(subc)
+    return sorted(subclasses, key=lambda model: model.__name__)
+
+def table_name(model):
+    """The name of model's table, under both peewee 2 and peewee 3"""
+    return getattr(model._meta, "table_name", None) or model._meta.db_table
+
+def content_digest(model, data):
+    """
+    Digest the fields of model named in model.HASHED_FIELDS
+
+    :param dict data: field name: value, for at least the hashed fields
+    :returns: a hex string suitable for the contentHash field
+    """
+    digest = hashlib.sha256()
+    for name in model.HASHED_FIELDS:
+        digest.update(repr(data[name]).encode("utf-8", "surrogatepass"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
 class Email(MalmailModel):
     fromAddress = pw.CharField(max_length=256)
     toAddress = pw.CharField(max_length=256)
     fromFriend = pw.BooleanField()
     content = pw.CharField(max_length=1024)
+    contentHash = pw.CharField(max_length=64, unique=True, null=True)
+
+    HASHED_FIELDS = ("fromAddress", "toAddress", "fromFriend", "content")
 
 class Domain(MalmailModel):
-    url = pw.CharField(max_length=256)
+    url = pw.CharField(max_length=256, unique=True)
+    # Why the domain was last unreachable, and until when (a Unix time) it's
+    # not worth trying again
+    failureReason = pw.CharField(max_length=64, null=True)
+    failureExpires = pw.FloatField(null=True)
 
 class URL(MalmailModel):
     domain = pw.ForeignKeyField(Domain) #TODO: what implication does this have for foreign key constraints? (cascading...)
-    url = pw.CharField(max_length=2083)
-    processed = pw.BooleanField()
+    url = pw.CharField(max_length=2083, unique=True)
+    processed = pw.BooleanField(index=True)
+    # The URL as first found, when it wasn't already canonical
+    original = pw.CharField(max_length=2083, null=True)
 
 class Content(MalmailModel):
     content = pw.CharField(max_length=1024) #TODO: varbinary?
+    contentHash = pw.CharField(max_length=64, unique=True, null=True)
+
+    HASHED_FIELDS = ("content",)
 
 class HTML_Content(Content):
     pass
@@ -46,23 +101,64 @@ class Other_Content(Content):
 class URL_To_Email(MalmailModel):
     email = pw.ForeignKeyField(Email)
     url = pw.ForeignKeyField(URL)
+    class Meta:
+        indexes = ((("email", "url"), True),)
 
 class URL_To_URL(MalmailModel):
     source_url = pw.ForeignKeyField(URL, related_name="source_url")
     contained_url = pw.ForeignKeyField(URL, related_name="contained_url")
     userAgent = pw.CharField(max_length=4096)
+    class Meta:
+        indexes = ((("source_url", "contained_url", "userAgent"), True),)
 
 class HTML_To_URL(MalmailModel):
     content = pw.ForeignKeyField(HTML_Content)
     url = pw.ForeignKeyField(URL)
     userAgent = pw.CharField(max_length=4096)
+    class Meta:
+        indexes = ((("content", "url", "userAgent"), True),)
 
 class JS_To_URL(MalmailModel):
     content = pw.ForeignKeyField(JS_Content)
     url = pw.ForeignKeyField(URL)
     userAgent = pw.CharField(max_length=4096)
+    class Meta:
+        indexes = ((("content", "url", "userAgent"), True),)
 
 class Other_To_URL(MalmailModel):
     content = pw.ForeignKeyField(Other_Content)
     url = pw.ForeignKeyField(URL)
     userAgent = pw.CharField(max_length=4096)
+    class Meta:
+        indexes = ((("content", "url", "userAgent"), True),)
+
+class MailboxSyncState(MalmailModel):
+    """How far incremental IMAP retrieval has got in one account's folder"""
+    account = pw.CharField(max_length=512)
+    folder = pw.CharField(max_length=256)
+    uidValidity = pw.BigIntegerField()
+    lastUID = pw.BigIntegerField()
+    class Meta:
+        indexes = ((("account", "folder"), True),)
+
+class CrawlQueue(MalmailModel):
+    """A URL's place in the crawl, so an interrupted crawl can resume"""
+    QUEUED = "queued"
+    IN_FLIGHT = "in-flight"
+    DONE = "done"
+    FAILED = "failed"
+
+    url = pw.ForeignKeyField(URL, unique=True)
+    depth = pw.IntegerField()
+    state = pw.CharField(max_length=16)
+    attempts = pw.IntegerField(default=0)
+    # The Unix time an in-flight claim lapses, or a queued retry is due
+    leaseExpires = pw.FloatField(null=True)
+    # Identifies the claim that last took the URL
+    leaseOwner = pw.CharField(max_length=32, null=True, index=True)
+    class Meta:
+        indexes = ((("state", "depth"), False),)
+
+class SchemaVersion(MalmailModel):
+    """The single row records the last migration applied by CreateTables"""
+    version = pw.IntegerField()
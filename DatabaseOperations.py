@@ -4,10 +4,45 @@ Abstracted database operations
 The external interface is the Database class
 """
 
+import contextlib
+import io
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
 import urllib.parse
+import uuid
 
 from Common import *
 from DatabaseModel import *
+import Export
+import Metrics
+import SimilarityIndex
+from URLCanonicalizer import defaultCanonicalizer
+
+# SQLite allows at most 999 bound variables per statement
+SELECT_BATCH_SIZE = 900
+INSERT_BATCH_SIZE = 300
+DEFAULT_CACHE_SIZE = 100000
+CONTENT_CACHE_SIZE = 10000
+DEFAULT_TRANSACTION_SIZE = 100
+DEFAULT_LEASE = 5 * 60          # Seconds a claimed URL is held for
+DEFAULT_MAX_ATTEMPTS = 3        # Claims before a failing URL is given up on
+DEFAULT_RETRY_DELAY = 10 * 60   # Seconds before a failed URL's next attempt
+
+def _chunks(items, size):
+    """Yield successive lists of at most size items from the list items."""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _unique(items):
+    """Yield the items in order, skipping any already seen."""
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
 
 def domain(url):
     """
@@ -48,6 +83,11 @@ class ContentToDatabase():
     model = None
     referrerModel = None
 
+    # (model, contentHash): id, the cache of the Database in use, set by it
+    contentIDCache = None
+    # The SimilarityIndex new content is added to, set by Database
+    similarityIndex = None
+
     @classmethod
     def _insertGenericIfNotExists(cls, dbModel, **data):
         """
@@ -69,7 +109,28 @@ class ContentToDatabase():
 
     @classmethod
     def _insertContentIfNotExists(cls, **data):
-        return cls._insertGenericIfNotExists(cls.model, **data)
+        """
+        Insert content unless content with the same digest is present.
+
+        Return: The content's database key, new or old.
+        """
+        model = cls.model
+        digest = content_digest(model, data)
+        cache = cls.contentIDCache
+        contentID = None if cache is None else cache.get((model, digest))
+        if contentID is None:
+            try:
+                contentID = model.select(model.id).where(
+                        model.contentHash == digest).get().id
+            except model.DoesNotExist:
+                contentID = model.insert(contentHash=digest, **data).execute()
+                if (cls.similarityIndex is not None and
+                        model.__name__ in SimilarityIndex.KINDS):
+                    cls.similarityIndex.add(model.__name__, contentID,
+                            data["content"])
+            if cache is not None:
+                cache.put((model, digest), contentID)
+        return contentID
 
     @classmethod
     def _insertReferrerIfNotExists(cls, **data):
@@ -129,26 +190,106 @@ class Database():
     """
     Database presents a set of operations against the database.
 
+    Everything happens in transactions holding up to transactionSize items
+    of work, each ended with checkpoint().  Work since the last commit is
+    committed when the with block ends, or rolled back if it raises.
+
     Intended use:
         with Database() as db:
-            db.do_things()
+            for item in work:
+                db.do_things(item)
+                db.checkpoint()
     """
-    def __init__(self):
-        # Cheats
-        self.cheaterFullSet = set()
-        self.cheaterExploredSet = set()
+    def __init__(self, cacheSize=DEFAULT_CACHE_SIZE,
+            transactionSize=DEFAULT_TRANSACTION_SIZE,
+            canonicalizer=defaultCanonicalizer, similarityIndex=None):
+        """
+        :param int cacheSize:
+            OPTIONAL: default - DEFAULT_CACHE_SIZE
+            How many url and domain ids to remember between calls.
+
+        :param int transactionSize:
+            OPTIONAL: default - DEFAULT_TRANSACTION_SIZE
+            How many checkpoints to allow between commits
+
+        :param URLCanonicalizer canonicalizer:
+            OPTIONAL: default - URLCanonicalizer.defaultCanonicalizer
+            Reduces each URL to its canonical form before it's stored or
+            looked up.  URLs it can't fetch are dropped.
+
+        :param SimilarityIndex similarityIndex:
+            OPTIONAL: default - None
+            An index to add new emails, pages and scripts to.  It commits
+            and rolls back along with the database.
+        """
+        self.urlIDCache = BoundedCache(cacheSize)
+        self.domainIDCache = BoundedCache(cacheSize)
+        self.contentIDCache = BoundedCache(CONTENT_CACHE_SIZE)
+        self.transactionSize = transactionSize
+        self.canonicalizer = canonicalizer
+        self.similarityIndex = similarityIndex
+        self._transaction = None
+        self._uncommitted = 0
 
     def __enter__(self):
         database.connect()
+        # The database may not be the one these ids came from
+        self.contentIDCache.clear()
+        ContentToDatabase.contentIDCache = self.contentIDCache
+        ContentToDatabase.similarityIndex = self.similarityIndex
+        self._begin()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        database.close()
+        if exc_type is not None:   # Rolled back ids must not be remembered
+            self.urlIDCache.clear()
+            self.domainIDCache.clear()
+            self.contentIDCache.clear()
+        try:
+            self._transaction.__exit__(exc_type, exc_value, traceback)
+            if self.similarityIndex is not None:
+                if exc_type is None:
+                    self.similarityIndex.commit()
+                else:
+                    self.similarityIndex.rollback()
+        finally:
+            ContentToDatabase.contentIDCache = None
+            ContentToDatabase.similarityIndex = None
+            database.close()
+
+    def _begin(self):
+        self._transaction = database.atomic()
+        self._transaction.__enter__()
+        self._uncommitted = 0
+
+    @Metrics.timed()
+    def checkpoint(self):
+        """
+        Mark an item of work, such as an email or a URL, as finished.  Commit
+        once transactionSize items are waiting.
 
+        :returns: True if everything so far was just committed
+        """
+        self._uncommitted += 1
+        if self._uncommitted >= self.transactionSize:
+            self.commit()
+            return True
+        return False
+
+    @Metrics.timed()
+    def commit(self):
+        """Commit everything so far and start a new transaction"""
+        self._transaction.__exit__(None, None, None)
+        if self.similarityIndex is not None:
+            self.similarityIndex.commit()
+        self._begin()
+
+    @Metrics.timed()
     def addURLs(self, urlList, referrer=None, userAgents=None,
             fromEmail=False):
         """
-        Add URLs to the database if they're not there already.
+        Add URLs to the database if they're not there already.  They're
+        canonicalized first, keeping the original form of new URLs.
         
         :param iterable urlList:
             An iterable yielding string URLs
@@ -164,22 +305,88 @@ class Database():
         :param bool fromEmail:
             Make this true when the referrer is an email
         """
-        for url in urlList:
-            if not URL.select().where(URL.url == url).exists():
-                dom = domain(url)
-                try:
-                    domainID = Domain.select().where(
-                            Domain.url == dom).get().id
-                except Domain.DoesNotExist:
-                    domainID = Domain.insert(url = dom).execute()
-                URL.insert(domain=domainID, url = url,
-                        processed=False).execute()
+        originals = dict()  # canonical url: the first original form
+        for original in urlList:
+            url = self.canonicalizer.canonicalize(original)
+            if url is not None:
+                originals.setdefault(url, original)
+        urlList = list(originals)
+        urlIDs = self._urlIDs(urlList)
+        newURLs = [url for url in urlList if url not in urlIDs]
+
+        if newURLs:
+            domainIDs = self._domainIDs(domain(url) for url in newURLs)
+            rows = [{"domain": domainIDs[domain(url)], "url": url,
+                        "processed": False,
+                        "original": None if originals[url] == url
+                            else originals[url]}
+                    for url in newURLs]
+            for chunk in _chunks(rows, INSERT_BATCH_SIZE):
+                URL.insert_many(chunk).execute()
+            self._urlIDs(newURLs)
+
         if referrer:
             if fromEmail:
                 self.referenceURLsToEmail(urlList, referrer)
             else:
                 self.referenceURLsToURL(urlList, referrer, userAgents)
 
+    def _urlIDs(self, urlList):
+        """
+        Find the database ids of the urls that are already in the database.
+
+        :param iterable urlList:
+            An iterable yielding string URLs
+
+        :returns: {url string: url id, ...} for only the urls that exist
+        """
+        return self._cachedIDs(URL, self.urlIDCache, urlList)
+
+    def _domainIDs(self, domainList):
+        """
+        Find the database ids of the domains, inserting the missing ones.
+
+        :param iterable domainList:
+            An iterable yielding domain strings, as returned by domain()
+
+        :returns: {domain string: domain id, ...} for every domain
+        """
+        domainList = list(_unique(domainList))
+        domainIDs = self._cachedIDs(Domain, self.domainIDCache, domainList)
+        newDomains = [dom for dom in domainList if dom not in domainIDs]
+        if newDomains:
+            for chunk in _chunks(newDomains, INSERT_BATCH_SIZE):
+                Domain.insert_many([{"url": dom} for dom in chunk]).execute()
+            domainIDs.update(
+                    self._cachedIDs(Domain, self.domainIDCache, newDomains))
+        return domainIDs
+
+    @staticmethod
+    def _cachedIDs(model, cache, urlList):
+        """
+        Map url strings to ids for model, consulting cache first and then
+        querying the database for the rest in a few set-based selects.
+
+        :returns: {url string: id, ...} for only the urls that exist
+        """
+        found = dict()
+        missing = list()
+        for url in _unique(urlList):
+            modelID = cache.get(url)
+            if modelID is None:
+                missing.append(url)
+            else:
+                found[url] = modelID
+
+        for chunk in _chunks(missing, SELECT_BATCH_SIZE):
+            query = model.select(model.url, model.id).where(
+                    model.url.in_(chunk)).tuples()
+            for (url, modelID) in query:
+                found[url] = modelID
+                cache.put(url, modelID)
+        return found
+
+    @Metrics.timed()
     def getURLs(self):
         """
         Return the URLs in the database that require processing.
@@ -190,6 +397,7 @@ class Database():
         recordList = URL.select().where(URL.processed == False).execute()
         return [item.url for item in recordList]
 
+    @Metrics.timed()
     def markURLsExplored(self, urlList):
         """
         Mark all urls in urlList as having-been explored
@@ -197,9 +405,205 @@ class Database():
         :param iterable urlList:
             An iterable containing url strings
         """
-        for url in urlList:
-            URL.update(processed = True).where(URL.url == url).execute()
+        urlList = self.canonicalizer.canonicalURLs(urlList)
+        for chunk in _chunks(list(_unique(urlList)), SELECT_BATCH_SIZE):
+            URL.update(processed = True).where(URL.url.in_(chunk)).execute()
+            CrawlQueue.update(state=CrawlQueue.DONE, leaseExpires=None).where(
+                    CrawlQueue.url.in_(URL.select(URL.id).where(
+                    URL.url.in_(chunk)))).execute()
+
+    @Metrics.timed()
+    def queueURLs(self, urlList, depth):
+        """
+        Add the unprocessed urls in urlList to the crawl queue, unless
+        they're in it already.
+
+        :param iterable urlList:
+            An iterable containing url strings already in the database
 
+        :param int depth:
+            How many links were followed from an email to reach the urls
+
+        :returns: how many urls were added
+        """
+        urlIDs = self._urlIDs(self.canonicalizer.canonicalURLs(urlList))
+        queued = 0
+        for chunk in _chunks(list(urlIDs.values()), SELECT_BATCH_SIZE):
+            queued += self._queueIDs(URL.select(URL.id).where(
+                    URL.id.in_(chunk) & (URL.processed == False) &
+                    ~(URL.id.in_(CrawlQueue.select(CrawlQueue.url).where(
+                    CrawlQueue.url.in_(chunk))))), depth)
+        return queued
+
+    @Metrics.timed()
+    def queueUnprocessedURLs(self, now=None):
+        """
+        Start a crawl from every unprocessed url: add those not in the crawl
+        queue to it, at depth 0, and move those waiting in it to depth 0.
+        Depth then counts from this crawl's starting urls, so urls left too
+        deep by an earlier crawl are retrieved by the next one.
+
+        :returns: how many urls were added
+        """
+        now = time.time() if now is None else now
+        CrawlQueue.update(depth=0).where((CrawlQueue.depth > 0) &
+                ((CrawlQueue.state == CrawlQueue.QUEUED) |
+                    ((CrawlQueue.state == CrawlQueue.IN_FLIGHT) &
+                    (CrawlQueue.leaseExpires <= now)))).execute()
+        return self._queueIDs(URL.select(URL.id).where(
+                (URL.processed == False) &
+                ~(URL.id.in_(CrawlQueue.select(CrawlQueue.url)))), 0)
+
+    @staticmethod
+    def _queueIDs(idQuery, depth):
+        """Queue the ids idQuery selects, which aren't queued already"""
+        ids = [urlID for (urlID,) in idQuery.tuples()]
+        rows = [{"url": urlID, "depth": depth, "state": CrawlQueue.QUEUED}
+                for urlID in ids]
+        for chunk in _chunks(rows, INSERT_BATCH_SIZE):
+            CrawlQueue.insert_many(chunk).on_conflict("IGNORE").execute()
+        return len(ids)
+
+    @Metrics.timed()
+    def claimURLs(self, count, maxDepth=None, lease=DEFAULT_LEASE, now=None):
+        """
+        Claim up to count queued urls, shallowest first.  A single UPDATE
+        takes them, so concurrent claims never share a url.  Urls whose
+        earlier claim lapsed without finishing are taken again.
+
+        The claim is part of the current transaction, committed with the
+        work done on the urls.  Until then SQLite's write lock keeps other
+        runs from claiming, and a rollback returns the urls to the queue.
+
+        :param int maxDepth:
+            OPTIONAL: default - None, any depth
+            Only claim urls shallower than this
+
+        :param float lease:
+            OPTIONAL: default - DEFAULT_LEASE
+            Seconds until the claim lapses
+
+        :returns: [(url string, depth), ...]
+        """
+        now = time.time() if now is None else now
+        owner = uuid.uuid4().hex
+        claimable = (((CrawlQueue.state == CrawlQueue.QUEUED) |
+                    (CrawlQueue.state == CrawlQueue.IN_FLIGHT)) &
+                (CrawlQueue.leaseExpires.is_null() |
+                    (CrawlQueue.leaseExpires <= now)))
+        if maxDepth is not None:
+            claimable = claimable & (CrawlQueue.depth < maxDepth)
+        chosen = (CrawlQueue.select(CrawlQueue.id).where(claimable)
+                .order_by(CrawlQueue.depth, CrawlQueue.id).limit(count))
+        CrawlQueue.update(state=CrawlQueue.IN_FLIGHT,
+                attempts=CrawlQueue.attempts + 1, leaseExpires=now + lease,
+                leaseOwner=owner).where(
+                CrawlQueue.id.in_(chosen) & claimable).execute()
+        claimed = list(CrawlQueue.select(URL.url, CrawlQueue.depth)
+                .join(URL).where(CrawlQueue.leaseOwner == owner)
+                .order_by(CrawlQueue.depth, CrawlQueue.id).tuples())
+        return claimed
+
+    @Metrics.timed()
+    def markURLsFailed(self, urlList, maxAttempts=DEFAULT_MAX_ATTEMPTS,
+            retryDelay=DEFAULT_RETRY_DELAY, now=None):
+        """
+        Record that claimed urls couldn't be retrieved.  Each is queued to be
+        tried again after retryDelay, until it has been claimed maxAttempts
+        times; then it's failed and marked explored.
+
+        :param iterable urlList:
+            An iterable containing url strings
+        """
+        now = time.time() if now is None else now
+        urlIDs = self._urlIDs(self.canonicalizer.canonicalURLs(urlList))
+        for chunk in _chunks(list(urlIDs.values()), SELECT_BATCH_SIZE):
+            inChunk = CrawlQueue.url.in_(chunk)
+            CrawlQueue.update(state=CrawlQueue.QUEUED,
+                    leaseExpires=now + retryDelay).where(
+                    inChunk & (CrawlQueue.attempts < maxAttempts)).execute()
+            CrawlQueue.update(state=CrawlQueue.FAILED, leaseExpires=None
+                    ).where(inChunk & (CrawlQueue.attempts >= maxAttempts)
+                    ).execute()
+            URL.update(processed=True).where(URL.id.in_(
+                    CrawlQueue.select(CrawlQueue.url).where(inChunk &
+                    (CrawlQueue.state == CrawlQueue.FAILED)))).execute()
+
+    @Metrics.timed()
+    def markURLsSkipped(self, urlList, retryDelay=DEFAULT_RETRY_DELAY,
+            now=None):
+        """
+        Return claimed urls that weren't requested, because their host was
+        being skipped, to the queue.  They're tried again after retryDelay,
+        and the claim isn't counted as an attempt.
+
+        :param iterable urlList:
+            An iterable containing url strings
+        """
+        now = time.time() if now is None else now
+        urlIDs = self._urlIDs(self.canonicalizer.canonicalURLs(urlList))
+        for chunk in _chunks(list(urlIDs.values()), SELECT_BATCH_SIZE):
+            CrawlQueue.update(state=CrawlQueue.QUEUED,
+                    attempts=CrawlQueue.attempts - 1,
+                    leaseExpires=now + retryDelay).where(
+                    CrawlQueue.url.in_(chunk) &
+                    (CrawlQueue.state == CrawlQueue.IN_FLIGHT)).execute()
+
+    @Metrics.timed()
+    def getHostFailures(self, now):
+        """
+        Return the domains recorded as unreachable that are still skipped.
+
+        :param float now: the current Unix time
+        :returns: {domain string: (reason, expiry time), ...}
+        """
+        query = (Domain.select(Domain.url, Domain.failureReason,
+                Domain.failureExpires)
+                .where(Domain.failureExpires > now).tuples())
+        return {url: (reason, expires) for (url, reason, expires) in query}
+
+    @Metrics.timed()
+    def setHostFailures(self, failures):
+        """
+        Record unreachable domains, so later runs skip them too.
+
+        :param dict failures: {domain string: (reason, expiry time), ...}
+        """
+        domainIDs = self._domainIDs(failures)
+        for (dom, (reason, expires)) in failures.items():
+            Domain.update(failureReason=reason, failureExpires=expires).where(
+                    Domain.id == domainIDs[dom]).execute()
+
+    @Metrics.timed()
+    def getSyncState(self, account, folder):
+        """
+        Return how far incremental retrieval has got in a mailbox folder.
+
+        :returns: (uidValidity, lastUID), or None if it never has been
+        """
+        row = (MailboxSyncState.select(MailboxSyncState.uidValidity,
+                MailboxSyncState.lastUID)
+                .where((MailboxSyncState.account == account) &
+                    (MailboxSyncState.folder == folder))
+                .tuples().first())
+        return None if row is None else tuple(row)
+
+    @Metrics.timed()
+    def setSyncState(self, account, folder, uidValidity, lastUID):
+        """
+        Record that everything up to lastUID in a mailbox folder is stored.
+        It's committed along with the emails themselves.
+        """
+        updated = (MailboxSyncState.update(uidValidity=uidValidity,
+                lastUID=lastUID)
+                .where((MailboxSyncState.account == account) &
+                    (MailboxSyncState.folder == folder))
+                .execute())
+        if updated == 0:
+            MailboxSyncState.insert(account=account, folder=folder,
+                    uidValidity=uidValidity, lastUID=lastUID).execute()
+
+    @Metrics.timed()
     def addContent(self, content, referrer=None, userAgents=None):
         """
         Add content of some RetrievedData type into the database
@@ -220,6 +624,7 @@ class Database():
         """
         return content.toDatabaseClass.add(content, referrer, userAgents)
 
+    @Metrics.timed()
     def referenceURLsToEmail(self, urlList, emailDBKey):
         """
         Reference URLs (that are already in the DB) to the email.
@@ -229,16 +634,19 @@ class Database():
         :param int emailDBKey:
             A database key for an email
         """
+        urlList = list(self.canonicalizer.canonicalURLs(urlList))
+        urlIDs = self._urlIDs(urlList)
+        rows = list()
         for url in urlList:
-            try:
-                URL_To_Email.insert(
-                        email=emailDBKey,
-                        url=URL.select().where(URL.url == url).get()
-                    ).execute()
-            except URL.DoesNotExist:
+            if url in urlIDs:
+                rows.append({"email": emailDBKey, "url": urlIDs[url]})
+            else:
                 print_error("Error associating email with non-existent URL:",
                         url)
+        for chunk in _chunks(rows, INSERT_BATCH_SIZE):
+            URL_To_Email.insert_many(chunk).on_conflict("IGNORE").execute()
 
+    @Metrics.timed()
     def referenceURLsToURL(self, urlList, sourceUrl, userAgents):
         """
         Reference URLs (that are already in the DB) to the url (also in db)
@@ -254,33 +662,273 @@ class Database():
                         "URL ({src})")
         nonExist = "non-existent "
 
+        urlList = list(self.canonicalizer.canonicalURLs(urlList))
+        sourceUrl = self.canonicalizer.canonicalize(sourceUrl) or sourceUrl
+        urlIDs = self._urlIDs(urlList + [sourceUrl])
+        src = urlIDs.get(sourceUrl)
+
+        rows = list()
         for containedUrl in urlList:
-            src = URL.select().where(URL.url == sourceUrl).first()
-            cont = URL.select().where(URL.url == containedUrl).first()
+            cont = urlIDs.get(containedUrl)
 
-            formatDict = {"contNE": nonExist if (src is None) else "",
-                            "srcNE": nonExist if (cont is None) else "",
+            formatDict = {"contNE": nonExist if (cont is None) else "",
+                            "srcNE": nonExist if (src is None) else "",
                             "cont": containedUrl, "src": sourceUrl}
 
             if (src is not None) and (cont is not None):
                 for userAgent in userAgents:
-                    URL_To_URL.insert(source_url = src, contained_url = cont,
-                                    userAgent=userAgent).execute()
+                    rows.append({"source_url": src, "contained_url": cont,
+                                    "userAgent": userAgent})
             else:
                 print_error(errorString.format(**formatDict))
 
+        for chunk in _chunks(rows, INSERT_BATCH_SIZE):
+            URL_To_URL.insert_many(chunk).on_conflict("IGNORE").execute()
+
     def printDatabase(self):
         """
-        Print out the database in a rough way
-        """
-        subclasses = set([BASE_CLASS])
-        len_prev = -1
-        while len_prev != len(subclasses):
-            len_prev = len(subclasses)
-            for subc in set(subclasses):
-                subclasses.update(subc.__subclasses__())
-        subclasses.remove(BASE_CLASS)
-        for subc in subclasses:
-            print("{}: {}".format(subc.__name__, subc.select().count()))
-            for mbr in subc.select():
-                print(mbr._data)
+        Print out the database in a rough way, a page of rows at a time
+        """
+        counts = Export.summary()
+        for model in model_classes():
+            print("{}: {}".format(model.__name__, counts[model.__name__]))
+            names = Export.columns(model)
+            for rows in Export.pages(model):
+                for row in rows:
+                    print(dict(zip(names, row)))
+
+
+
+
+
+class CrawlQueueTester(unittest.TestCase):
+    def setUp(self):
+        import CreateTables
+        self.originalPath = database.database
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database.init(os.path.join(self.tmpdir.name, "test.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateTables.create_tables()
+        self.urls = ["http://a.example/{}".format(num) for num in range(4)]
+
+    def tearDown(self):
+        database.init(self.originalPath)
+        self.tmpdir.cleanup()
+
+    def test_claimsResume(self):
+        with Database() as dbo:
+            dbo.addURLs(self.urls)
+            dbo.markURLsExplored(self.urls[3:])
+            dbo.queueUnprocessedURLs()
+            self.assertEqual(dbo.claimURLs(2, now=0),
+                    [(self.urls[0], 0), (self.urls[1], 0)])
+            self.assertEqual(dbo.claimURLs(5, now=0), [(self.urls[2], 0)])
+            self.assertEqual(dbo.claimURLs(5, now=0), [])
+            dbo.markURLsExplored(self.urls[:1])
+            self.assertEqual(dbo.queueURLs(["http://a.example/0",
+                    "http://b.example/"], 1), 0)
+            dbo.addURLs(["http://b.example/"])
+            self.assertEqual(dbo.queueURLs(["http://a.example/0",
+                    "http://b.example/"], 1), 1)
+            self.assertEqual(dbo.queueURLs(["http://b.example/"], 0), 0)
+
+        # A later run takes back the lapsed claims, but not finished urls
+        with Database() as dbo:
+            self.assertEqual(dbo.claimURLs(5, maxDepth=1,
+                    now=DEFAULT_LEASE), [(self.urls[1], 0), (self.urls[2], 0)])
+            self.assertEqual(dbo.claimURLs(5, now=DEFAULT_LEASE),
+                    [("http://b.example/", 1)])
+            self.assertEqual(dbo.getURLs(), self.urls[1:3] +
+                    ["http://b.example/"])
+
+    def test_claimsDontCommitPendingWork(self):
+        with Database() as dbo:
+            dbo.addURLs(self.urls[:1])
+            dbo.queueUnprocessedURLs()
+        with self.assertRaises(RuntimeError):
+            with Database() as dbo:
+                dbo.addURLs(self.urls[1:])
+                self.assertEqual(dbo.claimURLs(5, now=0), [(self.urls[0], 0)])
+                raise RuntimeError("storing failed")
+        with Database() as dbo:
+            self.assertEqual(dbo.getURLs(), self.urls[:1])
+            self.assertEqual(dbo.claimURLs(5, now=0), [(self.urls[0], 0)])
+
+    def test_leftoversStartNextCrawl(self):
+        with Database() as dbo:
+            dbo.addURLs(self.urls)
+            dbo.queueURLs(self.urls[:2], 1)
+            dbo.queueURLs(self.urls[2:], 2)
+            self.assertEqual(dbo.claimURLs(1, maxDepth=2, now=0),
+                    [(self.urls[0], 1)])
+            # Too deep for this crawl
+            self.assertEqual(dbo.claimURLs(5, maxDepth=1, now=0), [])
+
+            # The next crawl starts from them, leaving live claims alone
+            self.assertEqual(dbo.queueUnprocessedURLs(now=0), 0)
+            self.assertEqual(dbo.claimURLs(5, maxDepth=1, now=0),
+                    [(url, 0) for url in self.urls[1:]])
+            self.assertEqual(dbo.queueUnprocessedURLs(now=DEFAULT_LEASE), 0)
+            self.assertEqual(dbo.claimURLs(5, maxDepth=1, now=DEFAULT_LEASE),
+                    [(url, 0) for url in self.urls])
+
+    def test_failuresRetryThenGiveUp(self):
+        with Database() as dbo:
+            dbo.addURLs(self.urls[:1])
+            dbo.queueUnprocessedURLs()
+            for attempt in range(DEFAULT_MAX_ATTEMPTS):
+                now = attempt * DEFAULT_RETRY_DELAY
+                self.assertEqual(dbo.claimURLs(5, now=now),
+                        [(self.urls[0], 0)])
+                self.assertEqual(dbo.claimURLs(5, now=now), [])
+                dbo.markURLsFailed(self.urls[:1], now=now)
+            self.assertEqual(dbo.claimURLs(5, now=10 ** 9), [])
+            self.assertEqual(dbo.getURLs(), [])
+            self.assertEqual(CrawlQueue.get().state, CrawlQueue.FAILED)
+
+    def test_skippedHostsDontUseAttempts(self):
+        with Database() as dbo:
+            dbo.addURLs(self.urls[:1])
+            dbo.queueUnprocessedURLs()
+            for attempt in range(DEFAULT_MAX_ATTEMPTS + 2):
+                now = attempt * DEFAULT_RETRY_DELAY
+                self.assertEqual(dbo.claimURLs(5, now=now),
+                        [(self.urls[0], 0)])
+                dbo.markURLsSkipped(self.urls[:1], now=now)
+                self.assertEqual(dbo.claimURLs(5, now=now), [])
+            self.assertEqual(CrawlQueue.get().attempts, 0)
+            self.assertEqual(dbo.getURLs(), self.urls[:1])
+
+
+class AddURLsTester(unittest.TestCase):
+    def setUp(self):
+        import CreateTables
+        self.originalPath = database.database
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database.init(os.path.join(self.tmpdir.name, "test.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateTables.create_tables()
+
+    def tearDown(self):
+        database.init(self.originalPath)
+        self.tmpdir.cleanup()
+
+    @contextlib.contextmanager
+    def countStatements(self):
+        """Yield a list that ends up holding each SQL statement run"""
+        statements = []
+        executeSQL = database.execute_sql
+        def _executeSQL(sql, *args, **kwargs):
+            statements.append(sql)
+            return executeSQL(sql, *args, **kwargs)
+        with unittest.mock.patch.object(database, "execute_sql", _executeSQL):
+            yield statements
+
+    def test_batchedInserts(self):
+        urls = ["http://{}.example/{}".format("abc"[num % 3], num)
+                for num in range(300)]
+        import ContentHandlers as ch
+        with Database() as dbo:
+            email = dbo.addContent(ch.ParsedEmailData("a", "b", False, "c", []))
+            with self.countStatements() as statements:
+                dbo.addURLs(urls + ["HTTP://A.example:80/0"], email,
+                        fromEmail=True)
+            # A few statements per batch, not per url
+            self.assertLess(len(statements), 15)
+            with self.countStatements() as statements:
+                dbo.addURLs(urls[:100])
+            self.assertEqual(statements, [])    # All cached
+
+        # Without the cache they're found with one query a batch
+        with Database() as dbo:
+            with self.countStatements() as statements:
+                dbo.addURLs(urls)
+            self.assertEqual(len(statements),
+                    -(-len(urls) // SELECT_BATCH_SIZE))
+
+        self.assertEqual(URL.select().count(), len(urls))
+        self.assertEqual(sorted(dom.url for dom in Domain.select()),
+                ["http://a.example", "http://b.example", "http://c.example"])
+        self.assertEqual(URL.get(URL.url == urls[1]).domain.url,
+                "http://b.example")
+        self.assertIsNone(URL.get(URL.url == urls[0]).original)
+        self.assertEqual(URL_To_Email.select().count(), len(urls))
+
+    def test_missingURLsLabelled(self):
+        with Database() as dbo:
+            dbo.addURLs(["http://a.example/"])
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                dbo.referenceURLsToURL(["http://missing.example/"],
+                        "http://a.example/", ["agent"])
+                dbo.referenceURLsToURL(["http://a.example/"],
+                        "http://missing.example/", ["agent"])
+        self.assertEqual(stderr.getvalue().splitlines(), [
+                "Error associating non-existent URL (http://missing.example/)"
+                " with URL (http://a.example/)",
+                "Error associating URL (http://a.example/) with non-existent"
+                " URL (http://missing.example/)"])
+        self.assertEqual(URL_To_URL.select().count(), 0)
+
+
+class ContentToDatabaseTester(unittest.TestCase):
+    def setUp(self):
+        import CreateTables
+        self.originalPath = database.database
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database.init(os.path.join(self.tmpdir.name, "test.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateTables.create_tables()
+
+    def tearDown(self):
+        database.init(self.originalPath)
+        self.tmpdir.cleanup()
+
+    def test_sameContentSameID(self):
+        import ContentHandlers as ch
+        email = ch.ParsedEmailData("a@example.com", "b@example.com", False,
+                "hello", [])
+        page = ch.RetrievedData("<p>hi</p>", "text/html")
+        with Database() as dbo:
+            dbo.addURLs(["http://a.example/"])
+            emailID = dbo.addContent(email)
+            pageID = HTMLContentToDatabase.add(page, "http://a.example/",
+                    ["agent"])
+            for _ in range(2):
+                self.assertEqual(dbo.addContent(ch.ParsedEmailData(
+                        "a@example.com", "b@example.com", False, "hello",
+                        [])), emailID)
+                self.assertEqual(HTMLContentToDatabase.add(page,
+                        "http://a.example/", ["agent", "other"]), pageID)
+                # Found in the database, not only the cache
+                dbo.contentIDCache.clear()
+            self.assertNotEqual(dbo.addContent(ch.ParsedEmailData(
+                    "a@example.com", "b@example.com", True, "hello", [])),
+                    emailID)
+        self.assertEqual(Email.select().count(), 2)
+        self.assertEqual(HTML_Content.select().count(), 1)
+        self.assertEqual(HTML_To_URL.select().count(), 2)
+
+    def test_cacheNotShared(self):
+        import ContentHandlers as ch
+        import CreateTables
+        email = ch.ParsedEmailData("a@example.com", "b@example.com", False,
+                "hello", [])
+        dbo = Database()
+        with dbo:
+            dbo.addContent(email)
+        # The same Database, on a second database file
+        database.init(os.path.join(self.tmpdir.name, "other.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateTables.create_tables()
+        with dbo:
+            emailID = dbo.addContent(email)
+        database.connect()
+        try:
+            self.assertEqual([row.id for row in Email.select()], [emailID])
+        finally:
+            database.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,11 +2,12 @@
 
 import imaplib
 import itertools as it
+import re
 import unittest
 import socket
 
-from EmailAcctData import server_details
 import ContentHandlers as ch
+import Metrics
 
 class EmailRetrieverException(Exception):
     instanceMessage=""
@@ -29,6 +30,29 @@ class ErrorRetrieving(EmailRetrieverException):
     instanceMessage = "Failed to retrieve emails"
 
 
+# How many messages to request with each UID FETCH
+DEFAULT_FETCH_CHUNK = 100
+
+def _uidSets(uidList, chunkSize):
+    """Group UIDs into IMAP sequence sets of at most chunkSize UIDs.
+
+            uidList: an ascending list of integer UIDs
+            chunkSize: the most UIDs to put in each set
+
+            Yield value: (set string such as "1:500,502", [uid, uid, ...])
+            """
+    for start in range(0, len(uidList), chunkSize):
+        chunk = uidList[start:start + chunkSize]
+        ranges = []
+        for uid in chunk:
+            if ranges and ranges[-1][1] == uid - 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        yield (",".join(str(low) if low == high else "{}:{}".format(low, high)
+                        for (low, high) in ranges), chunk)
+
+
 class EmailRetriever():
     """Enables simple email retrieval with a 'with' statement.
 
@@ -41,12 +65,42 @@ class EmailRetriever():
             """
 
     def __init__(self, hostname, port, username, password, unseenOnly=True,
-                    useSSL=True, directory="INBOX"):
+                    useSSL=True, directory="INBOX",
+                    chunkSize=DEFAULT_FETCH_CHUNK, markSeen=None, raw=False,
+                    sinceUID=None, expectedUIDValidity=None):
+        """
+                chunkSize: how many messages to request in each UID FETCH
+                markSeen: flag retrieved messages \\Seen once they have been
+                        handed out.  Defaults to unseenOnly, so the next
+                        unseen-only run skips them.  Fetching itself never
+                        changes the flag.
+                raw: yield (int uid, bytes message) instead of EmailData, for
+                        parsing elsewhere
+                sinceUID: retrieve only messages with a higher UID, seen or
+                        not, for incremental retrieval.  unseenOnly is then
+                        ignored.
+                expectedUIDValidity: the folder's UIDVALIDITY when sinceUID
+                        was recorded.  If the folder's UIDs have been
+                        renumbered since, everything is retrieved again.
+                        If the server reports no UIDVALIDITY, its UIDs
+                        can't be trusted from one session to the next, so
+                        sinceUID is ignored and unseenOnly applies.
+
+                After retrieval starts, uidValidity holds the folder's
+                UIDVALIDITY, or None if the server reported none, and each
+                EmailData has a uid attribute.
+                """
         self.serverDetails = {"host": hostname, "port": port}
         self.userDetails = {"user": username, "password": password}
         self.directory = directory
         self.useSSL = useSSL
         self.unseenOnly = unseenOnly
+        self.chunkSize = chunkSize
+        self.markSeen = unseenOnly if markSeen is None else markSeen
+        self.raw = raw
+        self.sinceUID = sinceUID
+        self.expectedUIDValidity = expectedUIDValidity
+        self.uidValidity = None
 
     def __enter__(self):
         imapClass = imaplib.IMAP4_SSL if self.useSSL else imaplib.IMAP4
@@ -63,25 +117,43 @@ class EmailRetriever():
         except imaplib.IMAP4.error as exc:
             raise ErrorLoggingIn(exc) from exc
 
-        return self._emailGenerator()
+        self._generator = self._emailGenerator()
+        return self._generator
 
     def __exit__(self, exc_type, exc_value, traceback):
+        try:    # Let an unfinished generator flag and close the mailbox first
+            self._generator.close()
+        except:
+            pass
         try:
             self.imapObject.logout()
         except:
             pass
 
 
+    _fetchUIDRE = re.compile(rb"UID (\d+)")
+    _uidValidityRE = re.compile(rb"\d+")
+
+    def _searchCriteria(self):
+        """Return (UID SEARCH criteria, lowest UID wanted) for the folder"""
+        if self.sinceUID is None or self.uidValidity is None:
+            return ("UNSEEN" if self.unseenOnly else "ALL", 0)
+        sinceUID = self.sinceUID
+        if self.expectedUIDValidity not in (None, self.uidValidity):
+            sinceUID = 0    # Old UIDs mean nothing now, start over
+        # n:* always matches the newest message, even below n, so the UIDs
+        # found are filtered too
+        return ("UID {}:*".format(sinceUID + 1), sinceUID + 1)
+
+    @Metrics.timed("EmailRetriever.emails")
     def _emailGenerator(self):
         """Returns data from the email.
 
+                Messages are requested chunkSize at a time with BODY.PEEK[], and
+                each chunk is parsed and handed out as soon as it arrives.
+
                 Yield value: ContentHandlers.EmailData instances
                 """
-        def _extractEmail(emailDataList):
-            return emailDataList[0][1]
-
-        searchStr = "UNSEEN" if self.unseenOnly else "ALL"
-
         try:
             (success, response) = self.imapObject.select(self.directory)
         except imaplib.IMAP4.error as exc:
@@ -89,12 +161,28 @@ class EmailRetriever():
         else:
             if success != "OK":
                 raise ErrorSettingDirectory(response)
+            (_, validity) = self.imapObject.response("UIDVALIDITY")
+            match = self._uidValidityRE.search((validity or [b""])[0] or b"")
+            self.uidValidity = int(match.group()) if match else None
+            (searchStr, lowestUID) = self._searchCriteria()
             try:
                 (_, uidSpaceSeparated) = self.imapObject.uid("search", None, searchStr)
-                uidList = uidSpaceSeparated[0].split()
-                for uid in uidList:
-                    (_, emailDataList) = self.imapObject.uid("fetch", uid, "(RFC822)")
-                    yield ch.EmailData(_extractEmail(emailDataList))
+                uidList = sorted(uid for uid in
+                                map(int, uidSpaceSeparated[0].split())
+                                if uid >= lowestUID)
+                for (uidSet, _) in _uidSets(uidList, self.chunkSize):
+                    yielded = []
+                    try:
+                        for (uid, rawEmail) in self._fetchChunk(uidSet):
+                            if self.raw:
+                                yield (uid, rawEmail)
+                            else:
+                                email = ch.EmailData(rawEmail)
+                                email.uid = uid
+                                yield email
+                            yielded.append(uid)
+                    finally:
+                        self._flagSeen(yielded)
 
             except imaplib.IMAP4.error as exc:
                 raise ErrorRetrieving(exc)
@@ -105,12 +193,63 @@ class EmailRetriever():
                 except:
                     pass
 
+    @Metrics.timed()
+    def _fetchChunk(self, uidSet):
+        """Fetch the messages in uidSet without touching their flags.
+
+                Return value: [(int uid, bytes message), ...]
+                """
+        (success, response) = self.imapObject.uid("fetch", uidSet,
+                        "(BODY.PEEK[])")
+        if success != "OK":
+            raise ErrorRetrieving(response)
+
+        # Each message arrives as a (b'<seq> (UID <uid> BODY[] {<size>}',
+        # message) tuple, followed by a closing b')'
+        messages = []
+        for item in response:
+            if isinstance(item, tuple):
+                match = self._fetchUIDRE.search(item[0])
+                messages.append((int(match.group(1)) if match else None,
+                                item[1]))
+        return messages
+
+    def flagSeen(self, uidList):
+        """Mark the messages \\Seen, whatever markSeen says.
+
+                For flagging messages once they're safely stored, from inside
+                the with block after the messages have been retrieved.
+                """
+        try:
+            (success, response) = self.imapObject.select(self.directory)
+            if success != "OK":
+                raise ErrorSettingDirectory(response)
+            self._storeSeen(uidList)
+        except imaplib.IMAP4.error as exc:
+            raise ErrorRetrieving(exc)
+        finally:
+            try:
+                self.imapObject.close()
+            except:
+                pass
+
+    def _flagSeen(self, uidList):
+        """Mark the messages \\Seen, if this retriever should."""
+        if self.markSeen:
+            self._storeSeen(uidList)
+
+    def _storeSeen(self, uidList):
+        uidList = [uid for uid in uidList if uid is not None]
+        for (uidSet, _) in _uidSets(uidList, self.chunkSize):
+            self.imapObject.uid("store", uidSet, "+FLAGS.SILENT", "(\\Seen)")
+
 
 
 
 
 class EmailRetrieverTester(unittest.TestCase):
     def setUp(self):
+        from EmailAcctData import server_details
         self.setupOptions = server_details.copy()
         self.setupOptions["unseenOnly"] = False
 
@@ -140,6 +279,45 @@ class EmailRetrieverTester(unittest.TestCase):
             retrieveOne = next(email)
         return True
 
+class IncrementalRetrievalTester(unittest.TestCase):
+    """Runs against a local StandInIMAPServer rather than a real account"""
+    @staticmethod
+    def message(num):
+        return "Subject: {0}\r\n\r\nhttp://x{0}.example/\r\n".format(
+                num).encode("ascii")
+
+    def uids(self, server, **options):
+        with EmailRetriever("127.0.0.1", server.port, "user", "pass",
+                        useSSL=False, **options) as emails:
+            return [email.uid for email in emails]
+
+    def test_sinceUID(self):
+        from StandInServers import StandInIMAPServer
+        with StandInIMAPServer(map(self.message, range(5)),
+                        uidValidity=7) as server:
+            server.messages[1][2] = True    # Seen messages are still new
+            self.assertEqual(self.uids(server, sinceUID=2,
+                    expectedUIDValidity=7), [3, 4, 5])
+            self.assertEqual(self.uids(server, sinceUID=5,
+                    expectedUIDValidity=7), [])
+            # Renumbered UIDs mean retrieving everything again
+            self.assertEqual(self.uids(server, sinceUID=5,
+                    expectedUIDValidity=6), [1, 2, 3, 4, 5])
+            retriever = EmailRetriever("127.0.0.1", server.port, "u", "p",
+                    useSSL=False, unseenOnly=False)
+            with retriever as emails:
+                list(emails)
+            self.assertEqual(retriever.uidValidity, 7)
+
+        # Without UIDVALIDITY, UIDs can't be compared with an earlier run's
+        with StandInIMAPServer(map(self.message, range(3)),
+                        uidValidity=None) as server:
+            server.messages[0][2] = True
+            self.assertEqual(self.uids(server, sinceUID=2,
+                    expectedUIDValidity=7), [2, 3])
+            self.assertEqual(self.uids(server, sinceUID=2,
+                    unseenOnly=False), [1, 2, 3])
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Export the database a page at a time, so memory use stays flat however
+large it grows.
+
+Rows are read with keyset pagination: each page starts after the last row
+of the one before, so it's a range search on an index rather than an
+OFFSET that rescans everything already read.  Unfiltered tables are read
+in id order; with a time range they're read in (created, id) order along
+the created index, and rows stored before created existed are left out.
+
+Formats:
+    jsonl       one JSON object per row, naming its table under "table"
+    csv         a directory holding one TABLE.csv per table
+    columnar    one JSON line per page, holding each column's values as an
+                array, so names aren't repeated on every row
+jsonl and columnar files whose names end in .gz are gzip compressed, and
+"-" writes them to stdout.
+
+Intended use:
+    exportTables("urls.jsonl.gz", tables=["URL"], since=yesterday)
+    printSummary(summary())
+"""
+
+import argparse
+import contextlib
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import peewee as pw
+
+from DatabaseModel import Domain, database, model_classes, table_name
+
+FORMATS = ("jsonl", "csv", "columnar")
+DEFAULT_PAGE_SIZE = 1000
+
+def findModels(tables=None):
+    """
+    :param iterable tables: model or table names, in any case.  None means
+        every table.
+    :returns: the models, in the order named
+    """
+    models = dict()
+    for model in model_classes():
+        models[model.__name__.lower()] = model
+        models[table_name(model).lower()] = model
+    if tables is None:
+        return model_classes()
+    unknown = [name for name in tables if name.lower() not in models]
+    if unknown:
+        raise ValueError("Unknown tables: {}".format(", ".join(unknown)))
+    return [models[name.lower()] for name in tables]
+
+def columns(model):
+    """:returns: the column names of model's rows, as pages() yields them"""
+    return [field.name for field in model._meta.sorted_fields]
+
+def pages(model, since=None, until=None, pageSize=DEFAULT_PAGE_SIZE):
+    """
+    Read model's rows a page at a time.
+
+    :param datetime since: only rows created at or after this time
+    :param datetime until: only rows created before this time
+    :param int pageSize: rows per page
+
+    Yield value: a list of up to pageSize row tuples, in columns() order
+    """
+    names = columns(model)
+    (idAt, createdAt) = (names.index("id"), names.index("created"))
+    byTime = since is not None or until is not None
+    query = model.select(*model._meta.sorted_fields)
+    if until is not None:
+        query = query.where(model.created < until)
+    if byTime:
+        query = query.order_by(model.created, model.id)
+    else:
+        query = query.order_by(model.id)
+
+    last = None
+    while True:
+        page = query
+        if last is None:
+            if since is not None:
+                page = page.where(model.created >= since)
+        elif byTime:
+            # The >= alone bounds the index search, the rest skips the rows
+            # already read that share the last time
+            (lastCreated, lastID) = last
+            page = page.where((model.created >= lastCreated) &
+                    ((model.created > lastCreated) | (model.id > lastID)))
+        else:
+            page = page.where(model.id > last[1])
+        rows = list(page.limit(pageSize).tuples())
+        if not rows:
+            return
+        yield rows
+        last = (rows[-1][createdAt], rows[-1][idAt])
+
+def summary(tables=None, since=None, until=None):
+    """
+    Count rows without reading them.  Each count is a single COUNT query
+    answered from an index: the created index for a time range, otherwise
+    whichever is smallest.
+
+    :returns: {model name: row count}, in table order
+    """
+    counts = dict()
+    for model in findModels(tables):
+        query = model.select(pw.fn.COUNT(model.id))
+        if since is not None:
+            query = query.where(model.created >= since)
+        if until is not None:
+            query = query.where(model.created < until)
+        counts[model.__name__] = query.scalar()
+    return counts
+
+def printSummary(counts):
+    """Print the counts summary() returns"""
+    for (name, count) in counts.items():
+        print("{}: {}".format(name, count))
+
+def _jsonValue(value):
+    """Convert values json can't, such as datetimes"""
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+def _openText(path):
+    """Open path to write text, gzipped for .gz names, stdout for "-" """
+    if path == "-":
+        return contextlib.nullcontext(sys.stdout)
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", encoding="utf-8", newline="")
+    return open(path, "w", encoding="utf-8", newline="")
+
+def exportTables(path, format="jsonl", tables=None, since=None, until=None,
+                pageSize=DEFAULT_PAGE_SIZE):
+    """
+    Write tables to path, a page at a time.
+
+    :param str path: the file to write, or the directory for csv
+    :param str format: one of FORMATS
+    :param iterable tables: model or table names.  Default: every table.
+    :param datetime since: only rows created at or after this time
+    :param datetime until: only rows created before this time
+    :param int pageSize: rows read at once
+
+    :returns: {model name: rows written}
+    """
+    if format not in FORMATS:
+        raise ValueError("Unknown export format: {}".format(format))
+    models = findModels(tables)
+    written = dict()
+    if format == "csv":
+        os.makedirs(path, exist_ok=True)
+        for model in models:
+            with open(os.path.join(path, model.__name__ + ".csv"), "w",
+                            encoding="utf-8", newline="") as outFile:
+                writer = csv.writer(outFile)
+                writer.writerow(columns(model))
+                written[model.__name__] = 0
+                for rows in pages(model, since, until, pageSize):
+                    writer.writerows(rows)
+                    written[model.__name__] += len(rows)
+        return written
+
+    with _openText(path) as outFile:
+        for model in models:
+            (name, names) = (model.__name__, columns(model))
+            written[name] = 0
+            for rows in pages(model, since, until, pageSize):
+                if format == "jsonl":
+                    for row in rows:
+                        record = {"table": name}
+                        record.update(zip(names, row))
+                        outFile.write(json.dumps(record, default=_jsonValue))
+                        outFile.write("\n")
+                else:
+                    outFile.write(json.dumps({"table": name, "columns": names,
+                                    "values": [list(col) for col in zip(*rows)]},
+                                    default=_jsonValue))
+                    outFile.write("\n")
+                written[name] += len(rows)
+    return written
+
+def _time(text):
+    """Parse a command line time, such as 2024-05-01 or 2024-05-01T12:30"""
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("not an ISO time: {}".format(text))
+
+def main():
+    parser = argparse.ArgumentParser(
+                    description="Export the database, or count its rows.")
+    parser.add_argument("OUTPUT", nargs="?",
+                    help="The file to write, - for stdout, or the directory "
+                    "for csv.")
+    parser.add_argument("-f", "--format", choices=FORMATS, default="jsonl",
+                    help="Default: jsonl.")
+    parser.add_argument("-t", "--table", action="append", dest="tables",
+                    help="Export this table.  Repeat for more.  Default: all.")
+    parser.add_argument("--since", type=_time, metavar="TIME",
+                    help="Only rows stored at or after TIME (local, ISO).")
+    parser.add_argument("--until", type=_time, metavar="TIME",
+                    help="Only rows stored before TIME (local, ISO).")
+    parser.add_argument("-p", "--page-size", type=int,
+                    default=DEFAULT_PAGE_SIZE, help="Rows read at once.")
+    parser.add_argument("-s", "--summary", action="store_true",
+                    help="Only print how many rows each table has.")
+    args = parser.parse_args()
+    if args.OUTPUT is None and not args.summary:
+        parser.error("OUTPUT is required unless --summary is given")
+
+    database.connect()
+    try:
+        if args.summary:
+            printSummary(summary(args.tables, args.since, args.until))
+        else:
+            written = exportTables(args.OUTPUT, args.format, args.tables,
+                            args.since, args.until, args.page_size)
+            print("Exported {} rows".format(sum(written.values())),
+                            file=sys.stderr)
+    finally:
+        database.close()
+
+
+
+
+
+class ExportTester(unittest.TestCase):
+    def setUp(self):
+        import CreateTables
+        self.originalPath = database.database
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database.init(os.path.join(self.tmpdir.name, "test.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateTables.create_tables()
+        database.connect()
+        self.start = datetime.datetime(2024, 1, 1)
+        # Out of id order, with times shared across page boundaries
+        for num in range(10):
+            Domain.insert(url="http://d{}.example".format(num),
+                    created=self.start + datetime.timedelta(
+                    hours=(9 - num) // 3)).execute()
+        Domain.insert(url="http://untimed.example", created=None).execute()
+
+    def tearDown(self):
+        database.close()
+        database.init(self.originalPath)
+        self.tmpdir.cleanup()
+
+    def test_pages(self):
+        urlAt = columns(Domain).index("url")
+        everything = [row for rows in pages(Domain, pageSize=3)
+                for row in rows]
+        self.assertEqual(len(everything), 11)
+        self.assertEqual([row[0] for row in everything], list(range(1, 12)))
+
+        since = self.start + datetime.timedelta(hours=1)
+        timed = list(pages(Domain, since=since, pageSize=2))
+        self.assertEqual([len(rows) for rows in timed], [2, 2, 2, 1])
+        self.assertEqual(sorted(row[urlAt] for rows in timed for row in rows),
+                ["http://d{}.example".format(num) for num in range(7)])
+        self.assertEqual(summary(["domain"], since=since), {"Domain": 7})
+        self.assertEqual(summary(["Domain"], until=since), {"Domain": 3})
+        self.assertEqual(summary(["Domain"]), {"Domain": 11})
+        self.assertRaises(ValueError, summary, ["NoSuchTable"])
+
+    def test_formats(self):
+        path = os.path.join(self.tmpdir.name, "out.jsonl.gz")
+        self.assertEqual(exportTables(path, tables=["Domain"], pageSize=4),
+                {"Domain": 11})
+        with gzip.open(path, "rt") as inFile:
+            records = [json.loads(line) for line in inFile]
+        self.assertEqual(records[0]["url"], "http://d0.example")
+        self.assertEqual(records[0]["created"], "2024-01-01 03:00:00")
+        self.assertEqual({record["table"] for record in records}, {"Domain"})
+
+        path = os.path.join(self.tmpdir.name, "out.columnar")
+        exportTables(path, "columnar", ["Domain", "URL"], pageSize=4)
+        with open(path) as inFile:
+            chunks = [json.loads(line) for line in inFile]
+        self.assertEqual([len(chunk["values"][0]) for chunk in chunks],
+                [4, 4, 3])
+        self.assertEqual(chunks[0]["values"][chunks[0]["columns"].index(
+                "url")][1], "http://d1.example")
+
+        path = os.path.join(self.tmpdir.name, "csv")
+        exportTables(path, "csv", ["Domain"])
+        with open(os.path.join(path, "Domain.csv"), newline="") as inFile:
+            rows = list(csv.reader(inFile))
+        self.assertEqual(rows[0], columns(Domain))
+        self.assertEqual(len(rows), 12)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,32 @@
 Provide high-level functionality for ingesting data
 """
 
-from DatabaseOperations import Database
+import contextlib
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from Common import print_error
+from CrawlFrontier import (CrawlFrontier, crawl, DEFAULT_WORKERS,
+    DEFAULT_DOMAIN_RATE, DEFAULT_DOMAIN_BURST)
+from DatabaseOperations import (Database, DEFAULT_LEASE,
+    DEFAULT_TRANSACTION_SIZE)
 from EmailRetriever import EmailRetriever
-from RetrieveURLs import retrieveURLWithEachUserAgent
+import Export
+import Metrics
+from ParsePipeline import ordered_parse, mbox_messages, maildir_messages
+from RetrieveURLs import (retrieveURLWithEachUserAgent, hostFailureCache,
+    FAILED, GONE, SKIPPED)
 
-def retrieve_emails_into_database(email_server_opts, unseen_only=True):
+@Metrics.timed()
+def retrieve_emails_into_database(email_server_opts, unseen_only=True,
+        transaction_size=DEFAULT_TRANSACTION_SIZE, parse_workers=0,
+        incremental=False, similarity_index=None):
     """
     Pull email from a server into the database
 
@@ -17,43 +38,374 @@ def retrieve_emails_into_database(email_server_opts, unseen_only=True):
     :param bool unseen_only:
         Optional - Default True
         If true, only pull in emails that are marked unread
+
+    :param int transaction_size:
+        Optional - Default DatabaseOperations.DEFAULT_TRANSACTION_SIZE
+        How many emails to store in each database transaction
+
+    :param int parse_workers:
+        Optional - Default 0
+        If 0, fetch, parse and store each email in turn.  Otherwise fetch on
+        a thread, parse in this many processes (None for one per core), and
+        store in order as parsed emails arrive.  Emails are then only flagged
+        seen once they are committed.
+
+    :param bool incremental:
+        Optional - Default False
+        If true, retrieve only the emails that arrived since the last
+        incremental run, seen or not, instead of following unseen_only.  How
+        far each account's folder has got is stored with the emails.
+
+    :param SimilarityIndex similarity_index:
+        Optional - Default None
+        An index to add the new emails to, for finding similar ones
     """
     email_server_opts["unseenOnly"] = unseen_only
+    with Database(transactionSize=transaction_size,
+            similarityIndex=similarity_index) as dbo:
+        sync = MailboxSync(email_server_opts, dbo) if incremental else None
+        if parse_workers != 0:
+            _retrieve_emails_pipelined(email_server_opts, dbo, parse_workers,
+                    sync)
+            return
 
-    with EmailRetriever(**email_server_opts) as email_connection:
-        for email in email_connection:
-            with Database() as dbo:
-                email_id = dbo.addContent(email)
-                urls = email.extractURLs()
-                dbo.addURLs(urls, email_id, fromEmail=True)
+        # Flagging waits for the commit, so a rollback leaves emails unseen
+        retriever = EmailRetriever(**dict(email_server_opts, markSeen=False))
+        committed = []
+        uncommitted = []
+        with retriever as email_connection:
+            try:
+                for email in email_connection:
+                    email_id = dbo.addContent(email)
+                    urls = email.extractURLs()
+                    dbo.addURLs(urls, email_id, fromEmail=True)
+                    if sync is not None:
+                        sync.stored(retriever, email.uid)
+                    uncommitted.append(email.uid)
+                    if dbo.checkpoint():
+                        committed.extend(uncommitted)
+                        uncommitted = []
+                dbo.commit()
+                committed.extend(uncommitted)
+            finally:
+                email_connection.close()
+                if _mark_seen(email_server_opts) and committed:
+                    retriever.flagSeen(committed)
+
+class MailboxSync():
+    """
+    Tracks incremental retrieval of one account's folder.  Adds the options
+    for retrieving only new mail to email_server_opts.
+    """
+    def __init__(self, email_server_opts, dbo):
+        self.dbo = dbo
+        self.account = "{username}@{hostname}:{port}".format(
+                **email_server_opts)
+        self.folder = email_server_opts.get("directory", "INBOX")
+        (uid_validity, last_uid) = (dbo.getSyncState(self.account,
+                self.folder) or (None, 0))
+        email_server_opts["sinceUID"] = last_uid
+        email_server_opts["expectedUIDValidity"] = uid_validity
+
+    def stored(self, retriever, uid):
+        """
+        Record that the email uid is stored, in the same transaction.
+        Nothing is recorded for servers that report no UIDVALIDITY, which
+        are retrieved from non-incrementally.
+        """
+        if uid is not None and retriever.uidValidity is not None:
+            self.dbo.setSyncState(self.account, self.folder,
+                    retriever.uidValidity, uid)
+
+def _mark_seen(email_server_opts):
+    """Whether retrieved emails should be flagged seen once committed"""
+    mark_seen = email_server_opts.get("markSeen")
+    if mark_seen is None:
+        mark_seen = email_server_opts["unseenOnly"]
+    return mark_seen
+
+# Raw emails the fetcher may get ahead of the parsers by
+FETCH_QUEUE_SIZE = 256
+
+def _fetch_raw_emails(retriever, mark_seen, raw_queue, stop, committed_queue):
+    """
+    The fetching stage of _retrieve_emails_pipelined.  Put (uid, raw email)
+    pairs from the raw mode retriever on raw_queue then None, or an
+    exception if fetching fails.  Then if mark_seen, flag seen the uids the
+    writer puts on committed_queue.
+    """
+    def _put(item):
+        while not stop.is_set():
+            try:
+                raw_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        with retriever as emails:
+            for item in emails:
+                if not _put(item):
+                    break
+            else:
+                _put(None)
+            committed = committed_queue.get()
+            if mark_seen and committed:
+                retriever.flagSeen(committed)
+    except Exception as exc:
+        if not _put(exc):
+            print_error("Error retrieving emails:", exc)
+
+def _queued(raw_queue):
+    """Yield items from raw_queue until None, raising any exception found"""
+    while True:
+        item = raw_queue.get()
+        if item is None:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def _retrieve_emails_pipelined(email_server_opts, dbo, parse_workers, sync):
+    """
+    retrieve_emails_into_database in three stages: a fetching thread, a
+    process pool parsing, and the writer, this thread.  Bounded queues
+    between them hold back whichever stage is ahead.
+    """
+    mark_seen = _mark_seen(email_server_opts)
+    retriever = EmailRetriever(**dict(email_server_opts, markSeen=False,
+            raw=True))
+    raw_queue = queue.Queue(FETCH_QUEUE_SIZE)
+    committed_queue = queue.Queue()
+    stop = threading.Event()
+    fetcher = threading.Thread(target=_fetch_raw_emails, daemon=True,
+            args=(retriever, mark_seen, raw_queue, stop, committed_queue))
+    fetcher.start()
 
-def retrieve_urls_into_database(extract_depth=1):
+    committed = []
+    uncommitted = []
+    unparsed = []
+    try:
+        for (uid, email) in ordered_parse(_queued(raw_queue), parse_workers):
+            if email is None:
+                # Left unseen, and below the incremental mark, so the next
+                # run tries it again
+                unparsed.append(uid)
+                Metrics.count("retrieve_emails_into_database.unparsed")
+                continue
+            email_id = dbo.addContent(email)
+            dbo.addURLs(email.urlList, email_id, fromEmail=True)
+            if sync is not None and not unparsed:
+                sync.stored(retriever, uid)
+            uncommitted.append(uid)
+            if dbo.checkpoint():
+                committed.extend(uncommitted)
+                uncommitted = []
+        dbo.commit()
+        committed.extend(uncommitted)
+        if unparsed:
+            print_error("Left unseen {} emails that couldn't be parsed, "
+                    "UIDs:".format(len(unparsed)), *unparsed)
+    finally:
+        stop.set()
+        committed_queue.put(committed)
+        fetcher.join()
+
+# URLs claimed from the crawl queue at once, per worker
+CLAIMS_PER_WORKER = 4
+
+def store_url_contents(dbo, url, depth, url_contents_list):
+    """
+    Store what was retrieved from a claimed url, and queue the urls it
+    contains, or record why nothing was retrieved.  A url whose host was
+    skipped is queued again without using an attempt, one that gave an
+    error a retry won't fix is explored, and any other is retried.
+
+    :param URLContentsList url_contents_list:
+        What was retrieved, or None if retrieving raised
+
+    :returns: how many urls were queued
+    """
+    if not url_contents_list:
+        outcome = getattr(url_contents_list, "outcome", FAILED)
+        if outcome == SKIPPED:
+            dbo.markURLsSkipped([url])
+        elif outcome == GONE:
+            dbo.markURLsExplored([url])
+        else:
+            dbo.markURLsFailed([url])
+        dbo.checkpoint()
+        return 0
+    queued = 0
+    for url_contents in url_contents_list:
+        dbo.addContent(
+            url_contents.contents, url, url_contents.userAgents)
+        contained_urls = list(dbo.canonicalizer.canonicalURLs(
+            url_contents.contents.extractURLs()))
+        dbo.addURLs(contained_urls, url, url_contents.userAgents)
+        queued += dbo.queueURLs(contained_urls, depth + 1)
+    dbo.markURLsExplored([url])
+    dbo.checkpoint()
+    return queued
+
+@Metrics.timed()
+def retrieve_urls_into_database(extract_depth=1, workers=DEFAULT_WORKERS,
+        domain_rate=DEFAULT_DOMAIN_RATE, domain_burst=DEFAULT_DOMAIN_BURST,
+        transaction_size=DEFAULT_TRANSACTION_SIZE, cache=None,
+        host_failures=hostFailureCache, lease=DEFAULT_LEASE,
+        similarity_index=None):
     """
     Pull content from all unprocessed URLs into the database.  With all
     content it pulls in, extract the URLs and add them to the database.
     Repeat this process on the new URLs "extract_depth" number of times.
 
+    The URLs to retrieve are kept in the database's crawl queue, so an
+    interrupted run picks up where it stopped.  URLs found deeper than
+    extract_depth stay queued, and the next run starts from them along with
+    the other unprocessed URLs.
+
     :param int extract_depth:
         Optional - Default 1
         How many rounds of extraction to complete before quitting
+
+    :param int workers:
+        Optional - Default CrawlFrontier.DEFAULT_WORKERS
+        How many URLs to retrieve at once
+
+    :param float domain_rate:
+        Optional - Default CrawlFrontier.DEFAULT_DOMAIN_RATE
+        How many requests per second to allow to any one domain
+
+    :param int domain_burst:
+        Optional - Default CrawlFrontier.DEFAULT_DOMAIN_BURST
+        How many requests a domain may receive at once before domain_rate
+        applies
+
+    :param int transaction_size:
+        Optional - Default DatabaseOperations.DEFAULT_TRANSACTION_SIZE
+        How many URLs to store in each database transaction
+
+    :param ResponseCache cache:
+        Optional - Default None
+        A cache to answer requests from, and store responses in
+
+    :param HostFailureCache host_failures:
+        Optional - Default RetrieveURLs.hostFailureCache
+        Hosts to skip because they recently failed.  It starts with the
+        failures recorded in the database by earlier runs, and the
+        unexpired ones are recorded again at the end.  None never skips.
+
+    :param float lease:
+        Optional - Default DatabaseOperations.DEFAULT_LEASE
+        Seconds a claimed URL is held before another run may claim it
+
+    :param SimilarityIndex similarity_index:
+        Optional - Default None
+        An index to add the new pages and scripts to, for finding similar ones
     """
-    with Database() as dbo:
-        next_round_urls = dbo.getURLs()
-        for _ in range(extract_depth):
-            round_urls, next_round_urls = next_round_urls, list()
+    frontier = CrawlFrontier(domain_rate, domain_burst)
+
+    def _handle(url, depth, url_contents_list):
+        store_url_contents(dbo, url, depth, url_contents_list)
+
+    def _claim():
+        claimed = dbo.claimURLs(CLAIMS_PER_WORKER * workers, extract_depth,
+                lease)
+        for (url, depth) in claimed:
+            frontier.add(url, depth)
+        return len(claimed)
+
+    def _fetch(url):
+        print("Processing URL: {}".format(url))
+        return retrieveURLWithEachUserAgent(url, cache=cache,
+                hostFailures=host_failures)
+
+    with Database(transactionSize=transaction_size,
+            similarityIndex=similarity_index) as dbo:
+        if host_failures is not None:
+            host_failures.load(dbo.getHostFailures(time.time()))
+        dbo.queueUnprocessedURLs()
+        crawl(frontier, _fetch, _handle, workers, refill=_claim)
+        if host_failures is not None:
+            dbo.setHostFailures(host_failures.entries())
 
-            for url in round_urls:
-                print("Processing URL: {}".format(url))
-                for url_contents in retrieveURLWithEachUserAgent(url):
-                    dbo.addContent(
-                        url_contents.contents, url, url_contents.userAgents)
-                    contained_urls = url_contents.contents.extractURLs()
-                    next_round_urls.extend(contained_urls)
-                    dbo.addURLs(contained_urls, url, url_contents.userAgents)
+@Metrics.timed()
+def import_archive_into_database(path, workers=None, resume_from=None,
+        state_path=None, transaction_size=DEFAULT_TRANSACTION_SIZE,
+        progress_interval=10, similarity_index=None):
+    """
+    Import the emails in an mbox file or a Maildir directory into the
+    database.  Emails are parsed by a pool of processes and stored in
+    archive order.
+
+    :param str path:
+        An mbox file, or a Maildir directory
+
+    :param int workers:
+        Optional - Default one per core
+        How many processes to parse with
+
+    :param resume_from:
+        Optional - Default None, or whatever state_path holds
+        Where to pick up a previous import: a byte offset into an mbox file,
+        or the position of the last Maildir message imported, as
+        ParsePipeline.maildir_messages reports it
+
+    :param str state_path:
+        Optional - Default None
+        A file to record the resume point in after each commit.  If it
+        exists and resume_from is None the import resumes from it.
+
+    :param int transaction_size:
+        Optional - Default DatabaseOperations.DEFAULT_TRANSACTION_SIZE
+        How many emails to store in each database transaction
 
-            dbo.markURLsExplored(round_urls)
+    :param float progress_interval:
+        Optional - Default 10
+        Seconds between progress reports
 
-        dbo.markURLsExplored(next_round_urls)
+    :param SimilarityIndex similarity_index:
+        Optional - Default None
+        An index to add the new emails to, for finding similar ones
+
+    :returns: The resume point after the last email imported
+    """
+    is_maildir = os.path.isdir(path)
+    if resume_from is None and state_path and os.path.exists(state_path):
+        with open(state_path) as state_file:
+            resume_from = state_file.read().strip() or None
+    if is_maildir:
+        messages = maildir_messages(path, resume_from)
+    else:
+        messages = mbox_messages(path, int(resume_from or 0))
+
+    def _save_state(position):
+        if state_path is not None and position is not None:
+            with open(state_path + ".tmp", "w") as state_file:
+                state_file.write(str(position))
+            os.replace(state_path + ".tmp", state_path)
+
+    position = resume_from
+    imported = 0
+    start = last_report = time.monotonic()
+    with Database(transactionSize=transaction_size,
+            similarityIndex=similarity_index) as dbo:
+        for (position, email) in ordered_parse(messages, workers):
+            if email is not None:
+                email_id = dbo.addContent(email)
+                dbo.addURLs(email.urlList, email_id, fromEmail=True)
+            imported += 1
+            if dbo.checkpoint():
+                _save_state(position)
+            now = time.monotonic()
+            if now - last_report >= progress_interval:
+                last_report = now
+                print("Imported {} emails, {:.0f}/s, resume from {}".format(
+                    imported, imported / (now - start), position))
+    _save_state(position)
+    print("Imported {} emails from {}".format(imported, path))
+    return position
 
 
 def print_database():
@@ -62,3 +414,187 @@ def print_database():
     """
     with Database() as dbo:
         dbo.printDatabase()
+
+def print_summary(since=None):
+    """
+    Print how many rows each table has, without reading them
+
+    :param datetime since:
+        Optional - Default None
+        Only count rows stored at or after this time
+    """
+    with Database():
+        Export.printSummary(Export.summary(since=since))
+
+
+
+
+
+class _TemporaryDatabaseTester(unittest.TestCase):
+    """Runs each test against a new temporary database"""
+    def setUp(self):
+        import CreateTables
+        from DatabaseModel import database
+        self.database = database
+        self.originalPath = database.database
+        self.tmpdir = tempfile.TemporaryDirectory()
+        database.init(os.path.join(self.tmpdir.name, "test.db"))
+        with contextlib.redirect_stdout(io.StringIO()):
+            CreateTables.create_tables()
+
+    def tearDown(self):
+        self.database.init(self.originalPath)
+        self.tmpdir.cleanup()
+
+
+class RetrieveEmailsTester(_TemporaryDatabaseTester):
+    """Runs against a local StandInIMAPServer and a temporary database"""
+    @staticmethod
+    def message(num):
+        return ("From: a@example.com\r\nTo: b@example.com\r\n"
+                "Subject: {0}\r\n\r\nhello {0}\r\n".format(num)
+                ).encode("ascii")
+
+    def retrieve(self, failAt=None, **options):
+        """
+        Retrieve five emails, with the failAt-th addContent raising.
+
+        :returns: (each message's seen flag, how many emails were stored)
+        """
+        from DatabaseModel import Email
+        from StandInServers import StandInIMAPServer
+        addContent = Database.addContent
+        calls = []
+        def _addContent(dbo, content, *args):
+            calls.append(content)
+            if len(calls) == failAt:
+                raise RuntimeError("storing failed")
+            return addContent(dbo, content, *args)
+
+        with StandInIMAPServer(map(self.message, range(5))) as server, \
+                unittest.mock.patch.object(Database, "addContent",
+                _addContent):
+            opts = {"hostname": "127.0.0.1", "port": server.port,
+                    "username": "user", "password": "pass", "useSSL": False}
+            if failAt is None:
+                retrieve_emails_into_database(opts, **options)
+            else:
+                self.assertRaises(RuntimeError,
+                        retrieve_emails_into_database, opts, **options)
+            seen = [message[2] for message in server.messages]
+        self.database.connect()
+        try:
+            return (seen, Email.select().count())
+        finally:
+            self.database.close()
+
+    def test_flaggedSeen(self):
+        self.assertEqual(self.retrieve(), ([True] * 5, 5))
+
+    def test_failureFlagsOnlyCommitted(self):
+        self.assertEqual(self.retrieve(4, transaction_size=2),
+                ([True, True, False, False, False], 2))
+
+    def test_failureBeforeCommitFlagsNothing(self):
+        self.assertEqual(self.retrieve(4), ([False] * 5, 0))
+
+    def test_pipelinedFlaggedSeen(self):
+        self.assertEqual(self.retrieve(parse_workers=1), ([True] * 5, 5))
+
+    def test_pipelinedFailureFlagsOnlyCommitted(self):
+        self.assertEqual(self.retrieve(4, transaction_size=2, parse_workers=1),
+                ([True, True, False, False, False], 2))
+
+    def test_pipelinedFailureBeforeCommitFlagsNothing(self):
+        self.assertEqual(self.retrieve(4, parse_workers=1), ([False] * 5, 0))
+
+    def test_pipelinedUnparsedLeftUnseen(self):
+        from DatabaseModel import Email, MailboxSyncState
+        from StandInServers import StandInIMAPServer
+        parse = ordered_parse
+        def _ordered_parse(messages, workers):
+            for (uid, email) in parse(messages, workers):
+                yield (uid, None if uid == 3 else email)
+
+        with StandInIMAPServer(map(self.message, range(5))) as server, \
+                unittest.mock.patch.dict(globals(),
+                {"ordered_parse": _ordered_parse}), \
+                contextlib.redirect_stderr(io.StringIO()) as stderr:
+            opts = {"hostname": "127.0.0.1", "port": server.port,
+                    "username": "user", "password": "pass", "useSSL": False}
+            retrieve_emails_into_database(dict(opts), parse_workers=1)
+            self.assertEqual([message[2] for message in server.messages],
+                    [True, True, False, True, True])
+            retrieve_emails_into_database(dict(opts), parse_workers=1,
+                    incremental=True)
+        self.assertIn("couldn't be parsed, UIDs: 3", stderr.getvalue())
+        self.database.connect()
+        try:
+            self.assertEqual(Email.select().count(), 4)
+            # The incremental mark stays below the unparsed email
+            self.assertEqual(MailboxSyncState.get().lastUID, 2)
+        finally:
+            self.database.close()
+
+    def test_incrementalWithoutUIDValidity(self):
+        from DatabaseModel import Email, MailboxSyncState
+        from StandInServers import StandInIMAPServer
+        with StandInIMAPServer(map(self.message, range(3)),
+                uidValidity=None) as server:
+            opts = {"hostname": "127.0.0.1", "port": server.port,
+                    "username": "user", "password": "pass", "useSSL": False}
+            for parse_workers in (0, 1):
+                retrieve_emails_into_database(dict(opts), incremental=True,
+                        parse_workers=parse_workers)
+                server.messages.append([len(server.messages) + 1,
+                        self.message(len(server.messages)), False])
+            seen = [message[2] for message in server.messages]
+        # Retrieved as unseen only, with nothing recorded to resume from
+        self.assertEqual(seen, [True] * 4 + [False])
+        self.database.connect()
+        try:
+            self.assertEqual(Email.select().count(), 4)
+            self.assertEqual(MailboxSyncState.select().count(), 0)
+        finally:
+            self.database.close()
+
+
+
+class RetrieveURLsTester(_TemporaryDatabaseTester):
+    """Runs against a local StandInHTTPServer and a temporary database"""
+    def test_failuresByOutcome(self):
+        from DatabaseModel import CrawlQueue, URL
+        from RetrieveURLs import HostFailureCache
+        from StandInServers import StandInHTTPServer
+        failures = HostFailureCache()
+        skipped = "http://skipped.example/"
+        failures.record(skipped, "connection refused")
+        pages = {"/": b'<a href="/missing">gone</a><a href="/busy">busy</a>',
+                "/busy": (503, {}, b"busy")}
+        with StandInHTTPServer(pages) as server:
+            with Database() as dbo:
+                dbo.addURLs([server.url(), skipped])
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                retrieve_urls_into_database(extract_depth=2,
+                        host_failures=failures)
+
+        self.database.connect()
+        try:
+            rows = {url: (state, attempts, processed) for
+                    (url, state, attempts, processed) in CrawlQueue.select(
+                    URL.url, CrawlQueue.state, CrawlQueue.attempts,
+                    URL.processed).join(URL).tuples()}
+        finally:
+            self.database.close()
+        self.assertEqual(rows, {
+                server.url(): (CrawlQueue.DONE, 1, True),
+                # Definitive, so not retried
+                server.url("/missing"): (CrawlQueue.DONE, 1, True),
+                server.url("/busy"): (CrawlQueue.QUEUED, 1, False),
+                # Never requested, so no attempt used
+                skipped: (CrawlQueue.QUEUED, 0, False)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Import an mbox file or a Maildir of saved emails into the database
+"""
+
+import argparse
+
+import HighLevelFunctionality as hlf
+from SimilarityIndex import SimilarityIndex, DEFAULT_INDEX_PATH
+
+def main():
+    parser = argparse.ArgumentParser(
+                    description="Import an mbox file or Maildir into the database.")
+    parser.add_argument("ARCHIVE", help="The mbox file or Maildir directory.")
+    parser.add_argument("-w", "--workers", type=int,
+                    help="Processes to parse emails with.  Default: one per "
+                    "core.")
+    parser.add_argument("-r", "--resume-from", metavar="POSITION",
+                    help="The byte offset (mbox) or message position "
+                    "(Maildir) a previous import reported.")
+    parser.add_argument("-s", "--state", metavar="FILE",
+                    help="Record the resume point in FILE, and resume from it "
+                    "if it exists.")
+    parser.add_argument("-x", "--similarity-index", metavar="FILE",
+                    default=DEFAULT_INDEX_PATH, help="Add the emails to this "
+                    "similarity index.  Default: {}".format(DEFAULT_INDEX_PATH))
+    parser.add_argument("--no-similarity-index", action="store_const",
+                    const=None, dest="similarity_index",
+                    help="Don't index the emails for similarity.")
+    args = parser.parse_args()
+
+    index = (None if args.similarity_index is None
+            else SimilarityIndex(args.similarity_index))
+    hlf.import_archive_into_database(args.ARCHIVE, args.workers,
+                    args.resume_from, args.state, similarity_index=index)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Find the URLs a piece of JavaScript is likely to visit.
+
+The scanner tokenizes the script once, left to right, with one compiled
+expression, and picks out:
+    - string literals holding absolute or protocol-relative URLs
+    - the targets of location assignments, location.replace/assign and
+      window.open, even when relative
+    - literals joined with "+", such as "http://ev" + "il.com/"
+    - atob("...") payloads, which are decoded and scanned in turn
+
+Obfuscated droppers can be huge, so each scan has a size and time budget.
+When either runs out the scan stops and returns what it found so far.
+"""
+
+import base64
+import binascii
+import re
+import time
+import unittest
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024
+DEFAULT_MAX_SECONDS = 0.5
+MAX_DECODE_DEPTH = 2
+_TOKENS_PER_CLOCK_CHECK = 4096
+
+# Comments, literals, and in bulk, the code between them
+_tokenRE = re.compile(r"""
+      (?P<comment>//[^\r\n]*|/\*(?:[^*]|\*(?!/))*(?:\*/)?)
+    | (?P<string>"(?:[^"\\\r\n]|\\.)*"|'(?:[^'\\\r\n]|\\.)*'|`(?:[^`\\]|\\.)*`)
+    | (?P<code>[^"'`/]+|/)
+    """, re.X | re.S)
+
+# The code before a literal that makes it a navigation target or a payload
+_CONTEXT_LOOKBEHIND = 64
+_contextRE = re.compile(r"""
+      (?P<navigate>(?:\blocation(?:\s*\.\s*href)?\s*=(?!=)
+        |\blocation\s*\.\s*(?:replace|assign)\s*\(
+        |\bopen\s*\()\s*)
+    | (?P<atob>\batob\s*\(\s*)
+    $""", re.X)
+# Code that joins the literals either side of it
+_concatenationRE = re.compile(r"\s*\+\s*$")
+
+_escapeRE = re.compile(r"\\(?:x([0-9a-fA-F]{2})|u([0-9a-fA-F]{4})|(.))", re.S)
+_escapes = {"n": "\n", "r": "\r", "t": "\t", "b": "\b", "f": "\f",
+        "v": "\v", "0": "\0"}
+
+_absoluteURLRE = re.compile(r"""(?i:https?://)[^\s<>"'`\\]+""")
+_protocolRelativeRE = re.compile(r"//[\w.-]+\.[A-Za-z]{2,}(?:[/?#]\S*)?$")
+
+def _unescape(literal):
+    """Turn the source of a JS string literal into its value."""
+    def _replace(match):
+        (hexCode, unicodeCode, char) = match.groups()
+        if hexCode or unicodeCode:
+            return chr(int(hexCode or unicodeCode, 16))
+        return _escapes.get(char, char)
+    return _escapeRE.sub(_replace, literal[1:-1])
+
+def extractURLs(script, maxBytes=DEFAULT_MAX_BYTES,
+                maxSeconds=DEFAULT_MAX_SECONDS):
+    """
+    Return the URLs in script, in the order found, without repeats.
+
+    :param str script: JavaScript source
+    :param int maxBytes: only this much of the script is scanned
+    :param float maxSeconds: the scan stops after this long
+    """
+    found = dict()  # Ordered set
+    deadline = time.monotonic() + maxSeconds
+    for url in _scan(script[:maxBytes], deadline, 0):
+        found.setdefault(url, None)
+    return list(found)
+
+def _scan(script, deadline, depth):
+    """Yield URLs found in script, until deadline."""
+    chain = []          # Values of literals joined with +
+    chainContext = None
+    code = ""           # The end of the code since the last literal
+    tokenCount = 0
+
+    for match in _tokenRE.finditer(script):
+        tokenCount += 1
+        if (tokenCount % _TOKENS_PER_CLOCK_CHECK == 0 and
+                        time.monotonic() > deadline):
+            break
+        kind = match.lastgroup
+        if kind == "code":
+            code = (code + match.group())[-_CONTEXT_LOOKBEHIND:]
+        elif kind == "string":
+            if not (chain and _concatenationRE.match(code)):
+                if chain:
+                    yield from _classify("".join(chain), chainContext,
+                                    deadline, depth)
+                    chain.clear()
+                context = _contextRE.search(code)
+                chainContext = context.lastgroup if context else None
+            chain.append(_unescape(match.group()))
+            code = ""
+
+    if chain:
+        yield from _classify("".join(chain), chainContext, deadline, depth)
+
+def _classify(value, context, deadline, depth):
+    """Yield the URLs in a string value used in context."""
+    if context == "atob":
+        if depth >= MAX_DECODE_DEPTH:
+            return
+        try:
+            decoded = base64.b64decode(value, validate=False).decode(
+                            "utf-8", "replace")
+        except (binascii.Error, ValueError):
+            return
+        yield from _scan(decoded, deadline, depth + 1)
+        yield from _absoluteURLRE.findall(decoded)
+        return
+
+    value = value.strip()
+    if context == "navigate" and value and not value.startswith(
+                    ("javascript:", "#", "about:")):
+        yield value
+    elif _protocolRelativeRE.match(value):
+        yield value
+    else:
+        yield from _absoluteURLRE.findall(value)
+
+
+
+
+class JSURLScannerTester(unittest.TestCase):
+    def test_literalsAndTargets(self):
+        script = ("var a='http://evil.example/kit.js',b=\"not a url\";"
+                "// 'http://commented.example/'\n"
+                "window.location.href = '/next.php?id=1';"
+                "setTimeout(function(){location.replace(\"../stage2\")},9);"
+                "window.open('//cdn.example/x.html');"
+                "var h='<a href=\"https://inner.example/p\">';")
+        self.assertEqual(extractURLs(script), ["http://evil.example/kit.js",
+                "/next.php?id=1", "../stage2", "//cdn.example/x.html",
+                "https://inner.example/p"])
+
+    def test_concatenationEscapesAndAtob(self):
+        payload = base64.b64encode(
+                b"document.location='http://decoded.example/';").decode()
+        script = ("location = 'http://ev' + \"il.example/\\x3fq=\" + 'a';"
+                "eval(atob('" + payload + "'));")
+        self.assertEqual(extractURLs(script), ["http://evil.example/?q=a",
+                "http://decoded.example/"])
+
+    def test_budget(self):
+        script = ("var u='http://a.example/';" + "x='a';" * 100000 +
+                "u='http://b.example/';")
+        self.assertEqual(extractURLs(script, maxBytes=40),
+                ["http://a.example/"])
+        self.assertEqual(extractURLs(script, maxSeconds=0),
+                ["http://a.example/"])
+        self.assertEqual(extractURLs(script, maxSeconds=60),
+                ["http://a.example/",
+                "http://b.example/"])
+
+
+if __name__ == "__main__":
+    unittest.main()
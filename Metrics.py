@@ -0,0 +1,222 @@
+"""
+Timers and counters for finding where a collection run spends its time.
+
+Metrics are off unless enable() is called.  While off, each instrumented
+call costs one extra function call and a flag check.
+
+Intended use:
+    @Metrics.timed("Database.addURLs")
+    def addURLs(...): ...
+
+    Metrics.enable()
+    with Metrics.SnapshotWriter("metrics.jsonl", interval=60):
+        run_collection()
+"""
+
+import functools
+import inspect
+import json
+import threading
+import time
+import unittest
+
+enabled = False
+
+_lock = threading.Lock()
+_timers = dict()    # name: [calls, total seconds, longest seconds]
+_counters = dict()  # name: count
+_started = time.time()
+
+def enable(on=True):
+    """Turn metrics collection on, or off."""
+    global enabled
+    enabled = on
+
+def reset():
+    """Forget everything collected so far."""
+    global _started
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+        _started = time.time()
+
+def count(name, amount=1):
+    """Add amount to the counter name."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def _record(name, seconds):
+    with _lock:
+        timer = _timers.get(name)
+        if timer is None:
+            _timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            if seconds > timer[2]:
+                timer[2] = seconds
+
+class _Timer():
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _record(self.name, time.perf_counter() - self.start)
+
+class _NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_nullTimer = _NullTimer()
+
+def timer(name):
+    """Return a context manager that times its block under name."""
+    return _Timer(name) if enabled else _nullTimer
+
+def _timeIterations(name, iterator):
+    """Yield from iterator, timing the production of each item."""
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            _record(name, time.perf_counter() - start)
+            yield item
+    finally:
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+def timed(name=None):
+    """
+    Decorate a function so each call is timed under name, by default the
+    function's qualified name.  For generator functions the time taken to
+    produce each item is recorded instead.
+    """
+    def _decorator(function):
+        timerName = name or function.__qualname__
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def _wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                if not enabled:
+                    return generator
+                return _timeIterations(timerName, generator)
+        else:
+            @functools.wraps(function)
+            def _wrapper(*args, **kwargs):
+                if not enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    _record(timerName, time.perf_counter() - start)
+        return _wrapper
+    return _decorator
+
+def snapshot():
+    """
+    Return value: a JSON-ready dict of every timer and counter so far
+    """
+    with _lock:
+        timers = {name: {"calls": calls, "seconds": total,
+                        "mean_ms": 1000 * total / calls,
+                        "max_ms": 1000 * longest}
+                for (name, (calls, total, longest)) in _timers.items()}
+        counters = dict(_counters)
+    return {"time": time.time(), "elapsed": time.time() - _started,
+            "timers": timers, "counters": counters}
+
+
+class SnapshotWriter():
+    """
+    Write metrics to a file as JSON lines: a snapshot every interval seconds
+    while in use, if interval is given, then a summary on exit.
+
+    :param str path: the file to write
+    :param float interval: seconds between snapshots, or None for none
+    """
+    def __init__(self, path, interval=None):
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+
+    def _write(self, kind):
+        line = json.dumps(dict(snapshot(), type=kind), sort_keys=True)
+        self._file.write(line + "\n")
+        self._file.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._write("snapshot")
+
+    def __enter__(self):
+        self._file = open(self.path, "w")
+        if self.interval:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write("summary")
+        self._file.close()
+
+
+
+
+class MetricsTester(unittest.TestCase):
+    def setUp(self):
+        reset()
+
+    def tearDown(self):
+        enable(False)
+        reset()
+
+    def test_offCollectsNothing(self):
+        @timed("f")
+        def f(): return 1
+        with timer("block"):
+            f()
+        count("things")
+        self.assertEqual(snapshot()["timers"], {})
+        self.assertEqual(snapshot()["counters"], {})
+
+    def test_timersAndCounters(self):
+        enable()
+        @timed()
+        def f(): return 1
+        @timed("gen")
+        def gen():
+            yield 1
+            yield 2
+        self.assertEqual(f(), 1)
+        self.assertEqual(list(gen()), [1, 2])
+        with timer("block"):
+            count("things", 3)
+        result = snapshot()
+        self.assertEqual(result["timers"][f.__qualname__]["calls"], 1)
+        self.assertEqual(result["timers"]["gen"]["calls"], 2)
+        self.assertEqual(result["timers"]["block"]["calls"], 1)
+        self.assertEqual(result["counters"], {"things": 3})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Parse raw emails on every core, and read them out of mail archives.
+
+ordered_parse sends raw RFC822 messages to a process pool in batches and
+yields ContentHandlers.ParsedEmailData back in the order the messages came
+in, so a single database writer can store them.  At most a few batches per
+worker are in flight, so a fast reader can't fill memory.
+
+mbox_messages and maildir_messages read archives as (position, raw bytes),
+where position is what to resume the archive from once that message is
+stored: a byte offset for mbox files, and for Maildirs a message's
+modification time and key, as "<mtime ns>/<key>".
+
+Intended use:
+    for (position, parsed) in ordered_parse(mbox_messages("spam.mbox")):
+        store(parsed)
+"""
+
+import collections
+import concurrent.futures as futures
+import mmap
+import os
+import re
+import tempfile
+import unittest
+
+import ContentHandlers as ch
+from Common import print_error
+
+DEFAULT_BATCH_SIZE = 64
+BATCHES_PER_WORKER = 2
+
+_fromLineRE = re.compile(rb"^From ", re.M)
+_escapedFromRE = re.compile(rb"^>(>*From )", re.M)
+
+def parse_email(raw):
+    """
+    Parse one raw email.
+
+    :returns: ParsedEmailData, or None if the email couldn't be parsed
+    """
+    try:
+        return ch.ParsedEmailData.fromEmailData(ch.EmailData(raw))
+    except Exception as err:
+        print_error("Error parsing email:", repr(err))
+        return None
+
+def parse_emails(rawList):
+    """parse_email for each of a batch of raw emails, in a worker process"""
+    return [parse_email(raw) for raw in rawList]
+
+def _batches(items, size):
+    """Yield lists of up to size items from the iterable items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def ordered_parse(messages, workers=None, batchSize=DEFAULT_BATCH_SIZE,
+                executor=None):
+    """
+    Parse raw emails in a process pool, in order.
+
+    :param iterable messages: (key, raw bytes) pairs
+    :param int workers: processes to parse with.  Default: one per core.
+        0 parses in this process instead.
+    :param int batchSize: messages sent to a worker at once
+    :param executor: a concurrent.futures executor to use instead of
+        starting a process pool
+
+    Yield value: (key, ParsedEmailData or None), in the order of messages
+    """
+    if workers == 0 and executor is None:
+        for (key, raw) in messages:
+            yield (key, parse_email(raw))
+        return
+
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = futures.ProcessPoolExecutor(workers)
+    window = BATCHES_PER_WORKER * (workers or os.cpu_count() or 1)
+    pending = collections.deque()   # (keys, future), oldest first
+    try:
+        for batch in _batches(messages, batchSize):
+            keys = [key for (key, _) in batch]
+            pending.append((keys, executor.submit(parse_emails,
+                            [raw for (_, raw) in batch])))
+            while len(pending) >= window:
+                yield from _collect(pending.popleft())
+        while pending:
+            yield from _collect(pending.popleft())
+    finally:
+        for (_, future) in pending:
+            future.cancel()
+        if ownExecutor:
+            executor.shutdown()
+
+def _collect(batch):
+    (keys, future) = batch
+    return zip(keys, future.result())
+
+def mbox_messages(path, resumeFrom=0):
+    """
+    Read the messages of an mbox file, memory-mapped.
+
+    :param int resumeFrom: the byte offset to start at, from a previous
+        import.  It must be the start of a message.
+
+    Yield value: (byte offset just past the message, raw bytes)
+    """
+    with open(path, "rb") as mboxFile:
+        if os.fstat(mboxFile.fileno()).st_size == 0:
+            return
+        with mmap.mmap(mboxFile.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = resumeFrom
+            if data[start:start + 5] != b"From ":
+                match = _fromLineRE.search(data, start)
+                start = match.start() if match else len(data)
+            while start < len(data):
+                # Skip the "From " separator line
+                bodyStart = data.find(b"\n", start) + 1 or len(data)
+                match = _fromLineRE.search(data, bodyStart)
+                end = match.start() if match else len(data)
+                raw = data[bodyStart:end]
+                if b">" in raw:
+                    raw = _escapedFromRE.sub(rb"\1", raw)
+                yield (end, raw)
+                start = end
+
+def _maildirKey(filename):
+    """A Maildir message's unique key, without the flags after ":" """
+    return filename.partition(":")[0]
+
+def _maildirPosition(position):
+    """
+    Split a Maildir resume point into (mtime ns, key).  A bare key, as
+    earlier imports recorded, has an mtime of None.
+    """
+    (mtime, slash, key) = position.partition("/")
+    if not slash:
+        return (None, position)
+    return (int(mtime), key)
+
+def maildir_messages(path, resumeFrom=None):
+    """
+    Read the messages of a Maildir in arrival order: by modification time,
+    then key.  Delivery sets a message's modification time, and moving it
+    between new and cur or changing its flags keeps it.
+
+    :param str resumeFrom: the position of the last message stored by a
+        previous import.  It and every message before it are skipped.  A
+        bare key skips the messages with a lower key instead.
+
+    Yield value: ("<mtime ns>/<key>", raw bytes)
+    """
+    files = []
+    for subdir in ("new", "cur"):
+        directory = os.path.join(path, subdir)
+        if not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime_ns
+                except FileNotFoundError:
+                    continue
+                files.append((mtime, _maildirKey(entry.name), entry.path))
+    files.sort()
+
+    (resumeTime, resumeKey) = (None, None)
+    if resumeFrom is not None:
+        (resumeTime, resumeKey) = _maildirPosition(resumeFrom)
+    for (mtime, key, filePath) in files:
+        if resumeKey is not None and (key <= resumeKey if resumeTime is None
+                else (mtime, key) <= (resumeTime, resumeKey)):
+            continue
+        try:
+            with open(filePath, "rb") as messageFile:
+                raw = messageFile.read()
+        except FileNotFoundError:   # Moved or deleted since it was listed
+            continue
+        yield ("{}/{}".format(mtime, key), raw)
+
+
+
+
+class ParsePipelineTester(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def message(num):
+        return ("From: a{0}@example.com\nTo: b@example.com\n\n"
+                "Go to http://x{0}.example/\n>From here on\n").format(
+                num).encode("ascii")
+
+    start = 1500000000
+
+    def deliver(self, num, key, seconds):
+        """Deliver message num as key, seconds after start"""
+        subdir = os.path.join(self.tmpdir.name, "cur" if num % 2 else "new")
+        os.makedirs(subdir, exist_ok=True)
+        path = os.path.join(subdir, "{}:2,S".format(key))
+        with open(path, "wb") as messageFile:
+            messageFile.write(self.message(num))
+        os.utime(path, ns=((self.start + seconds) * 10 ** 9,) * 2)
+
+    def test_mbox(self):
+        path = os.path.join(self.tmpdir.name, "test.mbox")
+        with open(path, "wb") as mboxFile:
+            for num in range(3):
+                mboxFile.write(b"From MAILER-DAEMON Thu Jan  1 00:00:00 1970\n"
+                        + self.message(num).replace(b">From", b">>From")
+                        + b"\n")
+        messages = list(mbox_messages(path))
+        self.assertEqual([raw for (_, raw) in messages],
+                [self.message(num) + b"\n" for num in range(3)])
+        resumed = list(mbox_messages(path, messages[0][0]))
+        self.assertEqual(resumed, messages[1:])
+
+    def test_maildirParsedInOrder(self):
+        # Keys out of arrival order, as with keys from different hosts
+        for (num, key) in enumerate(["9.M1.b", "1.M1.c", "5.M1.a"]):
+            self.deliver(num, key, num)
+        messages = list(maildir_messages(self.tmpdir.name))
+        self.assertEqual([position.partition("/")[2]
+                for (position, _) in messages], ["9.M1.b", "1.M1.c", "5.M1.a"])
+        self.assertEqual(messages[1][0], "{}/1.M1.c".format(
+                (self.start + 1) * 10 ** 9))
+
+        # Mail arriving later is read on resuming, whatever its key
+        self.deliver(3, "0.M1.d", 3)
+        self.deliver(4, "7.M1.d", 4)
+        messages = maildir_messages(self.tmpdir.name,
+                resumeFrom=messages[0][0])
+        with futures.ThreadPoolExecutor(2) as executor:
+            parsed = list(ordered_parse(messages, batchSize=2,
+                            executor=executor))
+        self.assertEqual([position.partition("/")[2]
+                for (position, _) in parsed],
+                ["1.M1.c", "5.M1.a", "0.M1.d", "7.M1.d"])
+        self.assertEqual([email.urlList for (_, email) in parsed],
+                [["http://x{}.example/".format(num)] for num in range(1, 5)])
+        self.assertEqual(parsed[0][1].fromAddress, "a1@example.com")
+
+        # A bare key from an earlier import still resumes by key
+        self.assertEqual([position.partition("/")[2] for (position, _) in
+                maildir_messages(self.tmpdir.name, resumeFrom="5.M1.a")],
+                ["9.M1.b", "7.M1.d"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+An on-disk cache of HTTP responses, keyed by URL and User-Agent.
+
+Fresh entries are served without touching the network.  Stale entries with
+an ETag or Last-Modified header are revalidated with a conditional request.
+The least recently used entries are evicted once the cache outgrows its
+size limit.  In replay mode the network is never used, so analysts can
+rebuild ContentHandlers.WebData objects from an earlier crawl offline.
+
+Intended use:
+    cache = ResponseCache("malmail-cache.db")
+    with cache.urlopen(request, timeout=2) as response:
+        ContentHandlers.WebData(response, request)
+"""
+
+import contextlib
+import email.message
+import io
+import json
+import re
+import sqlite3
+import threading
+import time
+import unittest
+import urllib.error as urlErr
+import urllib.request as urlReq
+
+import ContentHandlers as ch
+
+DEFAULT_CACHE_PATH = "malmail-cache.db"
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+
+_maxAgeRE = re.compile(r"max-age=(\d+)")
+
+class NotCached(urlErr.URLError):
+    """Raised in replay mode for responses that aren't in the cache"""
+
+
+class CachedResponse(io.BytesIO):
+    """A response read from the cache, usable wherever an HTTPResponse is"""
+    def __init__(self, status, headers, body, url=None):
+        """
+                headers: [(name, value), ...]
+                """
+        super().__init__(body)
+        self.status = status
+        self.headers = email.message.Message()
+        for (name, value) in headers:
+            self.headers[name] = value
+        self.url = url
+
+    def getheader(self, name, default=None):
+        values = self.headers.get_all(name)
+        return ", ".join(values) if values else default
+
+
+class ResponseCache():
+    """
+    :param str path: the cache database file
+    :param float ttl: seconds a response stays fresh, unless the response's
+            Cache-Control max-age is shorter
+    :param int maxBytes: the total body size the cache may hold
+    :param bool replayOnly: serve only from the cache, never the network
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=DEFAULT_TTL,
+                    maxBytes=DEFAULT_MAX_BYTES, replayOnly=False,
+                    clock=time.time):
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.replayOnly = replayOnly
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=wal")
+            self._db.execute("CREATE TABLE IF NOT EXISTS response ("
+                    "url TEXT, userAgent TEXT, status INTEGER, headers TEXT, "
+                    "body BLOB, size INTEGER, expires REAL, lastUsed REAL, "
+                    "PRIMARY KEY (url, userAgent))")
+            self._db.execute("CREATE INDEX IF NOT EXISTS response_lastUsed "
+                    "ON response (lastUsed)")
+        (self._totalBytes,) = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM response").fetchone()
+
+    def close(self):
+        self._db.close()
+
+    @contextlib.contextmanager
+    def urlopen(self, request, timeout=None, opener=urlReq.urlopen):
+        """
+        Answer a urllib.request.Request from the cache if possible, otherwise
+        with opener, storing the answer.
+
+        Yield value: a CachedResponse
+        """
+        key = (request.full_url, request.get_header("User-agent", ""))
+        entry = self._lookup(key)
+        now = self.clock()
+
+        if entry is not None and (self.replayOnly or entry["expires"] > now):
+            yield self._response(entry, request)
+            return
+        if self.replayOnly:
+            raise NotCached("not in the response cache: {}".format(key[0]))
+
+        headers = dict(request.header_items())
+        if entry is not None:
+            cached = self._response(entry, request)
+            if cached.getheader("ETag"):
+                headers["If-None-Match"] = cached.getheader("ETag")
+            if cached.getheader("Last-Modified"):
+                headers["If-Modified-Since"] = cached.getheader("Last-Modified")
+        conditional = urlReq.Request(request.full_url, data=request.data,
+                        headers=headers, method=request.get_method())
+
+        try:
+            with opener(conditional, timeout=timeout) as response:
+                contentType = response.getheader("Content-Type")
+                if contentType is not None:
+                    contentType = contentType.partition(";")[0].strip().lower()
+                limit = ch.bodySizeLimit(contentType)
+                body = self._read(response, limit + 1)
+                status = getattr(response, "status", 200)
+                responseHeaders = list(response.headers.items())
+        except urlErr.HTTPError as err:
+            if err.code != 304 or entry is None:
+                raise
+            self._touch(key, self._expires(err.headers.get("Cache-Control"),
+                            now))
+            yield self._response(entry, request)
+            return
+
+        # A body cut at the limit keeps its extra byte, so WebData still sees
+        # it was truncated.  Only logged types are cached truncated, since
+        # that prefix is all WebData ever reads of them.
+        response = CachedResponse(status, responseHeaders, body,
+                        request.full_url)
+        cacheControl = response.getheader("Cache-Control", "").lower()
+        if ((len(body) <= limit or limit < ch.DEFAULT_MAX_BODY_SIZE) and
+                        "no-store" not in cacheControl):
+            self._store(key, status, responseHeaders, response.getvalue(),
+                            self._expires(cacheControl, now))
+        yield response
+
+    @staticmethod
+    def _read(response, size):
+        """Read at most size bytes of response, a chunk at a time"""
+        chunks = []
+        while size > 0:
+            chunk = response.read(min(ch.READ_CHUNK_SIZE, size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def _expires(self, cacheControl, now):
+        """The time a response stops being fresh, given its Cache-Control"""
+        match = _maxAgeRE.search(cacheControl or "")
+        ttl = self.ttl if match is None else min(self.ttl, int(match.group(1)))
+        return now + ttl
+
+    def _response(self, entry, request):
+        return CachedResponse(entry["status"], json.loads(entry["headers"]),
+                        entry["body"], request.full_url)
+
+    def _lookup(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT status, headers, body, expires "
+                    "FROM response WHERE url = ? AND userAgent = ?",
+                    key).fetchone()
+            if row is None:
+                return None
+            with self._db:
+                self._db.execute("UPDATE response SET lastUsed = ? "
+                        "WHERE url = ? AND userAgent = ?", (self.clock(),) + key)
+        return dict(zip(("status", "headers", "body", "expires"), row))
+
+    def _touch(self, key, expires):
+        with self._lock, self._db:
+            self._db.execute("UPDATE response SET expires = ?, lastUsed = ? "
+                    "WHERE url = ? AND userAgent = ?",
+                    (expires, self.clock()) + key)
+
+    def _store(self, key, status, headers, body, expires):
+        with self._lock, self._db:
+            old = self._db.execute("SELECT size FROM response "
+                    "WHERE url = ? AND userAgent = ?", key).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO response VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?)", key + (status,
+                    json.dumps(headers), body, len(body), expires,
+                    self.clock()))
+            self._totalBytes += len(body) - (old[0] if old else 0)
+            if self._totalBytes > self.maxBytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop the least recently used entries until under maxBytes"""
+        rows = self._db.execute("SELECT url, userAgent, size FROM response "
+                "ORDER BY lastUsed")
+        doomed = []
+        for (url, userAgent, size) in rows:
+            if self._totalBytes <= self.maxBytes:
+                break
+            doomed.append((url, userAgent))
+            self._totalBytes -= size
+        self._db.executemany(
+                "DELETE FROM response WHERE url = ? AND userAgent = ?", doomed)
+
+
+
+class ResponseCacheTester(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.requests = []
+        self.cache = ResponseCache(":memory:", ttl=60, maxBytes=100,
+                        clock=lambda: self.now)
+
+    def tearDown(self):
+        self.cache.close()
+
+    def opener(self, status=200, headers=(("ETag", '"v1"'),), body=b"<p>hi</p>"):
+        @contextlib.contextmanager
+        def _open(request, timeout=None):
+            self.requests.append(request)
+            if status != 200:
+                raise urlErr.HTTPError(request.full_url, status, "",
+                                dict(headers), None)
+            self.response = CachedResponse(status, list(headers), body)
+            yield self.response
+        return _open
+
+    def fetch(self, opener, url="http://example.com/", agent="agent"):
+        request = urlReq.Request(url, headers={"User-Agent": agent})
+        with self.cache.urlopen(request, opener=opener) as response:
+            return ch.WebData(response, request).body()
+
+    def test_freshEntriesSkipTheNetwork(self):
+        self.assertEqual(self.fetch(self.opener()), "<p>hi</p>")
+        self.assertEqual(self.fetch(self.opener(body=b"new")), "<p>hi</p>")
+        self.assertEqual(len(self.requests), 1)
+        # Keyed by user agent too
+        self.assertEqual(self.fetch(self.opener(body=b"new"), agent="b"), "new")
+
+    def test_staleEntriesRevalidate(self):
+        self.fetch(self.opener())
+        self.now += 61
+        self.assertEqual(self.fetch(self.opener(status=304)), "<p>hi</p>")
+        self.assertEqual(self.requests[-1].get_header("If-none-match"), '"v1"')
+        self.now += 30
+        self.fetch(self.opener(body=b"unused"))
+        self.assertEqual(len(self.requests), 2)
+
+    def test_evictsLeastRecentlyUsed(self):
+        for num in range(3):
+            self.now += 1
+            self.fetch(self.opener(body=b"x" * 40), "http://example.com/{}"
+                            .format(num))
+        self.cache.replayOnly = True
+        self.assertRaises(NotCached, self.fetch, None, "http://example.com/0")
+        self.assertEqual(self.fetch(None, "http://example.com/2"), "x" * 40)
+
+    def test_loggedTypesStopEarly(self):
+        self.cache.maxBytes = ch.DEFAULT_MAX_BODY_SIZE
+        body = b"x" * (ch.LOGGED_BODY_SIZE * 4)
+        opener = self.opener(headers=(("Content-Type", "image/png"),),
+                        body=body)
+        self.assertEqual(len(self.fetch(opener)), ch.LOGGED_BODY_SIZE)
+        self.assertEqual(self.response.tell(), ch.LOGGED_BODY_SIZE + 1)
+        # Replay sees the same truncated body
+        self.cache.replayOnly = True
+        request = urlReq.Request("http://example.com/",
+                        headers={"User-Agent": "agent"})
+        with self.cache.urlopen(request) as response:
+            webData = ch.WebData(response, request)
+        self.assertTrue(webData.truncated)
+        self.assertEqual(len(webData.body()), ch.LOGGED_BODY_SIZE)
+
+        # Parsed types are read up to the full limit
+        self.cache.replayOnly = False
+        body = b"x" * (ch.LOGGED_BODY_SIZE * 4)
+        self.fetch(self.opener(headers=(("Content-Type", "text/plain"),),
+                        body=body), "http://example.com/text")
+        self.assertEqual(self.response.tell(), len(body))
+
+
+if __name__ == "__main__":
+    unittest.main()
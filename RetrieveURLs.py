@@ -2,14 +2,27 @@
 
 import argparse
 from collections import defaultdict
+import concurrent.futures as futures
+import contextlib
+import functools
+import io
 import tempfile
 import os.path
+import socket
+import threading
+import time
+import unittest
 import urllib.request as urlReq
 import urllib.error as urlErr
+import urllib.parse as urlParse
 import sys
 
 import ContentHandlers as ch
 from Common import *
+from ConnectionPool import ConnectionPool
+from DatabaseOperations import domain
+import Metrics
+from ResponseCache import CachedResponse, ResponseCache
 
 userAgents = [
                 # Chrome - OS X
@@ -32,6 +45,9 @@ userAgents = [
                 "Mozilla/4.0 (compatible;MSIE 5.5; Windows 98)"
 ]
 
+# The most requests sent to one host at once when fetching concurrently
+DEFAULT_MAX_PER_HOST = 4
+
 class URLContentsListEntry():
     """Store user agents and contents"""
     def __init__(self, userAgents=None, contents=None):
@@ -39,48 +55,258 @@ class URLContentsListEntry():
                 # A list of user agents that produced these contents
         self.contents = contents # The specific contents
 
-def retrieveURLWithEachUserAgent(url, userAgents=userAgents, timeout=2):
+# How retrieving a URL went, as URLContentsList.outcome
+RETRIEVED = "retrieved" # Some agent got contents
+SKIPPED = "skipped"     # Its host recently failed, so nothing was requested
+GONE = "gone"           # It's invalid, or every agent got a definitive error
+FAILED = "failed"       # Nothing was retrieved, but a retry may succeed
+
+class URLContentsList(list):
+    """A list of URLContentsListEntry, and how retrieving them went"""
+    def __init__(self, entries=(), outcome=RETRIEVED):
+        super().__init__(entries)
+        self.outcome = outcome
+
+def _isDefinitive(code):
+    """Whether an HTTP error code would be the same on a later retry"""
+    return 400 <= code < 500 and code not in (408, 425, 429)
+
+class HostLimiter():
+    """
+    Caps how many requests may be sent to any one host at the same time.
+
+    Share one instance between everything fetching concurrently so the cap
+    holds across URLs, not just across the user agents of a single URL.
+    """
+    def __init__(self, maxPerHost=DEFAULT_MAX_PER_HOST):
+        self.maxPerHost = maxPerHost
+        self._lock = threading.Lock()
+        self._semaphores = dict()
+
+    def forURL(self, url):
+        """Return the semaphore guarding the host of url."""
+        host = urlParse.urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(
+                                self.maxPerHost)
+            return self._semaphores[host]
+
+# Seconds a host that failed at the network level is skipped for
+DEFAULT_FAILURE_TTL = 15 * 60
+
+def _hostFailureReason(err):
+    """
+    Return value: why err means the whole host is unreachable, or None if
+            it doesn't
+    """
+    if isinstance(err, urlErr.HTTPError):
+        return None
+    if isinstance(err, urlErr.URLError):
+        err = err.reason
+    if isinstance(err, socket.gaierror):
+        return "DNS failure"
+    if isinstance(err, ConnectionRefusedError):
+        return "connection refused"
+    if isinstance(err, (socket.timeout, TimeoutError)):
+        return "timeout"
+    return None
+
+class HostFailureCache():
+    """
+    Remembers hosts that recently failed with a DNS failure, a refused
+    connection or a timeout, so their other URLs can be skipped for a while
+    instead of each paying the same timeout.
+
+    Hosts are keyed by DatabaseOperations.domain, like Domain rows.
+    """
+    def __init__(self, ttl=DEFAULT_FAILURE_TTL, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._failures = dict() # domain: (reason, time it expires)
+
+    def failure(self, url):
+        """Return why url's host is being skipped, or None if it isn't"""
+        key = domain(url)
+        with self._lock:
+            entry = self._failures.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= self.clock():
+                del self._failures[key]
+                return None
+            return entry[0]
+
+    def record(self, url, reason):
+        """Skip url's host for the next ttl seconds"""
+        with self._lock:
+            self._failures[domain(url)] = (reason, self.clock() + self.ttl)
+
+    def entries(self):
+        """Return {domain: (reason, expiry time)} for unexpired failures"""
+        now = self.clock()
+        with self._lock:
+            return {key: entry for (key, entry) in self._failures.items()
+                    if entry[1] > now}
+
+    def load(self, entries):
+        """Add {domain: (reason, expiry time)} entries, as from entries()"""
+        with self._lock:
+            self._failures.update(entries)
+
+hostLimiter = HostLimiter()
+connectionPool = ConnectionPool()
+hostFailureCache = HostFailureCache()
+
+def _opener(pool, cache):
+    """Return a function like urllib.request.urlopen that sends requests
+    through cache, then pool, whichever are not None"""
+    opener = urlReq.urlopen if pool is None else pool.urlopen
+    if cache is not None:
+        opener = functools.partial(cache.urlopen, opener=opener)
+    return opener
+
+def _retrieveURL(url, userAgent, timeout, opener):
+    """Retrieve url once, as userAgent.  Return a ContentHandlers.WebData"""
+    request = urlReq.Request(url, headers={"User-Agent": userAgent})
+    with opener(request, timeout=timeout) as connection:
+        return ch.WebData(connection, request)
+
+def _recordHostFailure(hostFailures, url, err):
+    """Record url's host in hostFailures if err means it's unreachable"""
+    reason = _hostFailureReason(err)
+    if reason is not None and hostFailures is not None:
+        hostFailures.record(url, reason)
+
+def _retrieveURLReportingErrors(url, userAgent, timeout, opener,
+                hostFailures=None):
+    """Retrieve url as userAgent, printing any error.  Errors that mean
+            the host is unreachable are recorded in hostFailures.
+
+            Return value: (WebData or None, outcome, stop) - outcome is
+                    RETRIEVED, GONE or FAILED.  stop is True when the error
+                    would happen for any agent, so the others needn't be tried
+            """
+    try:
+        return (_retrieveURL(url, userAgent, timeout, opener), RETRIEVED,
+                        False)
+    except urlErr.HTTPError as err:
+        print_error("HTTP error retrieving URL:", url, "Agent:", userAgent,
+                        "Code:", err.code, "Reason:", err.reason)
+        return (None, GONE if _isDefinitive(err.code) else FAILED, False)
+    except urlErr.URLError as err:
+        _recordHostFailure(hostFailures, url, err)
+        if ((type(err.reason) is str) and
+                        err.reason.startswith("unknown url type")):
+            print_error("Invalid URL:", url, "Reason:", err.reason)
+            return (None, GONE, True)
+        print_error("URL error retrieving URL:", url, "Agent:", userAgent,
+                        "Reason:", err.reason)
+        return (None, FAILED, True) # URLErrors are regardless of agent
+    except (socket.timeout, TimeoutError) as err: # Timed out reading
+        _recordHostFailure(hostFailures, url, err)
+        print_error("Timeout retrieving URL:", url, "Agent:", userAgent)
+        return (None, FAILED, True)
+    except Exception as err:
+        print_error("Unknown error retrieving URL:", url, "Agent:", userAgent,
+                        "Exception:", err)
+    return (None, FAILED, False)
+
+@Metrics.timed()
+def retrieveURLWithEachUserAgent(url, userAgents=userAgents, timeout=2,
+                concurrent=True, limiter=None, pool=connectionPool,
+                cache=None, hostFailures=hostFailureCache):
     """Retrieve the contents of the URL with all user agents.
 
             url: a url string
             userAgents: a list of User Agent strings.  Defaults to the built-in list
+            timeout: seconds to wait on each request
+            concurrent: send the requests for each agent in parallel
+            limiter: a HostLimiter capping parallel requests per host.
+                    Defaults to the module-wide hostLimiter
+            pool: the ConnectionPool to send requests through.  Defaults to
+                    the module-wide connectionPool.  None uses plain urllib.
+            cache: a ResponseCache to answer from and store to, if any
+            hostFailures: a HostFailureCache of hosts to skip, which
+                    network failures are recorded in.  Defaults to the
+                    module-wide hostFailureCache.  None disables it.
 
-            Return value: [URLContentsListEntry, URLContentsListEntry, ...]
+            Return value: a URLContentsList of URLContentsListEntry.  Its
+                    outcome tells a skipped host, or an error a retry won't
+                    fix, from one it might.
             """
-    def _retrieveURL(userAgent):
-        request = urlReq.Request(url, headers={"User-Agent": userAgent})
-        with urlReq.urlopen(request, timeout=timeout) as connection:
-            return ch.WebData(connection, request)
-
     try: # Detect an invalid URL early
         urlReq.Request(url)
     except ValueError as err:
         print_error("Invalid URL:", url, "Exception:", err)
-        return []
+        return URLContentsList(outcome=GONE)
+
+    reason = None if hostFailures is None else hostFailures.failure(url)
+    if reason is not None:
+        print_error("Skipping URL:", url, "Host recently failed:", reason)
+        Metrics.count("retrieveURLWithEachUserAgent.skippedHosts")
+        return URLContentsList(outcome=SKIPPED)
+
+    opener = _opener(pool, cache)
+    if concurrent:
+        (results, stopped) = _retrieveConcurrently(url, userAgents, timeout,
+                        opener, hostLimiter if limiter is None else limiter,
+                        hostFailures)
+    else:
+        (results, stopped) = _retrieveSequentially(url, userAgents, timeout,
+                        opener, hostFailures)
+    if stopped is not None:
+        # Some agent hit a URLError, so drop everything
+        return URLContentsList(outcome=stopped)
 
     responses = defaultdict(list)
-    for uA in userAgents:
-        try:
-            response = _retrieveURL(uA)
-        except urlErr.HTTPError as err:
-            print_error("HTTP error retrieving URL:", url, "Agent:", uA,
-                            "Code:", err.code, "Reason:", err.reason)
-        except urlErr.URLError as err:
-            if ((type(err.reason) is str) and
-                            err.reason.startswith("unknown url type")):
-                print_error("Invalid URL:", url, "Reason:", err.reason)
-            else:
-                print_error("URL error retrieving URL:", url, "Agent:", uA,
-                                "Reason:", err.reason)
-            return [] # URLErrors are regardless of agent, so don't try other agents
-        except Exception as err:
-            print_error("Unknown error retrieving URL:", url, "Agent:", uA,
-                            "Exception:", err)
-        else:
+    for (uA, (response, _)) in zip(userAgents, results):
+        if response is not None:
             responses[response].append(uA)
+    if responses:
+        outcome = RETRIEVED
+    elif results and all(outcome == GONE for (_, outcome) in results):
+        outcome = GONE
+    else:
+        outcome = FAILED
+
+    return URLContentsList((URLContentsListEntry(userAgents=agents,
+                    contents=response)
+                    for (response, agents) in responses.items()), outcome)
+
+def _retrieveSequentially(url, userAgents, timeout, opener, hostFailures):
+    """Return ([(response or None, outcome) per agent], None), or
+            (results so far, outcome) once an error stops the others"""
+    results = []
+    for uA in userAgents:
+        (response, outcome, stop) = _retrieveURLReportingErrors(url, uA,
+                        timeout, opener, hostFailures)
+        if stop:
+            return (results, outcome)
+        results.append((response, outcome))
+    return (results, None)
+
+def _retrieveConcurrently(url, userAgents, timeout, opener, limiter,
+                hostFailures):
+    """Like _retrieveSequentially, but with the agents fetched in parallel."""
+    stopped = []    # The outcome of the first error to stop the others
+    semaphore = limiter.forURL(url)
+
+    def _fetch(uA):
+        with semaphore:
+            if stopped:
+                return (None, None)
+            (response, outcome, stop) = _retrieveURLReportingErrors(url, uA,
+                            timeout, opener, hostFailures)
+            if stop:
+                stopped.append(outcome)
+            return (response, outcome)
 
-    return [URLContentsListEntry(userAgents=agents, contents=response)
-                    for (response, agents) in responses.items()]
+    workers = max(1, min(len(userAgents), limiter.maxPerHost))
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(_fetch, userAgents))
+    return (results, stopped[0] if stopped else None)
 
 def outputURLContentsList(contentsList, basepath):
     """Output a set of URL contents to files in a directory.
@@ -110,11 +336,19 @@ def main():
                     description="Retrieve URL contents with multiple User Agent strings.")
     parser.add_argument("-d", "--dir", default="./",
                     help="The directory to store output in.")
+    parser.add_argument("-c", "--cache", metavar="PATH",
+                    help="Answer from, and store to, this response cache.")
+    parser.add_argument("-r", "--replay", action="store_true",
+                    help="Only answer from the cache, never the network.")
     parser.add_argument("URL", help="The URL to retrieve.")
 
     args = parser.parse_args()
     outputDir = os.path.abspath(args.dir)
     url = args.URL
+    if args.replay and not args.cache:
+        parser.error("--replay requires --cache")
+    cache = None if args.cache is None else ResponseCache(args.cache,
+                    replayOnly=args.replay)
 
     if os.path.exists(outputDir) and not os.path.isdir(outputDir):
         print("Output directory file exists but is not a directory:",
@@ -123,7 +357,113 @@ def main():
     elif not os.path.isdir(outputDir):
         os.mkdir(outputDir)
 
-    outputURLContentsList(retrieveURLWithEachUserAgent(url), outputDir)
+    outputURLContentsList(retrieveURLWithEachUserAgent(url, cache=cache),
+                    outputDir)
+
+
+
+
+
+class ConcurrentRetrievalTester(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.inFlight = 0
+        self.mostInFlight = 0
+        self.requests = []
+
+    def opener(self, error=None, delay=0.05):
+        """An opener that records how many requests it has open at once"""
+        @contextlib.contextmanager
+        def _open(request, timeout=None):
+            with self.lock:
+                self.requests.append(request)
+                self.inFlight += 1
+                self.mostInFlight = max(self.mostInFlight, self.inFlight)
+            try:
+                time.sleep(delay)
+                if error is not None:
+                    raise error
+                yield CachedResponse(200, [("Content-Type", "text/html")],
+                                request.get_header("User-agent").encode())
+            finally:
+                with self.lock:
+                    self.inFlight -= 1
+        return _open
+
+    def test_resultsInAgentOrder(self):
+        from StandInServers import StandInHTTPServer
+        (results, stopped) = _retrieveConcurrently("http://a.example/",
+                        userAgents, 2, self.opener(), HostLimiter(3), None)
+        self.assertIsNone(stopped)
+        self.assertEqual([result.body() for (result, _) in results],
+                        userAgents)
+        self.assertEqual(self.mostInFlight, 3)
+
+        with StandInHTTPServer({"/": b"<p>same</p>"}) as server:
+            (entry,) = retrieveURLWithEachUserAgent(server.url(),
+                            limiter=HostLimiter(3), pool=ConnectionPool())
+        self.assertEqual(entry.userAgents, userAgents)
+        self.assertEqual(entry.contents.body(), "<p>same</p>")
+
+    def test_outcomes(self):
+        from StandInServers import StandInHTTPServer
+        pages = {"/": b"<p>hi</p>", "/busy": (503, {}, b"busy"),
+                "/limited": (429, {}, b"slow down")}
+        with StandInHTTPServer(pages) as server, \
+                        contextlib.redirect_stderr(io.StringIO()):
+            for (path, outcome) in (("/", RETRIEVED), ("/missing", GONE),
+                            ("/busy", FAILED), ("/limited", FAILED)):
+                self.assertEqual(retrieveURLWithEachUserAgent(
+                                server.url(path), pool=ConnectionPool(),
+                                hostFailures=None).outcome, outcome)
+            for url in ("not a url", "nonsense://a.example/"):
+                self.assertEqual(retrieveURLWithEachUserAgent(url,
+                                hostFailures=None).outcome, GONE)
+
+    def test_limiterSharedAcrossURLs(self):
+        limiter = HostLimiter(2)
+        self.assertIs(limiter.forURL("http://a.example/1"),
+                        limiter.forURL("http://A.example/2"))
+        self.assertIsNot(limiter.forURL("http://a.example/"),
+                        limiter.forURL("http://b.example/"))
+        with futures.ThreadPoolExecutor(max_workers=3) as executor:
+            for num in range(3):
+                executor.submit(_retrieveConcurrently,
+                                "http://a.example/{}".format(num), userAgents,
+                                2, self.opener(), limiter, None)
+        self.assertEqual(len(self.requests), 3 * len(userAgents))
+        self.assertEqual(self.mostInFlight, 2)
+
+    def test_urlErrorStopsOtherAgents(self):
+        error = urlErr.URLError(ConnectionRefusedError())
+        with contextlib.redirect_stderr(io.StringIO()):
+            (_, stopped) = _retrieveConcurrently("http://a.example/",
+                            userAgents, 2, self.opener(error), HostLimiter(1),
+                            None)
+        self.assertEqual(stopped, FAILED)
+        self.assertEqual(len(self.requests), 1)
+
+
+class HostFailureCacheTester(unittest.TestCase):
+    def test_refusedHostSkipped(self):
+        with socket.socket() as sock:   # Find a port nothing listens on
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        now = [1000.0]
+        failures = HostFailureCache(ttl=60, clock=lambda: now[0])
+        url = "http://127.0.0.1:{}/".format(port)
+        self.assertEqual(retrieveURLWithEachUserAgent(url, concurrent=False,
+                        hostFailures=failures).outcome, FAILED)
+        self.assertEqual(failures.failure(url + "other"), "connection refused")
+        self.assertEqual(failures.entries(),
+                {domain(url): ("connection refused", 1060.0)})
+        skipped = retrieveURLWithEachUserAgent(url, hostFailures=failures)
+        self.assertEqual(skipped, [])
+        self.assertEqual(skipped.outcome, SKIPPED)
+        now[0] = 1060.0
+        self.assertIsNone(failures.failure(url))
+        self.assertEqual(failures.entries(), {})
+
 
 if __name__=="__main__":
     main()
@@ -1,5 +1,35 @@
 #!/usr/bin/env python3
 
+def ask_account(account):
+    """
+    Ask for the details of an email account, offering those in account as
+    defaults.  Returns the account with the answers filled in.
+    """
+    account = dict(account)
+    new = dict()
+    new["hostname"] = input("IMAP Server Hostname ({}): ".format(
+        account["hostname"]))
+    new["port"] = input("IMAP Server Port ({}): ".format(
+        account["port"]))
+    new["username"] = input("Username ({}): ".format(
+        account["username"]))
+    new["password"] = input("Password ({}): ".format(
+        account["password"]))
+    folders = input("Folders, separated by commas ({}): ".format(
+        ", ".join(account.get("folders", ["INBOX"]))))
+    connections = input("Most connections at once ({}): ".format(
+        account.get("maxConnections", 2)))
+
+    for key, val in new.items():
+        if val:
+            account[key] = val
+    if folders:
+        account["folders"] = [folder.strip() for folder in folders.split(",")
+                if folder.strip()]
+    if connections:
+        account["maxConnections"] = int(connections)
+    return account
+
 def write_config():
     filename = "EmailAcctData.py"
 
@@ -8,30 +38,36 @@ def write_config():
     except ImportError as e:
         server_details = {"hostname": "", "port": "993", "username": "",
                 "password": ""}
+    try:
+        from EmailAcctData import accounts
+    except ImportError as e:
+        accounts = [server_details]
 
     print("Malmail Setup")
     print(
-"""This program will request information about the email account you wish to
+"""This program will request information about the email accounts you wish to
 look for malicious email in.  It will write that information in plaintext, as
-a dictionary, to the file "{}" in the current directory.
-""".format(filename))
+dictionaries, to the file "{}" in the current directory.
 
-    new = dict()
-    new["hostname"] = input("IMAP Server Hostname ({}): ".format(
-        server_details["hostname"]))
-    new["port"] = input("IMAP Server Port ({}): ".format(
-        server_details["port"]))
-    new["username"] = input("Username ({}): ".format(
-        server_details["username"]))
-    new["password"] = input("Password ({}): ".format(
-        server_details["password"]))
+Accounts are collected from at the same time, each using at most its number of
+connections.  Answer - for an extra account's hostname to remove it.
+""".format(filename))
 
-    for key, val in new.items():
-        if val:
-            server_details[key] = val
+    new_accounts = []
+    for (num, account) in enumerate(accounts):
+        print("Account {}".format(num + 1))
+        account = ask_account(account)
+        if num == 0 or account["hostname"] != "-":
+            new_accounts.append(account)
+    while input("Add another account? (y/N): ").strip().lower() == "y":
+        new_accounts.append(ask_account(dict(new_accounts[0], hostname="",
+                username="", password="")))
 
+    server_details = {key: new_accounts[0][key] for key in
+            ("hostname", "port", "username", "password")}
     with open(filename, "w") as f:
-        f.write("server_details = {}".format(server_details))
+        f.write("server_details = {}\n".format(server_details))
+        f.write("accounts = {}\n".format(new_accounts))
 
 if __name__ == "__main__":
     write_config()
@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+Find near-duplicate emails and pages, to group them into campaigns.
+
+Each document is reduced to a MinHash signature of its word shingles.  The
+signatures come from one-permutation hashing: every shingle is hashed once
+and the hash lands in one of SIGNATURE_BINS bins, keeping each bin's
+minimum.  Bins no shingle landed in are densified by copying the bin a
+fixed, per-bin probe sequence finds first, so short documents still get a
+full signature.  The fraction of bins two signatures share estimates the
+Jaccard similarity of their shingle sets.
+
+Signatures are split into bands, and documents sharing any band's values
+become candidates (locality-sensitive hashing), so a query looks up a few
+index entries instead of comparing against every document.  Candidates are
+then checked against the similarity threshold.
+
+The index is an SQLite file beside malmail.db.  Database keeps it in step
+with the content tables: new Email, HTML_Content and JS_Content rows are
+added as ContentToDatabase stores them, in the same transactions.
+
+Intended use:
+    index = SimilarityIndex()
+    index.add("Email", emailID, text)
+    index.similar("Email", emailID)     # [(id, similarity), ...]
+    index.clusters("Email")             # [[id, id, ...], ...]
+"""
+
+import argparse
+import array
+import contextlib
+import io
+import itertools
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import unittest
+import zlib
+
+DEFAULT_INDEX_PATH = "malmail-similarity.db"
+SIGNATURE_BINS = 128
+DEFAULT_BANDS = 32              # Of SIGNATURE_BINS // DEFAULT_BANDS bins each
+DEFAULT_THRESHOLD = 0.5
+SHINGLE_WORDS = 3
+# The content models indexed, by name.  Other_Content may be anything,
+# so it isn't.
+KINDS = ("Email", "HTML_Content", "JS_Content")
+
+_wordRE = re.compile(r"\w+")
+_HASH_RANGE = 1 << 32
+
+def shingles(text, size=SHINGLE_WORDS):
+    """
+    :returns: the set of size-word runs in text, lower cased, as bytes.
+        Texts shorter than size words give their words.
+    """
+    if isinstance(text, bytes):
+        text = text.decode("utf-8", "replace")
+    words = _wordRE.findall(text.lower())
+    if len(words) < size:
+        return {word.encode("utf-8") for word in words}
+    return {" ".join(words[start:start + size]).encode("utf-8")
+            for start in range(len(words) - size + 1)}
+
+class MinHasher():
+    """
+    Computes one-permutation MinHash signatures with densification.
+
+    :param int bins: the signature length
+    """
+    def __init__(self, bins=SIGNATURE_BINS):
+        self.bins = bins
+        # Where each empty bin looks for a value: its own pseudo-random
+        # order of the other bins, the same for every document
+        self._probes = [[zlib.crc32(b"%d:%d" % (binNum, attempt))
+                        * bins >> 32 for attempt in range(4 * bins)]
+                for binNum in range(bins)]
+
+    def signature(self, shingleSet):
+        """
+        :returns: an array of bins unsigned ints, or None if shingleSet is
+            empty
+        """
+        if not shingleSet:
+            return None
+        (bins, empty) = (self.bins, _HASH_RANGE)
+        minimums = [empty] * bins
+        for shingle in shingleSet:
+            value = zlib.crc32(shingle)
+            binNum = value * bins >> 32
+            if value < minimums[binNum]:
+                minimums[binNum] = value
+        return array.array("I", [value if value != empty
+                else self._densified(minimums, binNum)
+                for (binNum, value) in enumerate(minimums)])
+
+    def _densified(self, minimums, binNum):
+        for probe in self._probes[binNum]:
+            if minimums[probe] != _HASH_RANGE:
+                return minimums[probe]
+        # The probes missed every filled bin: take the next filled one
+        for offset in range(1, self.bins):
+            probe = (binNum + offset) % self.bins
+            if minimums[probe] != _HASH_RANGE:
+                return minimums[probe]
+
+def similarity(signatureA, signatureB):
+    """:returns: the estimated Jaccard similarity of two signatures"""
+    same = sum(1 for (a, b) in zip(signatureA, signatureB) if a == b)
+    return same / len(signatureA)
+
+class SimilarityIndex():
+    """
+    :param str path: the index database file
+    :param int bands: how many bands signatures are split into.  More, and
+        narrower, bands find less similar documents, at the cost of more
+        candidates to check.
+    """
+    def __init__(self, path=DEFAULT_INDEX_PATH, bands=DEFAULT_BANDS):
+        if SIGNATURE_BINS % bands:
+            raise ValueError("bands must divide {}".format(SIGNATURE_BINS))
+        self.path = path
+        self.bands = bands
+        self.hasher = MinHasher()
+        self._bandBytes = SIGNATURE_BINS // bands * 4
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.execute("PRAGMA journal_mode=wal")
+            self._db.execute("PRAGMA synchronous=normal")
+            self._db.execute("PRAGMA cache_size=-64000")
+            self._db.execute("CREATE TABLE IF NOT EXISTS signature ("
+                    "kind INTEGER, id INTEGER, signature BLOB, "
+                    "PRIMARY KEY (kind, id)) WITHOUT ROWID")
+            self._db.execute("CREATE TABLE IF NOT EXISTS band ("
+                    "kind INTEGER, key INTEGER, id INTEGER, "
+                    "PRIMARY KEY (kind, key, id)) WITHOUT ROWID")
+
+    def close(self):
+        self._db.close()
+
+    def commit(self):
+        """Make everything added so far permanent"""
+        with self._lock:
+            self._db.commit()
+
+    def rollback(self):
+        """Forget everything added since the last commit"""
+        with self._lock:
+            self._db.rollback()
+
+    @staticmethod
+    def _kind(kind):
+        try:
+            return KINDS.index(kind)
+        except ValueError:
+            raise ValueError("Not an indexed kind: {}".format(kind))
+
+    def _bandKeys(self, signature):
+        data = signature.tobytes()
+        size = self._bandBytes
+        return [(band << 32) | zlib.crc32(data[band * size:(band + 1) * size])
+                for band in range(self.bands)]
+
+    def add(self, kind, docID, text):
+        """
+        Index a document, unless it has no words or is indexed already.
+        Uncommitted until commit().
+
+        :param str kind: one of KINDS
+        :param int docID: the document's id in its table
+        :param text: the document, str or bytes
+
+        :returns: True if the document was added
+        """
+        return self.addSignature(kind, docID,
+                self.hasher.signature(shingles(text)))
+
+    def addSignature(self, kind, docID, signature):
+        """add() for a signature already computed"""
+        if signature is None:
+            return False
+        kindNum = self._kind(kind)
+        with self._lock:
+            cursor = self._db.execute("INSERT OR IGNORE INTO signature "
+                    "VALUES (?, ?, ?)", (kindNum, docID, signature.tobytes()))
+            if cursor.rowcount == 0:
+                return False
+            self._db.executemany("INSERT OR IGNORE INTO band VALUES (?, ?, ?)",
+                    ((kindNum, key, docID) for key in self._bandKeys(signature)))
+        return True
+
+    def signature(self, kind, docID):
+        """:returns: the stored signature of a document, or None"""
+        row = self._db.execute("SELECT signature FROM signature "
+                "WHERE kind = ? AND id = ?", (self._kind(kind), docID)
+                ).fetchone()
+        return None if row is None else self._array(row[0])
+
+    @staticmethod
+    def _array(data):
+        signature = array.array("I")
+        signature.frombytes(data)
+        return signature
+
+    def __len__(self):
+        (count,) = self._db.execute("SELECT COUNT(*) FROM signature"
+                ).fetchone()
+        return count
+
+    def similar(self, kind, docID=None, text=None,
+                threshold=DEFAULT_THRESHOLD, limit=None):
+        """
+        Find the documents like an indexed document, or like some text.
+
+        :param int docID: an indexed document to compare against
+        :param text: otherwise, the text to compare against
+        :param float threshold: the least estimated similarity reported
+        :param int limit: report at most this many of the most similar
+
+        :returns: [(id, similarity), ...], most similar first, without docID
+        """
+        if docID is not None:
+            signature = self.signature(kind, docID)
+        else:
+            signature = self.hasher.signature(shingles(text))
+        if signature is None:
+            return []
+        kindNum = self._kind(kind)
+        keys = self._bandKeys(signature)
+        candidates = self._db.execute("SELECT id, signature FROM signature "
+                "WHERE kind = ? AND id IN (SELECT id FROM band "
+                "WHERE kind = ? AND key IN ({}))".format(
+                ", ".join("?" * len(keys))), [kindNum, kindNum] + keys)
+        found = []
+        for (candidateID, data) in candidates:
+            if candidateID == docID:
+                continue
+            score = similarity(signature, self._array(data))
+            if score >= threshold:
+                found.append((candidateID, score))
+        found.sort(key=lambda item: (-item[1], item[0]))
+        return found if limit is None else found[:limit]
+
+    def clusters(self, kind, threshold=DEFAULT_THRESHOLD, minSize=2):
+        """
+        Group every indexed document of kind into clusters of similar ones,
+        such as the emails of one campaign.  Each pair of documents sharing a
+        band is joined when they're at least threshold similar, unless
+        they're in one cluster already; clusters are the connected groups.
+
+        :returns: [[id, ...], ...] of at least minSize documents each,
+            largest first
+        """
+        kindNum = self._kind(kind)
+        parents = dict()
+
+        def _root(docID):
+            root = docID
+            while parents.get(root, root) != root:
+                root = parents[root]
+            while docID != root:    # Shorten the path for next time
+                (parents[docID], docID) = (root, parents[docID])
+            return root
+
+        signatures = dict()
+        def _signature(docID):
+            if docID not in signatures:
+                signatures[docID] = self.signature(kind, docID)
+            return signatures[docID]
+
+        # The documents of each band shared by more than one
+        shared = self._db.execute("SELECT key, id FROM band WHERE kind = ? "
+                "AND key IN (SELECT key FROM band WHERE kind = ? "
+                "GROUP BY key HAVING COUNT(*) > 1) ORDER BY key, id",
+                (kindNum, kindNum))
+        for (_, rows) in itertools.groupby(shared, key=lambda row: row[0]):
+            members = [docID for (_, docID) in rows]
+            for (num, docID) in enumerate(members):
+                for other in members[:num]:
+                    if _root(other) == _root(docID):
+                        continue
+                    if (similarity(_signature(other), _signature(docID)) >=
+                            threshold):
+                        root = parents.setdefault(_root(other), _root(other))
+                        parents[_root(docID)] = root
+
+        groups = dict()
+        for docID in parents:
+            groups.setdefault(_root(docID), []).append(docID)
+        return sorted((sorted(group) for group in groups.values()
+                        if len(group) >= minSize),
+                key=lambda group: (-len(group), group[0]))
+
+    def rebuild(self, kinds=KINDS, pageSize=1000):
+        """
+        Index the rows of the content tables that aren't indexed yet, such as
+        those stored before the index existed.  Needs a database connection.
+
+        :returns: how many documents were added
+        """
+        import DatabaseModel
+        import Export
+        added = 0
+        for kind in kinds:
+            model = getattr(DatabaseModel, kind)
+            for rows in Export.pages(model, pageSize=pageSize):
+                for row in rows:
+                    row = dict(zip(Export.columns(model), row))
+                    added += self.add(kind, row["id"], row["content"])
+                self.commit()
+        return added
+
+def main():
+    import DatabaseModel
+    parser = argparse.ArgumentParser(
+                    description="Find similar emails and pages.")
+    parser.add_argument("-p", "--path", default=DEFAULT_INDEX_PATH,
+                    help="The index file.  Default: {}".format(
+                    DEFAULT_INDEX_PATH))
+    parser.add_argument("-k", "--kind", choices=KINDS, default="Email",
+                    help="The documents to search.  Default: Email.")
+    parser.add_argument("-t", "--threshold", type=float,
+                    default=DEFAULT_THRESHOLD, help="The least similarity "
+                    "reported.  Default: {}".format(DEFAULT_THRESHOLD))
+    commands = parser.add_mutually_exclusive_group(required=True)
+    commands.add_argument("--rebuild", action="store_true",
+                    help="Index content stored before the index existed.")
+    commands.add_argument("--similar", type=int, metavar="ID",
+                    help="List the documents like document ID.")
+    commands.add_argument("--clusters", action="store_true",
+                    help="List the groups of similar documents.")
+    args = parser.parse_args()
+
+    index = SimilarityIndex(args.path)
+    try:
+        if args.rebuild:
+            DatabaseModel.database.connect()
+            try:
+                print("Indexed {} documents".format(index.rebuild()))
+            finally:
+                DatabaseModel.database.close()
+        elif args.similar is not None:
+            for (docID, score) in index.similar(args.kind, args.similar,
+                            threshold=args.threshold):
+                print("{}: {:.2f}".format(docID, score))
+        else:
+            for group in index.clusters(args.kind, args.threshold):
+                print("{} documents: {}".format(len(group),
+                        " ".join(str(docID) for docID in group)))
+    finally:
+        index.close()
+
+
+
+
+
+class SimilarityIndexTester(unittest.TestCase):
+    template = ("Dear {name}, your account at {bank} has been suspended "
+            "because of unusual sign in activity.  To restore access please "
+            "verify your identity within 24 hours at the secure link below "
+            "or your account will be closed permanently.  Thank you for "
+            "banking with {bank} customer security team reference {ref}")
+    parcel = ("Hello {name}, we tried to deliver parcel {ref} today but "
+            "nobody was home to sign for it.  A redelivery fee of 1.99 is "
+            "due before we can schedule another attempt, pay it online "
+            "using the tracking page and choose a new delivery day from "
+            "{bank} depot")
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.index = SimilarityIndex(os.path.join(self.tmpdir.name, "sim.db"))
+
+    def tearDown(self):
+        self.index.close()
+        self.tmpdir.cleanup()
+
+    def test_densifiedSignatures(self):
+        hasher = MinHasher()
+        short = hasher.signature(shingles("one two"))
+        self.assertEqual(len(short), SIGNATURE_BINS)
+        self.assertEqual(set(short), {zlib.crc32(b"one"), zlib.crc32(b"two")})
+        self.assertIsNone(hasher.signature(shingles(" ,. ")))
+        text = self.template.format(name="Ann", bank="First", ref=1)
+        self.assertEqual(similarity(hasher.signature(shingles(text)),
+                hasher.signature(shingles(text.upper()))), 1.0)
+
+    def test_similarAndClusters(self):
+        names = ["Ann", "Bob", "Cy", "Di", "Ed"]
+        for (num, name) in enumerate(names):
+            self.assertTrue(self.index.add("Email", num + 1,
+                    self.template.format(name=name, bank="First", ref=num)))
+            self.index.add("Email", num + 11, self.parcel.format(
+                    name=name, bank="Leeds", ref=num * 7))
+        self.index.add("Email", 21, "Lunch on Friday?  The usual place at "
+                "noon, bring the quarterly numbers if you have them.")
+        self.index.add("HTML_Content", 1, self.template)
+        self.assertFalse(self.index.add("Email", 1, "already indexed"))
+        self.index.commit()
+
+        similar = self.index.similar("Email", 1)
+        self.assertEqual(sorted(docID for (docID, _) in similar), [2, 3, 4, 5])
+        self.assertEqual(similar, sorted(similar, key=lambda item: -item[1]))
+        self.assertTrue(all(score >= DEFAULT_THRESHOLD
+                for (_, score) in similar))
+        self.assertEqual(self.index.similar("Email", text="lunch on friday?"
+                " the usual place at noon", threshold=0.2)[0][0], 21)
+        self.assertEqual(self.index.clusters("Email"),
+                [[1, 2, 3, 4, 5], [11, 12, 13, 14, 15]])
+
+        self.index.add("Email", 30, "Something else")
+        self.index.rollback()
+        self.assertEqual(len(self.index), 12)
+
+    def test_clustersCompareEveryBandMember(self):
+        # 2 and 3 match 3 bins of every band, but only share band 0, where
+        # 1, which is like neither, has the lowest id
+        bandBins = SIGNATURE_BINS // DEFAULT_BANDS
+        signatures = {docID: array.array("I", range(base,
+                base + SIGNATURE_BINS)) for (docID, base) in
+                ((1, 1000), (2, 5000), (3, 5000))}
+        for signature in signatures.values():
+            signature[:bandBins] = array.array("I", [1] * bandBins)
+        for band in range(1, DEFAULT_BANDS):
+            signatures[3][(band + 1) * bandBins - 1] += 9000
+        for (docID, signature) in signatures.items():
+            self.index.addSignature("Email", docID, signature)
+        self.index.commit()
+        self.assertGreater(similarity(signatures[2], signatures[3]),
+                DEFAULT_THRESHOLD)
+        self.assertEqual(self.index.clusters("Email"), [[2, 3]])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+"""
+Small local servers that stand in for the internet in tests and benchmarks.
+
+StandInIMAPServer speaks just enough IMAP4rev1 for EmailRetriever, and
+StandInHTTPServer serves a fixed set of pages over keep-alive HTTP/1.1.
+
+Intended use:
+    with StandInIMAPServer(messages) as server:
+        EmailRetriever("127.0.0.1", server.port, "user", "pass",
+                        useSSL=False)
+"""
+
+import http.server
+import re
+import socketserver
+import threading
+import time
+
+class _StandInServer(socketserver.ThreadingTCPServer):
+    """Runs a handler class on localhost in a background thread."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handlerClass):
+        super().__init__(("127.0.0.1", 0), handlerClass)
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                        daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInIMAPServer(_StandInServer):
+    """
+    An IMAP server holding one mailbox, INBOX, in memory.
+
+    :param iterable messages:
+        The RFC822 bytes of each message.  They get UIDs from 1.
+    :param float latency:
+        Seconds to wait before answering each command, to imitate a round
+        trip to a distant server
+    :param int uidValidity:
+        The UIDVALIDITY reported for INBOX, or None to report none, as some
+        servers don't
+    """
+    def __init__(self, messages, latency=0.0, uidValidity=1):
+        super().__init__(_IMAPHandler)
+        self.latency = latency
+        self.uidValidity = uidValidity
+        self.messages = [] # [[uid, bytes, seen], ...]
+        self.commandCount = 0
+        self._lock = threading.Lock()
+        for message in messages:
+            self.addMessage(message)
+
+    def addMessage(self, message, seen=False):
+        """Append a message to INBOX, returning its UID."""
+        with self._lock:
+            uid = self.messages[-1][0] + 1 if self.messages else 1
+            self.messages.append([uid, message, seen])
+        return uid
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+    _commandRE = re.compile(rb"^(\S+) (\S+)(?: (.*))?$")
+
+    def handle(self):
+        self.selected = False
+        self._send(b"* OK IMAP4rev1 stand-in ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            match = self._commandRE.match(line.rstrip(b"\r\n"))
+            if match is None:
+                self._send(b"* BAD unparseable command")
+                continue
+            (tag, command, args) = match.groups()
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            with self.server._lock:
+                self.server.commandCount += 1
+            command = command.upper()
+            if command == b"UID":
+                (command, _, args) = (args or b"").partition(b" ")
+                command = b"UID " + command.upper()
+            handler = self._commands.get(command)
+            if handler is None:
+                self._send(tag + b" BAD unknown command")
+            elif handler(self, tag, args or b"") is False:
+                return
+
+    def _send(self, *lines):
+        self.wfile.write(b"".join(line + b"\r\n" for line in lines))
+
+    def _capability(self, tag, args):
+        self._send(b"* CAPABILITY IMAP4rev1", tag + b" OK done")
+
+    def _ok(self, tag, args):
+        self._send(tag + b" OK done")
+
+    def _login(self, tag, args):
+        if args.split(b" ")[0].strip(b'"') == b"wrong":
+            self._send(tag + b" NO [AUTHENTICATIONFAILED] bad login")
+        else:
+            self._send(tag + b" OK logged in")
+
+    def _select(self, tag, args):
+        if args.strip(b'"').upper() != b"INBOX":
+            self._send(tag + b" NO no such mailbox")
+            return
+        self.selected = True
+        lines = [b"* %d EXISTS" % len(self.server.messages)]
+        if self.server.uidValidity is not None:
+            lines.append(b"* OK [UIDVALIDITY %d] UIDs valid" %
+                    self.server.uidValidity)
+        self._send(*lines, tag + b" OK [READ-WRITE] selected")
+
+    def _close(self, tag, args):
+        self.selected = False
+        self._send(tag + b" OK closed")
+
+    def _logout(self, tag, args):
+        self._send(b"* BYE logging out", tag + b" OK done")
+        return False
+
+    def _uidSearch(self, tag, args):
+        messages = list(self.server.messages)
+        criteria = args.upper().split()
+        if b"UNSEEN" in criteria:
+            messages = [msg for msg in messages if not msg[2]]
+        if b"UID" in criteria:
+            uidSet = criteria[criteria.index(b"UID") + 1]
+            messages = self._inSet(messages, uidSet)
+        uids = b" ".join(b"%d" % msg[0] for msg in messages)
+        self._send(b"* SEARCH " + uids if uids else b"* SEARCH",
+                tag + b" OK searched")
+
+    def _uidFetch(self, tag, args):
+        (uidSet, _, items) = args.partition(b" ")
+        peek = b"PEEK" in items.upper()
+        name = b"RFC822" if b"RFC822" in items.upper() else b"BODY[]"
+        allMessages = list(self.server.messages)
+        for message in self._inSet(allMessages, uidSet):
+            (uid, data, _) = message
+            sequence = allMessages.index(message) + 1
+            self.wfile.write(b"* %d FETCH (UID %d %s {%d}\r\n" % (
+                            sequence, uid, name, len(data)) + data + b")\r\n")
+            if not peek:
+                message[2] = True
+        self._send(tag + b" OK fetched")
+
+    def _uidStore(self, tag, args):
+        (uidSet, _, flags) = args.partition(b" ")
+        if b"\\SEEN" in flags.upper():
+            for message in self._inSet(self.server.messages, uidSet):
+                message[2] = not flags.startswith(b"-")
+        self._send(tag + b" OK stored")
+
+    @staticmethod
+    def _inSet(messages, uidSet):
+        """Filter messages to those whose UID is in the IMAP set uidSet"""
+        largest = messages[-1][0] if messages else 0
+        ranges = []
+        for part in uidSet.split(b","):
+            (low, _, high) = part.partition(b":")
+            low = largest if low == b"*" else int(low)
+            high = low if not high else (largest if high == b"*" else int(high))
+            ranges.append((min(low, high), max(low, high)))
+        return [msg for msg in messages
+                if any(low <= msg[0] <= high for (low, high) in ranges)]
+
+    _commands = {b"CAPABILITY": _capability, b"NOOP": _ok, b"LOGIN": _login,
+            b"SELECT": _select, b"EXAMINE": _select, b"CLOSE": _close,
+            b"LOGOUT": _logout, b"UID SEARCH": _uidSearch,
+            b"UID FETCH": _uidFetch, b"UID STORE": _uidStore}
+
+
+class StandInHTTPServer(_StandInServer):
+    """
+    An HTTP server for a fixed set of pages.
+
+    :param dict pages:
+        path: bytes, served as text/html, or
+        path: (status, {header: value}, bytes), or
+        path: (status, {header: value}, bytes, seconds to delay the answer)
+        Other paths get a 404.
+    :param float latency:
+        Seconds to wait before answering each request
+    """
+    def __init__(self, pages, latency=0.0):
+        super().__init__(_HTTPHandler)
+        self.pages = pages
+        self.latency = latency
+        self.connectionCount = 0
+        self.requestCount = 0
+        self._lock = threading.Lock()
+
+    def url(self, path="/"):
+        return "http://127.0.0.1:{}{}".format(self.port, path)
+
+
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server._lock:
+            self.server.connectionCount += 1
+
+    def do_GET(self):
+        with self.server._lock:
+            self.server.requestCount += 1
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        page = self.server.pages.get(self.path)
+        if page is None:
+            page = (404, {}, b"not found")
+        elif isinstance(page, bytes):
+            page = (200, {"Content-Type": "text/html; charset=utf-8"}, page)
+        (status, headers, body, delay) = (tuple(page) + (0,))[:4]
+        if delay:
+            time.sleep(delay)
+
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Reduce the many spellings of a URL to one, so it's stored and fetched once.
+
+http://EVIL.com:80/a#x, http://evil.com/a and http://evil.com/%61 are all
+http://evil.com/a.  URLs that can't be fetched, such as javascript: and
+mailto: links or relative URLs with nothing to resolve them against,
+canonicalize to None.
+
+Intended use:
+    canonical = defaultCanonicalizer.canonicalize(url)
+    if canonical is not None:
+        frontier.add(canonical)
+"""
+
+import re
+import unittest
+import urllib.parse as urlParse
+
+from Common import BoundedCache
+
+FETCHABLE_SCHEMES = ("http", "https")
+DEFAULT_CACHE_SIZE = 100000
+
+_defaultPorts = {"http": 80, "https": 443, "ftp": 21}
+# Characters removed anywhere in a URL, as browsers do
+_strippedChars = str.maketrans("", "", "\t\r\n")
+_escapeRE = re.compile(r"%([0-9A-Fa-f]{2})")
+_unreserved = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+        "0123456789-._~")
+# Left alone when quoting paths and queries: reserved characters, and "%"
+# so existing escapes survive
+_pathSafe = "/:@!$&'()*+,;=%~"
+_querySafe = _pathSafe + "?"
+
+def _normalizeEscapes(text, safe):
+    """
+    Decode escaped unreserved characters, upper-case the remaining escapes,
+    and escape anything that must be.
+    """
+    def _replace(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in _unreserved else "%" + match.group(1).upper()
+    return urlParse.quote(_escapeRE.sub(_replace, text), safe=safe)
+
+class URLCanonicalizer():
+    """
+    :param iterable schemes: the schemes kept.  URLs with others, or with
+        none, canonicalize to None.
+    :param bool dropFragments: remove #fragments
+    :param bool dropDefaultPorts: remove ports that are the scheme's default
+    :param bool normalizeEscapes: make percent-encoding consistent
+    :param bool idna: encode international host names as ASCII
+    :param int cacheSize: how many URLs to remember the canonical form of.
+        0 disables the cache.
+    """
+    def __init__(self, schemes=FETCHABLE_SCHEMES, dropFragments=True,
+                    dropDefaultPorts=True, normalizeEscapes=True, idna=True,
+                    cacheSize=DEFAULT_CACHE_SIZE):
+        self.schemes = frozenset(scheme.lower() for scheme in schemes)
+        self.dropFragments = dropFragments
+        self.dropDefaultPorts = dropDefaultPorts
+        self.normalizeEscapes = normalizeEscapes
+        self.idna = idna
+        self._cache = BoundedCache(cacheSize)
+
+    def canonicalize(self, url):
+        """
+        Return value: the canonical form of url, or None if it can't be
+                fetched
+        """
+        if isinstance(url, bytes):
+            url = url.decode("utf-8", "replace")
+        canonical = self._cache.get(url, self)
+        if canonical is self:
+            canonical = self._canonicalize(url)
+            self._cache.put(url, canonical)
+        return canonical
+
+    __call__ = canonicalize
+
+    def canonicalURLs(self, urlList):
+        """Yield the canonical form of each fetchable URL in urlList"""
+        for url in urlList:
+            canonical = self.canonicalize(url)
+            if canonical is not None:
+                yield canonical
+
+    def _canonicalize(self, url):
+        try:
+            parts = urlParse.urlsplit(url.strip().translate(_strippedChars))
+            port = parts.port
+        except ValueError:  # Such as a port out of range
+            return None
+        scheme = parts.scheme.lower()
+        if scheme not in self.schemes or not parts.hostname:
+            return None
+
+        host = self._host(parts.hostname)
+        if host is None:
+            return None
+        if ":" in host:
+            host = "[{}]".format(host)
+        if port is not None and not (self.dropDefaultPorts and
+                        port == _defaultPorts.get(scheme)):
+            host = "{}:{}".format(host, port)
+        userInfo = parts.netloc.rpartition("@")[0]
+        netloc = "{}@{}".format(userInfo, host) if userInfo else host
+
+        (path, query) = (parts.path or "/", parts.query)
+        if self.normalizeEscapes:
+            path = _normalizeEscapes(path, _pathSafe)
+            query = _normalizeEscapes(query, _querySafe)
+        fragment = "" if self.dropFragments else parts.fragment
+        return urlParse.urlunsplit((scheme, netloc, path, query, fragment))
+
+    def _host(self, hostname):
+        """The canonical host name, or None if it can't be one"""
+        host = urlParse.unquote(hostname).lower().rstrip(".")
+        if not host:
+            return None
+        if self.idna and not host.isascii():
+            try:
+                host = host.encode("idna").decode("ascii")
+            except UnicodeError:
+                return None
+        return host
+
+defaultCanonicalizer = URLCanonicalizer()
+
+
+
+
+class URLCanonicalizerTester(unittest.TestCase):
+    def test_spellingsCollapse(self):
+        spellings = ["http://EVIL.com/a#x", "http://evil.com:80/a",
+                "http://evil.com/a", "HTTP://evil.com./%61", " http://evil.com\n/a "]
+        self.assertEqual({defaultCanonicalizer(url) for url in spellings},
+                {"http://evil.com/a"})
+
+    def test_details(self):
+        canon = URLCanonicalizer()
+        self.assertEqual(canon("https://Bücher.example:443"),
+                "https://xn--bcher-kva.example/")
+        self.assertEqual(canon("http://a.example:8080/p a/%7e%2f?q=%c3%a9 x"),
+                "http://a.example:8080/p%20a/~%2F?q=%C3%A9%20x")
+        self.assertEqual(canon(b"http://user@[::1]:80/"), "http://user@[::1]/")
+        for unfetchable in ("javascript:void(0)", "mailto:a@b.example",
+                "/relative/path", "//no.scheme/", "http://a.example:99999/",
+                "data:text/html,hi"):
+            self.assertIsNone(canon(unfetchable), unfetchable)
+        keeping = URLCanonicalizer(dropFragments=False, cacheSize=0)
+        self.assertEqual(keeping("http://a.example/#top"),
+                "http://a.example/#top")
+
+
+if __name__ == "__main__":
+    unittest.main()